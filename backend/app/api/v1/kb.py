@@ -1,4 +1,4 @@
-from fastapi import APIRouter, Depends, UploadFile, File, Form, HTTPException, Query
+from fastapi import APIRouter, Depends, UploadFile, File, Form, HTTPException, Query, Header, Request
 from sqlalchemy.orm import Session
 from typing import Optional
 
@@ -7,9 +7,11 @@ from app.core.deps import CommonDeps
 from app.db.session import get_db
 from app.models.orm import User
 from app.models.schemas import (
-    UploadResponse, IngestRequest, IngestResponse, TaskResponse, SearchResponse
+    UploadResponse, IngestRequest, IngestResponse, IngestMode, TaskResponse, SearchResponse,
+    BatchSearchRequest, BatchSearchResponse, UploadSessionCreate, UploadSessionResponse, UploadPartInfo
 )
 from app.services.kb_service import kb_service
+from app.services.upload_service import upload_service
 
 router = APIRouter()
 
@@ -22,27 +24,103 @@ async def upload_document(
     db: Session = Depends(get_db)
 ):
     """上传文档（需要教师权限）"""
-    # 读取文件内容
-    file_content = await file.read()
-    
     # 获取文件类型
     file_type = file.filename.split('.')[-1] if '.' in file.filename else ''
     
-    # 上传文档
-    document = await kb_service.upload_document(
+    # 上传文档（按块写入磁盘，不整体读入内存）
+    document, deduplicated = await kb_service.upload_document_stream(
         db=db,
         course_id=course_id,
         file_name=file.filename,
-        file_content=file_content,
+        stream=file,
         file_type=file_type
     )
     
     return UploadResponse(
         document_id=document.id,
-        status=document.status
+        status=document.status,
+        deduplicated=deduplicated
+    )
+
+
+@router.post("/uploads", response_model=UploadSessionResponse)
+async def create_upload_session(
+    request: UploadSessionCreate,
+    current_user: User = Depends(require_teacher),
+    db: Session = Depends(get_db)
+):
+    """创建断点续传上传会话（需要教师权限）"""
+    session = upload_service.create_session(
+        db=db,
+        user_id=current_user.id,
+        course_id=request.course_id,
+        file_name=request.file_name,
+        total_size=request.total_size
+    )
+    return UploadSessionResponse(**upload_service.describe(session))
+
+
+@router.put("/uploads/{upload_id}/parts/{part_number}", response_model=UploadPartInfo)
+async def upload_part(
+    upload_id: str,
+    part_number: int,
+    request: Request,
+    x_part_sha256: Optional[str] = Header(None),
+    current_user: User = Depends(require_teacher),
+    db: Session = Depends(get_db)
+):
+    """上传一个分片（请求体为分片原始字节，编号从 1 开始；可用 X-Part-SHA256 校验）"""
+    session = upload_service.get_session(db, upload_id, current_user.id)
+    part = await upload_service.write_part(
+        db=db,
+        session=session,
+        part_number=part_number,
+        stream=request.stream(),
+        expected_sha256=x_part_sha256
+    )
+    return UploadPartInfo(part_number=part.part_number, size=part.size, sha256=part.sha256)
+
+
+@router.get("/uploads/{upload_id}", response_model=UploadSessionResponse)
+async def get_upload_session(
+    upload_id: str,
+    current_user: User = Depends(require_teacher),
+    db: Session = Depends(get_db)
+):
+    """查询上传会话，返回已接收的分片（用于断点续传）"""
+    session = upload_service.get_session(db, upload_id, current_user.id)
+    return UploadSessionResponse(**upload_service.describe(session))
+
+
+@router.post("/uploads/{upload_id}/complete", response_model=UploadResponse)
+async def complete_upload(
+    upload_id: str,
+    current_user: User = Depends(require_teacher),
+    db: Session = Depends(get_db)
+):
+    """完成分片上传，拼接为文档"""
+    session = upload_service.get_session(db, upload_id, current_user.id)
+    document, deduplicated = await upload_service.complete(db, session)
+    
+    return UploadResponse(
+        document_id=document.id,
+        status=document.status,
+        deduplicated=deduplicated
     )
 
 
+@router.delete("/uploads/{upload_id}", response_model=UploadSessionResponse)
+async def abort_upload(
+    upload_id: str,
+    current_user: User = Depends(require_teacher),
+    db: Session = Depends(get_db)
+):
+    """取消上传会话并删除已接收的分片"""
+    session = upload_service.get_session(db, upload_id, current_user.id)
+    upload_service.abort(db, session)
+    return UploadSessionResponse(**upload_service.describe(session))
+
+
 @router.post("/ingest", response_model=IngestResponse)
 async def ingest_document(
     request: IngestRequest,
@@ -53,12 +131,53 @@ async def ingest_document(
     task_id = await kb_service.ingest_document(
         db=db,
         document_id=request.document_id,
-        chunk_policy=request.chunk_policy
+        chunk_policy=request.chunk_policy,
+        mode=request.mode,
+        force=request.force
     )
+    task_info = await kb_service.get_task_status(db, task_id)
+    
+    return IngestResponse(
+        task_id=task_id,
+        status=task_info["status"]
+    )
+
+
+@router.put("/documents/{document_id}", response_model=IngestResponse)
+async def replace_document(
+    document_id: int,
+    file: UploadFile = File(...),
+    current_user: User = Depends(require_teacher),
+    db: Session = Depends(get_db)
+):
+    """替换文档内容并增量入库，只重新向量化变化的文本块（需要教师权限）"""
+    from app.models.orm import Document
+    
+    document = db.query(Document).filter(Document.id == document_id).first()
+    if not document:
+        raise HTTPException(status_code=404, detail="文档不存在")
+    
+    file_type = file.filename.split('.')[-1] if '.' in file.filename else ''
+    
+    changed = await kb_service.replace_document(
+        db=db,
+        document=document,
+        file_name=file.filename,
+        stream=file,
+        file_type=file_type
+    )
+    
+    # 内容未变化且已入库时直接返回已完成的任务
+    task_id = await kb_service.ingest_document(
+        db=db,
+        document_id=document_id,
+        mode=IngestMode.INCREMENTAL if changed else IngestMode.FULL
+    )
+    task_info = await kb_service.get_task_status(db, task_id)
     
     return IngestResponse(
         task_id=task_id,
-        status="queued"
+        status=task_info["status"]
     )
 
 
@@ -75,7 +194,8 @@ async def get_task_status(
         task_id=task_info["task_id"],
         status=task_info["status"],
         progress=task_info["progress"],
-        error=task_info["error"]
+        error=task_info["error"],
+        queue_position=task_info["queue_position"]
     )
 
 
@@ -99,9 +219,9 @@ async def search_knowledge(
         top_k=top_k
     )
     
-    logger.info(f"kb_service返回结果数: {len(results)}")
+    logger.debug(f"kb_service返回结果数: {len(results)}")
     if results:
-        logger.info(f"第一个结果: {results[0]}")
+        logger.debug(f"第一个结果: {results[0]}")
     
     # 转换为响应格式
     hits = []
@@ -114,11 +234,41 @@ async def search_knowledge(
             "snippet": result["snippet"]
         })
     
-    logger.info(f"转换后hits数: {len(hits)}")
+    logger.debug(f"转换后hits数: {len(hits)}")
     
     return SearchResponse(hits=hits)
 
 
+@router.post("/search/batch", response_model=BatchSearchResponse)
+async def search_knowledge_batch(
+    request: BatchSearchRequest,
+    current_user: User = Depends(get_current_user)
+):
+    """批量搜索知识库（评测任务、教师预览等场景一次提交多个查询）"""
+    grouped = await kb_service.search_knowledge_batch(
+        course_id=request.course_id,
+        queries=request.queries,
+        top_k=request.top_k
+    )
+    
+    return BatchSearchResponse(results=[
+        {
+            "query": query,
+            "hits": [
+                {
+                    "chunk_id": result["chunk_id"],
+                    "score": result["score"],
+                    "document_id": result["document_id"],
+                    "meta": result["meta"],
+                    "snippet": result["snippet"]
+                }
+                for result in results
+            ]
+        }
+        for query, results in zip(request.queries, grouped)
+    ])
+
+
 @router.get("/documents/{document_id}")
 async def get_document(
     document_id: int,
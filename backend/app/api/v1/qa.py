@@ -28,8 +28,7 @@ async def ask_question(
         user_id=current_user.id,
         course_id=request.course_id,
         question=request.question,
-        top_k=request.top_k,
-        stream=False
+        top_k=request.top_k
     )
     
     elapsed = time.time() - start_time
@@ -40,7 +39,8 @@ async def ask_question(
         answer=result["answer"],
         confidence=result["confidence"],
         citations=result["citations"],
-        followups=result["followups"]
+        followups=result["followups"],
+        cached=result.get("cached", False)
     )
 
 
@@ -79,23 +79,27 @@ async def qa_stream(websocket: WebSocket, db: Session = Depends(get_db)):
             # 这里简化处理，实际应该验证token
             user_id = message.get("user_id", 1)  # 临时处理
             
+            # 流式生成答案；客户端断开时关闭生成器，终止上游LLM请求
+            answer_stream = rag_service.ask_question_stream(
+                db=db,
+                user_id=user_id,
+                course_id=message["course_id"],
+                question=message["question"]
+            )
             try:
-                # 流式生成答案
-                async for chunk in rag_service.ask_question(
-                    db=db,
-                    user_id=user_id,
-                    course_id=message["course_id"],
-                    question=message["question"],
-                    stream=True
-                ):
-                    await websocket.send_text(json.dumps(chunk))
+                async for chunk in answer_stream:
+                    await websocket.send_text(json.dumps(chunk, ensure_ascii=False))
                     
+            except WebSocketDisconnect:
+                raise
             except Exception as e:
                 logger.error(f"流式问答失败: {e}")
                 await websocket.send_text(json.dumps({
                     "type": "error",
                     "message": str(e)
                 }))
+            finally:
+                await answer_stream.aclose()
                 
     except WebSocketDisconnect:
         logger.info("WebSocket连接断开")
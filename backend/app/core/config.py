@@ -37,13 +37,20 @@ class Settings(BaseSettings):
     DATABASE_URL: str = "sqlite:///./app.db"
     
     # 向量数据库配置
-    VECTORDB_TYPE: str = "chroma"
+    VECTORDB_TYPE: str = "chroma"  # chroma | numpy
     CHROMA_PERSIST_DIR: str = "./storage/chroma_db"
+    NUMPY_VECTORDB_DIR: str = "./storage/numpy_vectordb"
+    NUMPY_VECTORDB_BLOCK_ROWS: int = 32768  # 每次矩阵乘法处理的行数
+    NUMPY_VECTORDB_QUANTIZATION: str = "none"  # none | int8
+    NUMPY_VECTORDB_RERANK_FACTOR: int = 4  # 量化粗排候选数 = top_k * 该系数
     
     # Embedding 配置
     EMBEDDING_PROVIDER: str = "siliconflow"
     EMBEDDING_MODEL: str = "BAAI/bge-large-zh-v1.5"
     EMBEDDING_DIMENSION: int = 1024
+    EMBEDDING_MAX_TOKENS: int = 512  # 向量模型单条输入的 token 上限（含 [CLS]/[SEP]）
+    EMBEDDING_TOKENIZER_PATH: str = ""  # 向量模型的本地 tokenizer.json，留空时按规则估算 token 数
+    TOKENIZER_CACHE_MAX_ENTRIES: int = 2048
     
     # LLM 配置
     LLM_PROVIDER: str = "siliconflow"
@@ -74,13 +81,39 @@ class Settings(BaseSettings):
     MAX_FILE_SIZE: str = "50MB"
     ALLOWED_FILE_TYPES: List[str] = ["pdf", "docx", "pptx", "md", "txt"]
     STORAGE_DIR: str = "./storage"
+    UPLOAD_BLOCK_SIZE: int = 1024 * 1024  # 流式上传每次读写的字节数
+    
+    # 断点续传上传配置（大文件分片上传，不受 MAX_FILE_SIZE 限制）
+    RESUMABLE_UPLOAD_MAX_SIZE: str = "1GB"
+    UPLOAD_PART_MAX_SIZE: str = "64MB"
+    UPLOAD_SESSION_TTL_HOURS: int = 24  # 超时未完成的上传会话被清理
     
     # RAG 配置
     CHUNK_SIZE: int = 800
     CHUNK_OVERLAP: int = 120
+    CHUNK_LENGTH_UNIT: str = "tokens"  # chars | tokens，按 token 计长时每个文本块都能完整向量化
+    CHUNK_SIZE_TOKENS: int = 480  # 不超过 EMBEDDING_MAX_TOKENS - 2
+    CHUNK_OVERLAP_TOKENS: int = 64
     TOP_K: int = 12
     RERANK_TOP_N: int = 6
     CONFIDENCE_THRESHOLD: float = 0.45
+    LEXICAL_INDEX_ENABLED: bool = True
+    LEXICAL_ONLY_MAX_CHARS: int = 8  # 不超过该长度的关键词查询只走倒排索引
+    RRF_K: int = 60
+    
+    # 检索规划配置
+    QUERY_PLANNER_SHORT_QUERY_CHARS: int = 16
+    QUERY_PLANNER_TERM_COVERAGE: float = 0.95  # 短查询词项被单个文本块覆盖的比例达到该值时只走关键词检索
+    QUERY_PLANNER_EMBEDDING_BUDGET_MS: float = 800.0  # 有关键词结果可退回时，等待向量化的最长时间
+    QUERY_PLANNER_FAILURE_THRESHOLD: int = 3
+    QUERY_PLANNER_COOLDOWN_SECONDS: float = 30.0
+    
+    # 问答缓存配置
+    ANSWER_CACHE_MAX_ENTRIES: int = 2000
+    ANSWER_CACHE_TTL_SECONDS: int = 86400
+    SEMANTIC_CACHE_ENABLED: bool = True
+    SEMANTIC_CACHE_THRESHOLD: float = 0.92
+    SEMANTIC_CACHE_MAX_ENTRIES: int = 500
     
     # 原子物理学科特定配置
     SUBJECT_NAME: str = "原子物理学"
@@ -91,7 +124,44 @@ class Settings(BaseSettings):
     MAX_CONCURRENT_REQUESTS: int = 10
     REQUEST_TIMEOUT: int = 30
     EMBEDDING_BATCH_SIZE: int = 32
+    EMBEDDING_BATCH_MAX_CHARS: int = 6000
+    EMBEDDING_MAX_CONCURRENCY: int = 4
+    EMBEDDING_MAX_RETRIES: int = 4
+    METRICS_ENABLED: bool = True  # /metrics 仅管理员可访问，关闭后返回 404
+    
+    # 向量缓存配置
+    EMBEDDING_CACHE_ENABLED: bool = True
+    EMBEDDING_CACHE_PATH: str = "./storage/embedding_cache.sqlite3"
+    EMBEDDING_CACHE_MAX_ENTRIES: int = 200000
+    
+    # 查询向量微批配置
+    EMBEDDING_MICROBATCH_WAIT_MS: float = 5.0
+    EMBEDDING_MICROBATCH_MAX_SIZE: int = 32
     VECTOR_SEARCH_TIMEOUT: int = 5
+    VECTORDB_MAX_CONCURRENT_READS: int = 8
+    VECTORDB_MAX_CONCURRENT_WRITES: int = 2
+    
+    # 入库流水线配置
+    INGEST_PIPELINE_BATCH_SIZE: int = 64  # 每批向量化/写库的文本块数
+    INGEST_PIPELINE_QUEUE_SIZE: int = 256  # 解析分块与向量化之间的队列容量（文本块数）
+    INGEST_PIPELINE_EMBED_INFLIGHT: int = 4  # 同时在途的向量化批次数
+    
+    # 文档解析进程池配置
+    PARSE_POOL_WORKERS: int = 2  # 解析进程数，0 表示在入库线程中解析
+    PARSE_PAGES_PER_TASK: int = 16  # PDF/PPT 按页拆分时每个子任务的页数
+    PARSE_CPU_LIMIT_SECONDS: int = 300  # 单个文档解析的CPU时间上限
+    PARSE_TASK_TIMEOUT_SECONDS: int = 600  # 单个解析子任务的墙钟时间上限，超时终止解析进程（CPU上限不可用的平台，如 Windows）
+    
+    # 入库任务队列配置
+    INGEST_QUEUE_WORKERS: int = 2  # 同时处理的入库任务数
+    INGEST_QUEUE_POLL_SECONDS: float = 5.0  # 无通知时轮询队列的间隔
+    INGEST_QUEUE_LEASE_SECONDS: int = 120  # 任务租约时长，处理期间定期续约
+    INGEST_QUEUE_MAX_ATTEMPTS: int = 3  # 租约过期重新排队的最大尝试次数
+    
+    # LLM HTTP 连接池配置
+    LLM_MAX_CONNECTIONS: int = 100
+    LLM_MAX_KEEPALIVE_CONNECTIONS: int = 20
+    LLM_KEEPALIVE_EXPIRY: float = 30.0
     
     # 日志配置
     LOG_LEVEL: str = "INFO"
@@ -105,7 +175,20 @@ class Settings(BaseSettings):
     
     def get_max_file_size_bytes(self) -> int:
         """转换文件大小字符串为字节数"""
-        size_str = self.MAX_FILE_SIZE.upper()
+        return self.parse_size(self.MAX_FILE_SIZE)
+    
+    def get_resumable_upload_max_bytes(self) -> int:
+        """断点续传上传的文件大小上限（字节）"""
+        return self.parse_size(self.RESUMABLE_UPLOAD_MAX_SIZE)
+    
+    def get_upload_part_max_bytes(self) -> int:
+        """断点续传单个分片的大小上限（字节）"""
+        return self.parse_size(self.UPLOAD_PART_MAX_SIZE)
+    
+    @staticmethod
+    def parse_size(size_str: str) -> int:
+        """解析 50MB / 512KB / 1GB 形式的大小字符串"""
+        size_str = size_str.upper()
         if size_str.endswith('MB'):
             return int(size_str[:-2]) * 1024 * 1024
         elif size_str.endswith('KB'):
@@ -122,6 +205,8 @@ class Settings(BaseSettings):
         os.makedirs(f"{self.STORAGE_DIR}/raw", exist_ok=True)
         os.makedirs(f"{self.STORAGE_DIR}/parsed", exist_ok=True)
         os.makedirs(self.CHROMA_PERSIST_DIR, exist_ok=True)
+        if self.VECTORDB_TYPE.lower() == "numpy":
+            os.makedirs(self.NUMPY_VECTORDB_DIR, exist_ok=True)
         os.makedirs("./logs", exist_ok=True)
         os.makedirs("./data", exist_ok=True)
 
@@ -90,6 +90,12 @@ class FileTooLargeException(BaseAPIException):
         super().__init__(400, "FILE_TOO_LARGE", message)
 
 
+class UploadSessionNotFoundException(BaseAPIException):
+    def __init__(self, upload_id: str):
+        message = f"上传会话不存在: {upload_id}"
+        super().__init__(404, "UPLOAD_NOT_FOUND", message)
+
+
 # 任务相关异常
 class TaskNotFoundException(BaseAPIException):
     def __init__(self, task_id: str):
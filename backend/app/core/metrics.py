@@ -0,0 +1,125 @@
+import threading
+from bisect import bisect_left
+from typing import Dict, Any, Callable, Optional, Sequence
+
+
+class Counter:
+    """计数器"""
+
+    def __init__(self, name: str, description: str = ""):
+        self.name = name
+        self.description = description
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        """增加计数"""
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self) -> float:
+        return self._value
+
+    def snapshot(self) -> float:
+        return self._value
+
+
+class Histogram:
+    """直方图（累计分桶）"""
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name: str, description: str = "", buckets: Optional[Sequence[float]] = None):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets or self.DEFAULT_BUCKETS))
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._count = 0
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        """记录一个观测值"""
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._count += 1
+            self._sum += value
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            counts = list(self._counts)
+            count = self._count
+            total = self._sum
+
+        cumulative = 0
+        buckets = {}
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            buckets[f"le_{bound:g}"] = cumulative
+        buckets["le_inf"] = count
+
+        return {
+            "count": count,
+            "sum": round(total, 6),
+            "avg": round(total / count, 6) if count else 0.0,
+            "buckets": buckets
+        }
+
+
+class Gauge:
+    """瞬时值（回调求值）"""
+
+    def __init__(self, name: str, fn: Callable[[], Any], description: str = ""):
+        self.name = name
+        self.description = description
+        self.fn = fn
+
+    def snapshot(self) -> Any:
+        try:
+            return self.fn()
+        except Exception as e:
+            return f"error: {e}"
+
+
+class MetricsRegistry:
+    """进程内指标注册表"""
+
+    def __init__(self):
+        self._metrics: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, description: str = "") -> Counter:
+        """获取或创建计数器"""
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = Counter(name, description)
+            return self._metrics[name]
+
+    def histogram(self, name: str, description: str = "", buckets: Optional[Sequence[float]] = None) -> Histogram:
+        """获取或创建直方图"""
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = Histogram(name, description, buckets)
+            return self._metrics[name]
+
+    def gauge(self, name: str, fn: Callable[[], Any], description: str = "") -> Gauge:
+        """注册回调型瞬时值（同名覆盖）"""
+        with self._lock:
+            self._metrics[name] = Gauge(name, fn, description)
+            return self._metrics[name]
+
+    def snapshot(self) -> Dict[str, Any]:
+        """导出所有指标"""
+        with self._lock:
+            items = list(self._metrics.items())
+        return {name: metric.snapshot() for name, metric in sorted(items)}
+
+
+# 全局指标注册表
+metrics = MetricsRegistry()
@@ -0,0 +1,123 @@
+import asyncio
+import logging
+from typing import Any, AsyncGenerator, AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Optional
+
+from app.core.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """合并相同键的并发调用：同一时刻只执行一次，结果共享给所有等待者"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self._executions = metrics.counter(f"{name}_executions_total", "实际执行次数")
+        self._coalesced = metrics.counter(f"{name}_coalesced_total", "被合并的并发请求数")
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """执行或加入同键的进行中调用"""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t, k=key: self._forget(k, t))
+            self._executions.inc()
+        else:
+            self._coalesced.inc()
+
+        # 单个等待者被取消时不影响共享任务
+        return await asyncio.shield(task)
+
+    def _forget(self, key: Hashable, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # 所有等待者都已取消时，避免未读取的异常告警
+        if not task.cancelled() and task.exception() is not None:
+            logger.debug(f"{self.name} 共享调用失败: {task.exception()}")
+
+
+class _Broadcast:
+    """一次上游流的广播状态"""
+
+    def __init__(self):
+        self.events: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.condition = asyncio.Condition()
+        self.task: Optional[asyncio.Task] = None
+
+
+class StreamSingleFlight:
+    """合并相同键的并发流：上游只生成一次，事件扇出给所有订阅者（后加入者先回放已有事件）"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._inflight: Dict[Hashable, _Broadcast] = {}
+        self._executions = metrics.counter(f"{name}_executions_total", "实际执行次数")
+        self._coalesced = metrics.counter(f"{name}_coalesced_total", "被合并的并发订阅数")
+
+    async def subscribe(
+        self,
+        key: Hashable,
+        factory: Callable[[], AsyncIterator[Any]]
+    ) -> AsyncGenerator[Any, None]:
+        """订阅同键的上游流，不存在时启动一个"""
+        broadcast = self._inflight.get(key)
+        if broadcast is None:
+            broadcast = _Broadcast()
+            self._inflight[key] = broadcast
+            broadcast.task = asyncio.create_task(self._pump(key, broadcast, factory))
+            self._executions.inc()
+        else:
+            self._coalesced.inc()
+
+        broadcast.subscribers += 1
+        position = 0
+        try:
+            while True:
+                async with broadcast.condition:
+                    await broadcast.condition.wait_for(
+                        lambda: position < len(broadcast.events) or broadcast.done
+                    )
+                    pending = broadcast.events[position:]
+                    finished = broadcast.done
+
+                for event in pending:
+                    yield event
+                position += len(pending)
+
+                if finished and position >= len(broadcast.events):
+                    if broadcast.error is not None:
+                        raise broadcast.error
+                    return
+        finally:
+            broadcast.subscribers -= 1
+            # 最后一个订阅者离开时终止上游
+            if broadcast.subscribers == 0 and not broadcast.task.done():
+                if self._inflight.get(key) is broadcast:
+                    del self._inflight[key]
+                broadcast.task.cancel()
+
+    async def _pump(self, key: Hashable, broadcast: _Broadcast, factory: Callable[[], AsyncIterator[Any]]):
+        """消费上游流并广播事件"""
+        stream = factory()
+        try:
+            async for event in stream:
+                async with broadcast.condition:
+                    broadcast.events.append(event)
+                    broadcast.condition.notify_all()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            broadcast.error = e
+        finally:
+            if hasattr(stream, "aclose"):
+                await stream.aclose()
+            if self._inflight.get(key) is broadcast:
+                del self._inflight[key]
+            async with broadcast.condition:
+                broadcast.done = True
+                broadcast.condition.notify_all()
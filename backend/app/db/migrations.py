@@ -0,0 +1,40 @@
+import logging
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Engine
+
+from app.models.orm import Base
+
+logger = logging.getLogger(__name__)
+
+
+def _column_ddl(column, dialect) -> str:
+    """生成 ADD COLUMN 的列定义；SQLite 不允许新增无默认值的 NOT NULL 列，此时放宽为可空"""
+    ddl = f"{column.name} {column.type.compile(dialect=dialect)}"
+    default = column.default.arg if column.default is not None and column.default.is_scalar else None
+    if default is not None:
+        value = int(default) if isinstance(default, bool) else default
+        ddl += f" DEFAULT {value!r}" if isinstance(value, str) else f" DEFAULT {value}"
+        if not column.nullable:
+            ddl += " NOT NULL"
+    return ddl
+
+
+def upgrade_schema(engine: Engine):
+    """为已存在的表补齐模型中新增的列和索引（create_all 只会创建缺失的表）"""
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+        missing = [column for column in table.columns if column.name not in existing_columns]
+        if missing:
+            with engine.begin() as conn:
+                for column in missing:
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {_column_ddl(column, engine.dialect)}"))
+            logger.info(f"数据表 {table.name} 新增列: {', '.join(column.name for column in missing)}")
+
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
@@ -1,12 +1,24 @@
 import re
+import bisect
+import hashlib
 import logging
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterable, Iterator, Sequence
 from dataclasses import dataclass
 
 from app.core.config import settings
+from app.kb.tokenizer import token_counter, embedding_token_limit
 
 logger = logging.getLogger(__name__)
 
+# 句子结束符：中文句末标点、空行；英文句末标点需后接空白或位于末尾（不把小数点当作句末）
+_SENTENCE_ENDINGS = ('。', '！', '？', '\n\n')
+_LATIN_SENTENCE_ENDINGS = ('.', '!', '?')
+# 在预期切分点前后多少个长度单位（字符或 token）内寻找句子边界
+_BOUNDARY_SEARCH_RADIUS = 100
+
+UNIT_CHARS = "chars"
+UNIT_TOKENS = "tokens"
+
 
 @dataclass
 class TextChunk:
@@ -16,20 +28,69 @@ class TextChunk:
     metadata: Dict[str, Any]
     start_offset: int
     end_offset: int
+    
+    @property
+    def content_hash(self) -> str:
+        """文本内容哈希，作为文本块的稳定标识（增量入库时比对）"""
+        return content_hash(self.text)
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
 
 
 class TextChunker:
-    """文本分块器"""
+    """文本分块器（块长度按字符或向量模型的 token 计）"""
+    
+    def __init__(self, chunk_size: int = None, overlap: int = None, unit: str = None):
+        self.unit = unit or settings.CHUNK_LENGTH_UNIT
+        if self.unit == UNIT_TOKENS:
+            # 块大小不超过向量模型的输入上限，向量化时不会截断
+            chunk_size = chunk_size if chunk_size is not None else settings.CHUNK_SIZE_TOKENS
+            self.chunk_size = min(chunk_size, embedding_token_limit())
+            self.overlap = overlap if overlap is not None else settings.CHUNK_OVERLAP_TOKENS
+        elif self.unit == UNIT_CHARS:
+            self.chunk_size = chunk_size if chunk_size is not None else settings.CHUNK_SIZE
+            self.overlap = overlap if overlap is not None else settings.CHUNK_OVERLAP
+        else:
+            raise ValueError(f"不支持的分块长度单位: {self.unit}")
+        if self.chunk_size <= 0 or self.overlap < 0:
+            raise ValueError(f"无效的分块参数: chunk_size={self.chunk_size}, overlap={self.overlap}")
+    
+    @classmethod
+    def from_policy(cls, chunk_policy=None) -> "TextChunker":
+        """按入库任务的分块策略（ChunkPolicy）创建分块器"""
+        if chunk_policy is None:
+            return cls()
+        unit = chunk_policy.unit or settings.CHUNK_LENGTH_UNIT
+        if unit == UNIT_TOKENS:
+            return cls(chunk_policy.max_tokens, chunk_policy.overlap_tokens, UNIT_TOKENS)
+        return cls(chunk_policy.max_chars, chunk_policy.overlap, UNIT_CHARS)
     
-    def __init__(self, chunk_size: int = None, overlap: int = None):
-        self.chunk_size = chunk_size or settings.CHUNK_SIZE
-        self.overlap = overlap or settings.CHUNK_OVERLAP
+    def _length(self, text: str) -> int:
+        """按当前单位计算长度（token 切分结果有缓存）"""
+        if self.unit == UNIT_TOKENS:
+            return token_counter.count(text)
+        return len(text)
+    
+    def _unit_ends(self, text: str) -> Sequence[int]:
+        """每个长度单位结束处的字符偏移：text[:ends[k - 1]] 的长度为 k"""
+        if self.unit == UNIT_TOKENS:
+            return token_counter.token_ends(text)
+        return range(1, len(text) + 1)
     
     def chunk_document(self, parsed_doc: Dict[str, Any]) -> List[TextChunk]:
         """对解析后的文档进行分块"""
         content = parsed_doc.get("content", [])
         doc_type = parsed_doc.get("metadata", {}).get("type", "unknown")
         
+        if doc_type in ["pdf", "docx", "txt", "pptx", "markdown"]:
+            return list(self.iter_chunks(content, doc_type))
+        # 默认按原始文本分块
+        return list(self._chunk_raw_text(parsed_doc.get("raw_text", "")))
+    
+    def iter_chunks(self, content: Iterable[Dict], doc_type: str) -> Iterator[TextChunk]:
+        """对逐项产出的文档内容流式分块（块序号与 chunk_document 一致）"""
         if doc_type == "pdf":
             return self._chunk_pdf_content(content)
         elif doc_type in ["docx", "txt"]:
@@ -39,13 +100,10 @@ class TextChunker:
         elif doc_type == "markdown":
             return self._chunk_markdown_content(content)
         else:
-            # 默认按原始文本分块
-            raw_text = parsed_doc.get("raw_text", "")
-            return self._chunk_raw_text(raw_text)
+            return self._chunk_raw_text("\n\n".join(item["text"] for item in content))
     
-    def _chunk_pdf_content(self, content: List[Dict]) -> List[TextChunk]:
+    def _chunk_pdf_content(self, content: Iterable[Dict]) -> Iterator[TextChunk]:
         """PDF内容分块"""
-        chunks = []
         chunk_index = 0
         
         for page_info in content:
@@ -54,8 +112,8 @@ class TextChunker:
             section = page_info["section"]
             
             # 如果页面文本较短，直接作为一个块
-            if len(page_text) <= self.chunk_size:
-                chunks.append(TextChunk(
+            if self._length(page_text) <= self.chunk_size:
+                yield TextChunk(
                     index=chunk_index,
                     text=page_text,
                     metadata={
@@ -65,13 +123,13 @@ class TextChunker:
                     },
                     start_offset=0,
                     end_offset=len(page_text)
-                ))
+                )
                 chunk_index += 1
             else:
                 # 页面文本较长，需要进一步分块
                 page_chunks = self._split_text_with_overlap(page_text)
                 for i, chunk_text in enumerate(page_chunks):
-                    chunks.append(TextChunk(
+                    yield TextChunk(
                         index=chunk_index,
                         text=chunk_text,
                         metadata={
@@ -82,17 +140,17 @@ class TextChunker:
                         },
                         start_offset=0,  # 简化处理
                         end_offset=len(chunk_text)
-                    ))
+                    )
                     chunk_index += 1
-        
-        return chunks
     
-    def _chunk_paragraph_content(self, content: List[Dict]) -> List[TextChunk]:
+    def _chunk_paragraph_content(self, content: Iterable[Dict]) -> Iterator[TextChunk]:
         """段落内容分块"""
-        chunks = []
         chunk_index = 0
         current_chunk = ""
+        current_length = 0
         current_section = ""
+        # 段落之间的换行符长度（token 计长时空白不计）
+        separator_length = self._length("\n")
         current_metadata = {}
         
         for para_info in content:
@@ -101,15 +159,16 @@ class TextChunker:
             
             # 如果是新的章节，且当前块不为空，先保存当前块
             if section != current_section and current_chunk:
-                chunks.append(TextChunk(
+                yield TextChunk(
                     index=chunk_index,
                     text=current_chunk.strip(),
                     metadata=current_metadata,
                     start_offset=0,
                     end_offset=len(current_chunk)
-                ))
+                )
                 chunk_index += 1
                 current_chunk = ""
+                current_length = 0
             
             current_section = section
             current_metadata = {
@@ -118,24 +177,25 @@ class TextChunker:
                 "chunk_type": "paragraph"
             }
             
-            # 检查添加当前段落后是否超过块大小
-            if len(current_chunk + "\n" + para_text) > self.chunk_size:
+            # 检查添加当前段落后是否超过块大小（长度累加，不重复计算已有内容）
+            para_length = self._length(para_text)
+            if current_length + separator_length + para_length > self.chunk_size:
                 # 如果当前块不为空，先保存
                 if current_chunk:
-                    chunks.append(TextChunk(
+                    yield TextChunk(
                         index=chunk_index,
                         text=current_chunk.strip(),
                         metadata=current_metadata,
                         start_offset=0,
                         end_offset=len(current_chunk)
-                    ))
+                    )
                     chunk_index += 1
                 
                 # 如果单个段落就很长，需要分割
-                if len(para_text) > self.chunk_size:
+                if para_length > self.chunk_size:
                     para_chunks = self._split_text_with_overlap(para_text)
                     for i, chunk_text in enumerate(para_chunks):
-                        chunks.append(TextChunk(
+                        yield TextChunk(
                             index=chunk_index,
                             text=chunk_text,
                             metadata={
@@ -144,33 +204,35 @@ class TextChunker:
                             },
                             start_offset=0,
                             end_offset=len(chunk_text)
-                        ))
+                        )
                         chunk_index += 1
                     current_chunk = ""
+                    current_length = 0
                 else:
                     current_chunk = para_text
+                    current_length = para_length
             else:
                 # 添加到当前块
                 if current_chunk:
                     current_chunk += "\n" + para_text
+                    current_length += separator_length + para_length
                 else:
                     current_chunk = para_text
+                    current_length = para_length
         
         # 保存最后的块
         if current_chunk:
-            chunks.append(TextChunk(
+            yield TextChunk(
                 index=chunk_index,
                 text=current_chunk.strip(),
                 metadata=current_metadata,
                 start_offset=0,
                 end_offset=len(current_chunk)
-            ))
-        
-        return chunks
+            )
     
-    def _chunk_slide_content(self, content: List[Dict]) -> List[TextChunk]:
+    def _chunk_slide_content(self, content: Iterable[Dict]) -> Iterator[TextChunk]:
         """幻灯片内容分块"""
-        chunks = []
+        emitted = 0
         
         for i, slide_info in enumerate(content):
             slide_text = slide_info["text"]
@@ -178,8 +240,8 @@ class TextChunker:
             section = slide_info["section"]
             
             # 每张幻灯片作为一个块（除非文本过长）
-            if len(slide_text) <= self.chunk_size:
-                chunks.append(TextChunk(
+            if self._length(slide_text) <= self.chunk_size:
+                yield TextChunk(
                     index=i,
                     text=slide_text,
                     metadata={
@@ -189,13 +251,14 @@ class TextChunker:
                     },
                     start_offset=0,
                     end_offset=len(slide_text)
-                ))
+                )
+                emitted += 1
             else:
                 # 幻灯片文本过长，分割
                 slide_chunks = self._split_text_with_overlap(slide_text)
                 for j, chunk_text in enumerate(slide_chunks):
-                    chunks.append(TextChunk(
-                        index=len(chunks),
+                    yield TextChunk(
+                        index=emitted,
                         text=chunk_text,
                         metadata={
                             "section": section,
@@ -205,21 +268,19 @@ class TextChunker:
                         },
                         start_offset=0,
                         end_offset=len(chunk_text)
-                    ))
-        
-        return chunks
+                    )
+                    emitted += 1
     
-    def _chunk_markdown_content(self, content: List[Dict]) -> List[TextChunk]:
+    def _chunk_markdown_content(self, content: Iterable[Dict]) -> Iterator[TextChunk]:
         """Markdown内容分块"""
-        chunks = []
         chunk_index = 0
         
         for section_info in content:
             section_text = section_info["text"]
             section_name = section_info["section"]
             
-            if len(section_text) <= self.chunk_size:
-                chunks.append(TextChunk(
+            if self._length(section_text) <= self.chunk_size:
+                yield TextChunk(
                     index=chunk_index,
                     text=section_text,
                     metadata={
@@ -228,13 +289,13 @@ class TextChunker:
                     },
                     start_offset=0,
                     end_offset=len(section_text)
-                ))
+                )
                 chunk_index += 1
             else:
                 # 章节文本过长，分割
                 section_chunks = self._split_text_with_overlap(section_text)
                 for i, chunk_text in enumerate(section_chunks):
-                    chunks.append(TextChunk(
+                    yield TextChunk(
                         index=chunk_index,
                         text=chunk_text,
                         metadata={
@@ -244,18 +305,15 @@ class TextChunker:
                         },
                         start_offset=0,
                         end_offset=len(chunk_text)
-                    ))
+                    )
                     chunk_index += 1
-        
-        return chunks
     
-    def _chunk_raw_text(self, text: str) -> List[TextChunk]:
+    def _chunk_raw_text(self, text: str) -> Iterator[TextChunk]:
         """原始文本分块"""
-        chunks = []
         text_chunks = self._split_text_with_overlap(text)
         
         for i, chunk_text in enumerate(text_chunks):
-            chunks.append(TextChunk(
+            yield TextChunk(
                 index=i,
                 text=chunk_text,
                 metadata={
@@ -264,53 +322,90 @@ class TextChunker:
                 },
                 start_offset=0,
                 end_offset=len(chunk_text)
-            ))
-        
-        return chunks
+            )
     
     def _split_text_with_overlap(self, text: str) -> List[str]:
-        """带重叠的文本分割"""
-        if len(text) <= self.chunk_size:
+        """带重叠的文本分割，在预先计算的句子边界中二分查找切分点，整体耗时与文本长度成线性"""
+        ends = self._unit_ends(text)
+        if len(ends) <= self.chunk_size:
             return [text]
         
+        boundaries = self._sentence_boundaries(text)
+        # 重叠过大时每个窗口几乎不前进，限制最大重叠并要求每次至少前进半个步长
+        overlap = min(self.overlap, self.chunk_size * 3 // 4)
+        min_advance = max(1, (self.chunk_size - overlap) // 2)
+        # 按 token 计长时块大小是硬上限，只在预期切分点之前寻找句子边界
+        search_after = _BOUNDARY_SEARCH_RADIUS if self.unit == UNIT_CHARS else 0
+        
         chunks = []
         start = 0
         
-        while start < len(text):
+        while start < len(ends):
+            start_pos = ends[start - 1] if start else 0
             end = start + self.chunk_size
             
             # 如果不是最后一块，尝试在句子边界分割
-            if end < len(text):
-                # 寻找句号、问号、感叹号等句子结束符
-                sentence_end = self._find_sentence_boundary(text, start, end)
-                if sentence_end > start:
-                    end = sentence_end
+            if end < len(ends):
+                end_pos = self._nearest_boundary(
+                    boundaries,
+                    ends[end - 1],
+                    lower=ends[max(start + overlap + min_advance, end - _BOUNDARY_SEARCH_RADIUS) - 1],
+                    upper=ends[min(len(ends), end + search_after) - 1]
+                )
+                end = bisect.bisect_right(ends, end_pos)
+            else:
+                end = len(ends)
+                end_pos = len(text)
             
-            chunk = text[start:end].strip()
+            chunk = text[start_pos:end_pos].strip()
+            # 单独切分截出的片段时 token 数可能略多于在全文中的计数（如从词中间截断）
+            while self.unit == UNIT_TOKENS and end - start > 1 and self._length(chunk) > self.chunk_size:
+                end -= max(1, self._length(chunk) - self.chunk_size)
+                end = max(end, start + 1)
+                end_pos = ends[end - 1]
+                chunk = text[start_pos:end_pos].strip()
             if chunk:
                 chunks.append(chunk)
             
             # 计算下一个块的起始位置（考虑重叠）
-            if end >= len(text):
+            if end >= len(ends):
                 break
             
-            start = max(start + 1, end - self.overlap)
+            start = max(start + min_advance, end - overlap)
         
         return chunks
     
-    def _find_sentence_boundary(self, text: str, start: int, preferred_end: int) -> int:
-        """寻找句子边界"""
-        # 在preferred_end附近寻找句子结束符
-        search_start = max(start, preferred_end - 100)
-        search_end = min(len(text), preferred_end + 100)
-        
-        # 句子结束符的优先级
-        sentence_endings = ['。', '！', '？', '.', '!', '?', '\n\n']
-        
+    @staticmethod
+    def _sentence_boundaries(text: str) -> List[int]:
+        """一次扫描得到所有句子结束位置（结束符之后的偏移，升序）
+
+        逐个结束符用 str.find 扫描后排序，比等价的正则 finditer 快约 4 倍。
+        """
+        boundaries = []
+        for ending in _SENTENCE_ENDINGS:
+            pos = text.find(ending)
+            while pos != -1:
+                pos += len(ending)
+                boundaries.append(pos)
+                pos = text.find(ending, pos)
+        for ending in _LATIN_SENTENCE_ENDINGS:
+            pos = text.find(ending)
+            while pos != -1:
+                pos += 1
+                if pos == len(text) or text[pos].isspace():
+                    boundaries.append(pos)
+                pos = text.find(ending, pos)
+        boundaries.sort()
+        return boundaries
+    
+    @staticmethod
+    def _nearest_boundary(boundaries: List[int], preferred_end: int, lower: int, upper: int) -> int:
+        """在 [lower, upper] 内取离 preferred_end 最近的句子边界（距离相同取靠前的），没有则返回 preferred_end"""
+        i = bisect.bisect_right(boundaries, preferred_end)
         best_pos = preferred_end
-        for ending in sentence_endings:
-            pos = text.rfind(ending, search_start, search_end)
-            if pos > start and abs(pos - preferred_end) < abs(best_pos - preferred_end):
-                best_pos = pos + len(ending)
-        
-        return best_pos
\ No newline at end of file
+        best_distance = None
+        for pos in boundaries[max(0, i - 1):i + 1]:
+            if lower <= pos <= upper and (best_distance is None or abs(pos - preferred_end) < best_distance):
+                best_pos = pos
+                best_distance = abs(pos - preferred_end)
+        return best_pos
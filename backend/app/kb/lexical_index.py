@@ -0,0 +1,282 @@
+import re
+import math
+import heapq
+import time
+import logging
+import threading
+import unicodedata
+from collections import Counter, defaultdict
+from typing import List, Dict, Any, Optional, Tuple, Iterable
+
+from app.core.config import settings
+from app.core.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+_index_builds = metrics.histogram(
+    "lexical_index_build_seconds", "课程倒排索引全量构建耗时",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+)
+
+# 中文按字切成二元组，拉丁字母/数字按词切分（LS耦合 -> ls, 耦合）
+_TOKEN_PATTERN = re.compile(r"[㐀-鿿]+|[a-z0-9]+(?:\.[0-9]+)?")
+_CJK_PATTERN = re.compile(r"[㐀-鿿]")
+
+# BM25 参数
+_K1 = 1.2
+_B = 0.75
+
+
+def tokenize(text: str) -> List[str]:
+    """切分检索词项：中文字符二元组 + 英文单词/数字"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    tokens = []
+    for run in _TOKEN_PATTERN.findall(text):
+        if _CJK_PATTERN.match(run):
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+
+def _snippet(text: str) -> str:
+    return text[:200] + "..." if len(text) > 200 else text
+
+
+class _CourseIndex:
+    """单个课程的 BM25 倒排索引（读写由各自的锁保护，不同课程互不阻塞）"""
+
+    def __init__(self, generation: int):
+        self.generation = generation
+        self.lock = threading.Lock()
+        self.postings: Dict[str, Dict[int, int]] = defaultdict(dict)
+        self.doc_terms: Dict[int, List[str]] = {}
+        self.doc_lengths: Dict[int, int] = {}
+        self.doc_info: Dict[int, Tuple[Dict[str, Any], str]] = {}
+        self.total_length = 0
+
+    def add(self, chunk_id: int, text: str, meta: Dict[str, Any]):
+        if chunk_id in self.doc_lengths:
+            self.remove(chunk_id)
+        tokens = tokenize(text)
+        counts = Counter(tokens)
+        for term, tf in counts.items():
+            self.postings[term][chunk_id] = tf
+        self.doc_terms[chunk_id] = list(counts)
+        self.doc_lengths[chunk_id] = len(tokens)
+        self.doc_info[chunk_id] = (meta, _snippet(text))
+        self.total_length += len(tokens)
+
+    def remove(self, chunk_id: int):
+        for term in self.doc_terms.pop(chunk_id, []):
+            postings = self.postings.get(term)
+            if postings is not None:
+                postings.pop(chunk_id, None)
+                if not postings:
+                    del self.postings[term]
+        self.total_length -= self.doc_lengths.pop(chunk_id, 0)
+        self.doc_info.pop(chunk_id, None)
+
+    def _matches(self, meta: Dict[str, Any], filters: Optional[Dict[str, Any]]) -> bool:
+        if not filters:
+            return True
+        if "document_id" in filters and str(meta.get("document_id")) != str(filters["document_id"]):
+            return False
+        if "section" in filters and filters["section"] not in (meta.get("section") or ""):
+            return False
+        return True
+
+    def search(self, query: str, top_k: int, filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """BM25 排序；lexical_score 为命中词项 IDF 占查询词项 IDF 总和的比例（0-1）
+
+        只走关键词检索时没有向量相似度，score 同样取该比例；混合检索时由向量相似度替换。
+        """
+        n_docs = len(self.doc_lengths)
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not n_docs or not terms:
+            return []
+
+        avg_length = self.total_length / n_docs
+        scores: Dict[int, float] = defaultdict(float)
+        matched_idf: Dict[int, float] = defaultdict(float)
+        total_idf = 0.0
+        for term in terms:
+            postings = self.postings.get(term, {})
+            idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            total_idf += idf
+            for chunk_id, tf in postings.items():
+                norm = _K1 * (1 - _B + _B * self.doc_lengths[chunk_id] / avg_length)
+                scores[chunk_id] += idf * tf * (_K1 + 1) / (tf + norm)
+                matched_idf[chunk_id] += idf
+
+        candidates = scores.items()
+        if filters:
+            candidates = [item for item in candidates if self._matches(self.doc_info[item[0]][0], filters)]
+        results = []
+        for chunk_id, bm25 in heapq.nlargest(top_k, candidates, key=lambda item: item[1]):
+            meta, snippet = self.doc_info[chunk_id]
+            coverage = matched_idf[chunk_id] / total_idf if total_idf else 0.0
+            results.append({
+                "chunk_id": chunk_id,
+                "score": coverage,
+                "lexical_score": coverage,
+                "bm25": bm25,
+                "document_id": int(meta["document_id"]),
+                "meta": meta,
+                "snippet": snippet
+            })
+        return results
+
+
+class LexicalIndex:
+    """按课程维护的内存倒排索引，以知识库版本号判断是否需要重建
+
+    检索、增量更新都是纯 Python 计算，调用方放到线程中执行；全局锁只保护课程到索引的映射，
+    索引内容由课程自己的锁保护。
+    """
+
+    def __init__(self):
+        self._indexes: Dict[int, _CourseIndex] = {}
+        self._lock = threading.Lock()
+        metrics.gauge("lexical_index", self.stats, "倒排索引状态")
+
+    @staticmethod
+    def _chunk_meta(course_id: int, document_id: int, meta_json: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """与向量库元数据保持相同字段"""
+        meta_json = meta_json or {}
+        return {
+            "course_id": str(course_id),
+            "document_id": str(document_id),
+            "section": meta_json.get("section", ""),
+            "page": meta_json.get("page", 0)
+        }
+
+    def is_current(self, course_id: int, generation: int) -> bool:
+        index = self._indexes.get(course_id)
+        return index is not None and index.generation == generation
+
+    def build(self, db, course_id: int, generation: int):
+        """从 chunks 表全量构建课程索引（同步，调用方放到线程中执行）"""
+        from app.models.orm import Chunk
+
+        started = time.perf_counter()
+        index = _CourseIndex(generation)
+        rows = db.query(Chunk.id, Chunk.document_id, Chunk.chunk_text, Chunk.meta_json).filter(
+            Chunk.course_id == course_id
+        ).yield_per(1000)
+        for chunk_id, document_id, text, meta_json in rows:
+            index.add(chunk_id, text, self._chunk_meta(course_id, document_id, meta_json))
+        _index_builds.observe(time.perf_counter() - started)
+
+        with self._lock:
+            self._indexes[course_id] = index
+        logger.info(f"倒排索引构建完成: 课程 {course_id}, {len(index.doc_lengths)} 个文本块, 版本 {generation}")
+
+    def _discard(self, course_id: int, index: _CourseIndex):
+        """丢弃版本不连续的索引（已被重建替换时保留新索引）"""
+        with self._lock:
+            if self._indexes.get(course_id) is index:
+                del self._indexes[course_id]
+
+    def _get(self, course_id: int) -> Optional[_CourseIndex]:
+        with self._lock:
+            return self._indexes.get(course_id)
+
+    def add_chunks(
+        self,
+        course_id: int,
+        generation: int,
+        chunks: Iterable[Tuple[int, int, str, Optional[Dict[str, Any]]]]
+    ):
+        """入库后增量加入 (chunk_id, document_id, text, meta_json)；索引版本不连续时丢弃等待重建"""
+        index = self._get(course_id)
+        if index is None:
+            return
+        with index.lock:
+            if index.generation != generation - 1:
+                self._discard(course_id, index)
+                return
+            for chunk_id, document_id, text, meta_json in chunks:
+                index.add(chunk_id, text, self._chunk_meta(course_id, document_id, meta_json))
+            index.generation = generation
+
+    def remove_document(self, course_id: int, generation: int, document_id: int):
+        """删除文档后增量移除其文本块"""
+        index = self._get(course_id)
+        if index is None:
+            return
+        with index.lock:
+            if index.generation != generation - 1:
+                self._discard(course_id, index)
+                return
+            for chunk_id, (meta, _) in list(index.doc_info.items()):
+                if meta["document_id"] == str(document_id):
+                    index.remove(chunk_id)
+            index.generation = generation
+
+    def invalidate(self, course_id: int):
+        """丢弃课程索引，下次检索时重建"""
+        with self._lock:
+            self._indexes.pop(course_id, None)
+
+    def search(
+        self,
+        course_id: int,
+        query: str,
+        top_k: int = 12,
+        filters: Optional[Dict[str, Any]] = None
+    ) -> List[Dict[str, Any]]:
+        """关键词检索，返回与 search_knowledge 相同格式的结果"""
+        index = self._get(course_id)
+        if index is None:
+            return []
+        with index.lock:
+            return index.search(query, top_k, filters)
+
+    def search_batch(
+        self,
+        course_id: int,
+        queries: List[str],
+        top_k: int = 12,
+        filters: Optional[Dict[str, Any]] = None
+    ) -> List[List[Dict[str, Any]]]:
+        """多个查询依次检索，结果按查询顺序分组"""
+        return [self.search(course_id, query, top_k, filters) for query in queries]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            str(course_id): {"chunks": len(index.doc_lengths), "terms": len(index.postings), "generation": index.generation}
+            for course_id, index in list(self._indexes.items())
+        }
+
+
+def reciprocal_rank_fusion(result_lists: List[List[Dict[str, Any]]], top_k: int, k: int = None) -> List[Dict[str, Any]]:
+    """按倒数排名融合多路结果，rrf_score 为融合分
+
+    score 只取第一路（向量检索）的相似度，只被其它路命中的结果为 0，不混入关键词覆盖率等不同量纲的分数；
+    其它路的附加字段（如 lexical_score、bm25）合并到同一结果中。
+    """
+    k = k if k is not None else settings.RRF_K
+    fused: Dict[int, Dict[str, Any]] = {}
+    for list_index, results in enumerate(result_lists):
+        for rank, result in enumerate(results):
+            entry = fused.get(result["chunk_id"])
+            if entry is None:
+                entry = dict(result, rrf_score=0.0)
+                if list_index > 0:
+                    entry["score"] = 0.0
+                fused[result["chunk_id"]] = entry
+            else:
+                for key, value in result.items():
+                    entry.setdefault(key, value)
+            entry["rrf_score"] += 1.0 / (k + rank + 1)
+
+    ranked = sorted(fused.values(), key=lambda entry: entry["rrf_score"], reverse=True)
+    return ranked[:top_k]
+
+
+# 全局倒排索引
+lexical_index = LexicalIndex()
@@ -0,0 +1,965 @@
+import os
+import json
+import sys
+import shutil
+import sqlite3
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import List, Dict, Any, Optional, Callable
+
+import numpy as np
+
+from app.core.config import settings
+from app.core.exceptions import VectorDBException
+from app.kb.vectordb import VectorRecord, VectorHit, BlockingCallRunner
+
+logger = logging.getLogger(__name__)
+
+_META_DB = "meta.sqlite3"
+# 旧版本的 JSON 元数据文件，打开时迁移到 SQLite
+_LEGACY_META_FILE = "meta.json"
+_INITIAL_CAPACITY = 1024
+# 墓碑占比超过该值时压缩
+_COMPACT_RATIO = 0.25
+# int8 量化的对称取值范围
+_INT8_MAX = 127.0
+_QUANTIZED_BLOCK_ROWS = 4096
+# 等待其它进程释放元数据库写锁的秒数
+_META_LOCK_TIMEOUT = 30
+# 估算量化检索 recall 时使用的最近真实查询数
+_RECALL_QUERY_SAMPLES = 32
+# 没有文档ID的行在文档列中的编码
+_NO_DOCUMENT = -1
+# 估算行索引内存时抽样的 chunk_id 数
+_ID_SIZE_SAMPLES = 256
+
+
+def quantize_int8(vectors: np.ndarray):
+    """按行对称量化为 int8，返回 (codes, scales)，v ≈ codes * scale"""
+    scales = np.abs(vectors).max(axis=1) / _INT8_MAX
+    scales[scales == 0] = 1.0
+    codes = np.clip(np.rint(vectors / scales[:, None]), -_INT8_MAX, _INT8_MAX).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+@dataclass
+class _Snapshot:
+    """检索用的集合快照：在锁内取得数组引用和可选行掩码，扫描在锁外进行
+
+    写入只追加新行或原位覆盖已有行，压缩和扩容会换成新的数组，因此快照中的引用在扫描期间保持有效。
+    """
+    version: int
+    size: int
+    matrix: np.memmap
+    norms: np.memmap
+    codes: Optional[np.memmap]
+    scales: Optional[np.memmap]
+    ids: List[Optional[str]]
+    mask: np.ndarray
+
+    def _scan(self, queries: np.ndarray, top_k: int, approximate: bool):
+        """分块扫描，每个查询返回距离最小的 top_k 行及其距离（queries 形状为 (m, dim)）"""
+        query_sq_norms = np.einsum("ij,ij->i", queries, queries)
+        block_rows = max(1, settings.NUMPY_VECTORDB_BLOCK_ROWS)
+        if approximate:
+            # 编码块需转成 float32 参与矩阵乘法，限制块大小以免临时数组抵消量化省下的内存
+            block_rows = min(block_rows, _QUANTIZED_BLOCK_ROWS)
+
+        n_queries = queries.shape[0]
+        best_rows = np.empty((n_queries, 0), dtype=np.int64)
+        best_dist = np.empty((n_queries, 0), dtype=np.float32)
+        for start in range(0, self.size, block_rows):
+            end = min(start + block_rows, self.size)
+            block_mask = self.mask[start:end]
+            if not block_mask.any():
+                continue
+            if approximate:
+                dots = (queries @ self.codes[start:end].astype(np.float32).T) * self.scales[start:end]
+            else:
+                dots = queries @ self.matrix[start:end].T
+            # ||q - v||² = ||q||² + ||v||² - 2 q·v
+            dist = self.norms[start:end][None, :] + query_sq_norms[:, None] - 2.0 * dots
+            dist = np.where(block_mask[None, :], dist, np.inf)
+
+            k = min(top_k, end - start)
+            part = np.argpartition(dist, k - 1, axis=1)[:, :k]
+            best_rows = np.concatenate([best_rows, part + start], axis=1)
+            best_dist = np.concatenate([best_dist, np.take_along_axis(dist, part, axis=1)], axis=1)
+            if best_rows.shape[1] > top_k:
+                keep = np.argpartition(best_dist, top_k - 1, axis=1)[:, :top_k]
+                best_rows = np.take_along_axis(best_rows, keep, axis=1)
+                best_dist = np.take_along_axis(best_dist, keep, axis=1)
+
+        results = []
+        for rows, dist in zip(best_rows, best_dist):
+            finite = np.isfinite(dist)
+            results.append((rows[finite], dist[finite]))
+        return results
+
+    def _rerank(self, query: np.ndarray, rows: np.ndarray):
+        """只读取候选行的 float32 向量计算精确距离"""
+        rows = np.sort(rows)
+        dist = self.norms[rows] + float(query @ query) - 2.0 * (self.matrix[rows] @ query)
+        return rows, dist
+
+    def search_rows(self, queries: np.ndarray, top_k: int, exact: bool = False):
+        """量化模式两阶段检索（编码粗排 + 精排），否则直接精确检索"""
+        if self.codes is not None and not exact:
+            candidates = top_k * max(1, settings.NUMPY_VECTORDB_RERANK_FACTOR)
+            scanned = [
+                self._rerank(query, rows)
+                for query, (rows, _) in zip(queries, self._scan(queries, candidates, approximate=True))
+            ]
+        else:
+            scanned = self._scan(queries, top_k, approximate=False)
+
+        results = []
+        for rows, dist in scanned:
+            order = np.argsort(dist, kind="stable")[:top_k]
+            results.append((rows[order], dist[order]))
+        return results
+
+
+class _NumpyCollection:
+    """单个课程的向量集合：float32 内存映射矩阵 + SQLite 元数据库
+
+    vectors-{n}.f32 按行存放向量，容量不足时翻倍扩展；meta.sqlite3 的 rows 表记录行号对应的
+    chunk_id、元数据和文本，info 表记录维度、容量、文件编号和版本号。每次写入只写本批改动的行，
+    并把这些行和 info 的版本号加一；删除只打墓碑，墓碑过多时整体重写。写入在 SQLite 写事务
+    （BEGIN IMMEDIATE）中进行，该事务同时充当跨进程写锁；其它进程发现版本号变化后只读取版本号
+    更大的行，文件编号变化（压缩）时才整体重新加载。
+
+    进程内只保留行号对应的 chunk_id 和文档编号列（用于过滤），文本和元数据只为最终返回的
+    top_k 结果从元数据库读取。检索在锁内取快照，扫描在锁外进行，同一课程的多个查询可以并行。
+
+    quantization="int8" 时另存每行的 int8 编码和缩放系数，检索先在编码上粗排，
+    再只读取候选行的 float32 向量精排，常驻内存约为原来的四分之一。
+    """
+
+    def __init__(self, path: str, quantization: str = "none"):
+        self.path = path
+        self.quantization = quantization
+        self.dim = 0
+        self.capacity = 0
+        self.size = 0
+        self.file_no = 0
+        self.version: Optional[int] = None
+        self.ids: List[Optional[str]] = []
+        self.row_of: Dict[str, int] = {}
+        # 每行的文档编号（_document_codes 中的下标），按文档过滤和删除时使用
+        self.doc_codes = np.zeros(0, dtype=np.int32)
+        self._document_codes: Dict[str, int] = {}
+        self.matrix: Optional[np.memmap] = None
+        self.norms: Optional[np.memmap] = None
+        self.codes: Optional[np.memmap] = None
+        self.scales: Optional[np.memmap] = None
+        self.alive = np.zeros(0, dtype=bool)
+        self._conn: Optional[sqlite3.Connection] = None
+        # 锁外读取文本和元数据使用的连接（每个线程一个）
+        self._readers = threading.local()
+        self._reader_conns: List[sqlite3.Connection] = []
+        self._stale_paths: List[str] = []
+        self._recent_queries = deque(maxlen=_RECALL_QUERY_SAMPLES)
+        # (版本号, 查询数, k) -> recall，集合或查询样本变化后重新估算
+        self._recall_cache = None
+        self._lock = threading.RLock()
+
+    @property
+    def meta_path(self) -> str:
+        return os.path.join(self.path, _META_DB)
+
+    @property
+    def legacy_meta_path(self) -> str:
+        return os.path.join(self.path, _LEGACY_META_FILE)
+
+    def _vectors_path(self, file_no: int) -> str:
+        return os.path.join(self.path, f"vectors-{file_no}.f32")
+
+    def _norms_path(self, file_no: int) -> str:
+        return os.path.join(self.path, f"norms-{file_no}.f32")
+
+    def _codes_path(self, file_no: int) -> str:
+        return os.path.join(self.path, f"codes-{file_no}.i8")
+
+    def _scales_path(self, file_no: int) -> str:
+        return os.path.join(self.path, f"scales-{file_no}.f32")
+
+    def _data_paths(self, file_no: int) -> List[str]:
+        return [
+            self._vectors_path(file_no), self._norms_path(file_no),
+            self._codes_path(file_no), self._scales_path(file_no)
+        ]
+
+    @property
+    def quantized(self) -> bool:
+        return self.quantization == "int8"
+
+    @property
+    def live_count(self) -> int:
+        return len(self.row_of)
+
+    def exists(self) -> bool:
+        return os.path.exists(self.meta_path) or os.path.exists(self.legacy_meta_path)
+
+    def _check_exists(self):
+        if not self.exists():
+            raise VectorDBException(f"向量集合不存在: {os.path.basename(self.path)}")
+
+    def create(self):
+        """创建空集合"""
+        os.makedirs(self.path, exist_ok=True)
+        with self._lock:
+            self._connect()
+
+    def _connect(self) -> sqlite3.Connection:
+        """延迟打开元数据库，首次打开时建表（存在旧版 meta.json 时迁移）"""
+        if self._conn is None:
+            # isolation_level=None：事务由 _read_txn / _write_txn 显式开启
+            conn = sqlite3.connect(
+                self.meta_path, timeout=_META_LOCK_TIMEOUT, isolation_level=None, check_same_thread=False
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS rows (
+                    row INTEGER PRIMARY KEY,
+                    chunk_id TEXT,
+                    metadata TEXT NOT NULL,
+                    document TEXT NOT NULL,
+                    version INTEGER NOT NULL,
+                    document_id TEXT,
+                    section TEXT
+                )
+                """
+            )
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                columns = {column[1] for column in conn.execute("PRAGMA table_info(rows)")}
+                if "document_id" not in columns:
+                    # 早期的元数据库没有过滤列，从元数据 JSON 中补齐
+                    conn.execute("ALTER TABLE rows ADD COLUMN document_id TEXT")
+                    conn.execute("ALTER TABLE rows ADD COLUMN section TEXT")
+                    conn.execute(
+                        "UPDATE rows SET document_id = CAST(json_extract(metadata, '$.document_id') AS TEXT), "
+                        "section = json_extract(metadata, '$.section') WHERE chunk_id IS NOT NULL"
+                    )
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_rows_version ON rows(version)")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_rows_chunk_id ON rows(chunk_id)")
+                if conn.execute("SELECT 1 FROM info WHERE key = 'version'").fetchone() is None:
+                    self._initialize(conn)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                conn.close()
+                raise
+            self._conn = conn
+        return self._conn
+
+    def _reader(self) -> sqlite3.Connection:
+        """当前线程的只读连接（WAL 模式下与写事务互不阻塞）"""
+        conn = getattr(self._readers, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.meta_path, timeout=_META_LOCK_TIMEOUT, check_same_thread=False)
+            conn.execute("PRAGMA query_only=ON")
+            self._readers.conn = conn
+            with self._lock:
+                self._reader_conns.append(conn)
+        return conn
+
+    @staticmethod
+    def _row_record(row: int, chunk_id: Optional[str], metadata: Dict[str, Any], document: str, version: int):
+        """rows 表的一行；墓碑行只保留行号"""
+        if chunk_id is None:
+            return (row, None, "{}", "", version, None, None)
+        document_id = metadata.get("document_id")
+        return (
+            row, chunk_id, json.dumps(metadata, ensure_ascii=False), document, version,
+            None if document_id is None else str(document_id), metadata.get("section")
+        )
+
+    def _write_rows(self, conn: sqlite3.Connection, records):
+        conn.executemany(
+            "INSERT OR REPLACE INTO rows (row, chunk_id, metadata, document, version, document_id, section) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            records
+        )
+
+    def _initialize(self, conn: sqlite3.Connection):
+        """写入空集合的头部；存在旧版 meta.json 时导入其中的行"""
+        if not os.path.exists(self.legacy_meta_path):
+            self._write_header(conn, 0)
+            return
+
+        with open(self.legacy_meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.dim = meta["dim"]
+        self.capacity = meta["capacity"]
+        self.size = meta["size"]
+        self.file_no = meta["file_no"]
+        self._write_rows(conn, [
+            self._row_record(row, chunk_id, metadata, document, 0)
+            for row, (chunk_id, metadata, document) in enumerate(
+                zip(meta["ids"], meta["metadatas"], meta["documents"])
+            )
+        ])
+        self._write_header(conn, 0, quantization=meta.get("quantization", "none"))
+        os.replace(self.legacy_meta_path, f"{self.legacy_meta_path}.migrated")
+        logger.info(f"向量集合元数据已迁移到 SQLite: {os.path.basename(self.path)}, {self.size} 行")
+
+    def _write_header(self, conn: sqlite3.Connection, version: int, quantization: str = None):
+        conn.executemany(
+            "INSERT OR REPLACE INTO info (key, value) VALUES (?, ?)",
+            [
+                ("dim", str(self.dim)),
+                ("capacity", str(self.capacity)),
+                ("size", str(self.size)),
+                ("file_no", str(self.file_no)),
+                ("quantization", quantization or self.quantization),
+                ("version", str(version))
+            ]
+        )
+
+    @contextmanager
+    def _read_txn(self):
+        """读事务：头部与行数据来自同一快照"""
+        conn = self._connect()
+        conn.execute("BEGIN")
+        try:
+            yield conn
+        finally:
+            conn.execute("COMMIT")
+
+    @contextmanager
+    def _write_txn(self):
+        """写事务（跨进程写锁）：先同步其它进程的写入；失败时回滚，下次整体重新加载"""
+        self._check_exists()
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._load(conn)
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            self.version = None
+            self._stale_paths = []
+            raise
+        self._remove_stale_files()
+
+    @staticmethod
+    def _map_file(path: str, shape: tuple, dtype=np.float32) -> np.memmap:
+        """映射文件，长度不足时先扩展"""
+        expected = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if not os.path.exists(path) or os.path.getsize(path) < expected:
+            with open(path, "ab") as f:
+                f.truncate(expected)
+        return np.memmap(path, dtype=dtype, mode="r+", shape=shape)
+
+    def _open_matrix(self):
+        """按当前容量映射向量文件、范数文件（以及量化编码）"""
+        self.matrix = None
+        self.norms = None
+        self.codes = None
+        self.scales = None
+        if self.capacity == 0:
+            return
+        self.matrix = self._map_file(self._vectors_path(self.file_no), (self.capacity, self.dim))
+        # 每行的平方范数与向量一同落盘，加载时无需扫描整个矩阵
+        self.norms = self._map_file(self._norms_path(self.file_no), (self.capacity,))
+        if self.quantized:
+            self.codes = self._map_file(self._codes_path(self.file_no), (self.capacity, self.dim), np.int8)
+            self.scales = self._map_file(self._scales_path(self.file_no), (self.capacity,))
+
+    def _flush(self):
+        for array in (self.matrix, self.norms, self.codes, self.scales):
+            if array is not None:
+                array.flush()
+
+    def _build_codes(self, rows: np.ndarray):
+        """由 float32 向量重建指定行的量化编码（这些行由未开启量化的进程写入时）"""
+        block_rows = max(1, settings.NUMPY_VECTORDB_BLOCK_ROWS)
+        for start in range(0, len(rows), block_rows):
+            block = rows[start:start + block_rows]
+            self.codes[block], self.scales[block] = quantize_int8(np.asarray(self.matrix[block]))
+        self._flush()
+        logger.info(f"量化编码重建完成: {os.path.basename(self.path)}, {len(rows)} 条")
+
+    def _document_code(self, document_id: Optional[str]) -> int:
+        if document_id is None:
+            return _NO_DOCUMENT
+        code = self._document_codes.get(document_id)
+        if code is None:
+            code = self._document_codes[document_id] = len(self._document_codes)
+        return code
+
+    def _resize_rows(self, size: int):
+        """行数组扩展到 size，新行为墓碑"""
+        missing = size - len(self.ids)
+        if missing > 0:
+            self.ids.extend([None] * missing)
+        self.alive = np.resize(self.alive, size)
+        self.doc_codes = np.resize(self.doc_codes, size)
+        if missing > 0:
+            self.alive[size - missing:] = False
+            self.doc_codes[size - missing:] = _NO_DOCUMENT
+
+    def _set_row(self, row: int, chunk_id: Optional[str], document_id: Optional[str]):
+        previous = self.ids[row]
+        if previous is not None and self.row_of.get(previous) == row:
+            del self.row_of[previous]
+        self.ids[row] = chunk_id
+        self.alive[row] = chunk_id is not None
+        self.doc_codes[row] = self._document_code(document_id)
+        if chunk_id is not None:
+            self.row_of[chunk_id] = row
+
+    def _load(self, conn: sqlite3.Connection):
+        """按头部版本号同步其它进程的写入：文件编号未变时只读取版本号更大的行（调用方持有锁和事务）"""
+        info = dict(conn.execute("SELECT key, value FROM info"))
+        version = int(info["version"])
+        if version == self.version:
+            return
+
+        file_no = int(info["file_no"])
+        capacity = int(info["capacity"])
+        incremental = self.version is not None and file_no == self.file_no
+        if incremental:
+            cursor = conn.execute(
+                "SELECT row, chunk_id, document_id FROM rows WHERE version > ?", (self.version,)
+            )
+        else:
+            cursor = conn.execute("SELECT row, chunk_id, document_id FROM rows")
+            self.ids, self.row_of = [], {}
+            self.alive = np.zeros(0, dtype=bool)
+            self.doc_codes = np.zeros(0, dtype=np.int32)
+
+        self.size = int(info["size"])
+        self._resize_rows(self.size)
+        changed = []
+        for row, chunk_id, document_id in cursor:
+            self._set_row(row, chunk_id, document_id)
+            changed.append(row)
+
+        self.dim = int(info["dim"])
+        if not incremental or capacity != self.capacity:
+            self.file_no = file_no
+            self.capacity = capacity
+            self._open_matrix()
+        self.version = version
+        if self.quantized and info["quantization"] != "int8" and changed:
+            self._build_codes(np.asarray(changed if incremental else range(self.size)))
+
+    def refresh(self):
+        """其它进程写入后同步（未变化时只读取一次头部版本号）"""
+        self._check_exists()
+        with self._lock, self._read_txn() as conn:
+            self._load(conn)
+
+    def _commit_rows(self, conn: sqlite3.Connection, records: List[tuple]):
+        """只写入本批改动的行（_row_record 生成，版本号位置待填），并递增版本号（调用方持有写事务）"""
+        version = self.version + 1
+        self._write_rows(conn, [record[:4] + (version,) + record[5:] for record in records])
+        self._write_header(conn, version)
+        self.version = version
+
+    def _ensure_capacity(self, needed: int):
+        """容量不足时翻倍扩展向量文件"""
+        if needed <= self.capacity:
+            return
+        capacity = max(self.capacity, _INITIAL_CAPACITY)
+        while capacity < needed:
+            capacity *= 2
+        self._flush()
+        self.capacity = capacity
+        self._open_matrix()
+
+    def upsert(self, ids: List[str], vectors: np.ndarray, metadatas: List[Dict[str, Any]], documents: List[str]):
+        """插入或覆盖向量（已存在的 chunk_id 原位更新）"""
+        with self._lock, self._write_txn() as conn:
+            if self.dim == 0:
+                self.dim = vectors.shape[1]
+            elif vectors.shape[1] != self.dim:
+                raise VectorDBException(f"向量维度不匹配: 期望 {self.dim}, 实际 {vectors.shape[1]}")
+
+            rows = []
+            for chunk_id in ids:
+                row = self.row_of.get(chunk_id)
+                if row is None:
+                    row = self.size
+                    self.size += 1
+                    self.row_of[chunk_id] = row
+                rows.append(row)
+            self._resize_rows(self.size)
+            records = {}
+            for row, chunk_id, metadata, document in zip(rows, ids, metadatas, documents):
+                record = self._row_record(row, chunk_id, metadata, document, 0)
+                self._set_row(row, chunk_id, record[5])
+                records[row] = record
+
+            self._ensure_capacity(self.size)
+            rows = np.asarray(rows)
+            self.matrix[rows] = vectors
+            self.norms[rows] = np.einsum("ij,ij->i", vectors, vectors)
+            if self.quantized:
+                self.codes[rows], self.scales[rows] = quantize_int8(vectors)
+            self._flush()
+            self._commit_rows(conn, list(records.values()))
+
+    def delete_document(self, document_id: str) -> int:
+        """删除文档的全部向量，返回删除条数"""
+        with self._lock, self._write_txn() as conn:
+            code = self._document_codes.get(str(document_id))
+            if code is None:
+                return 0
+            rows = np.flatnonzero(self.alive[:self.size] & (self.doc_codes[:self.size] == code))
+            return self._remove_rows(conn, rows.tolist())
+
+    def document_vectors(self, document_id: str) -> Dict[str, Dict[str, Any]]:
+        """文档已有向量的 chunk_id 及元数据"""
+        self.refresh()
+        rows = self._reader().execute(
+            "SELECT chunk_id, metadata FROM rows WHERE chunk_id IS NOT NULL AND document_id = ?", (str(document_id),)
+        )
+        return {chunk_id: json.loads(metadata) for chunk_id, metadata in rows}
+
+    def delete_ids(self, ids: List[str]) -> int:
+        """按ID删除向量，返回删除条数"""
+        with self._lock, self._write_txn() as conn:
+            rows = [self.row_of[chunk_id] for chunk_id in ids if chunk_id in self.row_of]
+            return self._remove_rows(conn, rows)
+
+    def _remove_rows(self, conn: sqlite3.Connection, rows: List[int]) -> int:
+        """把行标记为墓碑，墓碑过多时压缩（调用方持有锁和写事务）"""
+        rows = sorted(set(rows))
+        for row in rows:
+            self._set_row(row, None, None)
+
+        if rows:
+            self._commit_rows(conn, [self._row_record(row, None, {}, "", 0) for row in rows])
+            if self.size and (self.size - self.live_count) / self.size > _COMPACT_RATIO:
+                self._compact(conn)
+        return len(rows)
+
+    def _compact(self, conn: sqlite3.Connection):
+        """去掉墓碑行，写入新的向量文件后在元数据库中重新编号；旧文件在事务提交后删除"""
+        keep = np.flatnonzero(self.alive[:self.size])
+        old_paths = self._data_paths(self.file_no)
+        old = (self.matrix, self.norms, self.codes, self.scales)
+
+        self.file_no += 1
+        self.capacity = max(_INITIAL_CAPACITY, int(len(keep) * 1.5))
+        self._open_matrix()
+        if len(keep):
+            for new_array, old_array in zip((self.matrix, self.norms, self.codes, self.scales), old):
+                if new_array is not None:
+                    new_array[:len(keep)] = old_array[keep]
+        self._flush()
+
+        # 保留行按原顺序前移，新行号不大于旧行号，按升序逐行改号不会与未移动的行冲突
+        conn.execute("DELETE FROM rows WHERE chunk_id IS NULL")
+        conn.executemany(
+            "UPDATE rows SET row = ? WHERE row = ?",
+            [(new_row, int(old_row)) for new_row, old_row in enumerate(keep) if new_row != old_row]
+        )
+        self.ids = [self.ids[row] for row in keep]
+        self.row_of = {chunk_id: row for row, chunk_id in enumerate(self.ids)}
+        self.doc_codes = self.doc_codes[keep]
+        self.alive = np.ones(len(keep), dtype=bool)
+        self.size = len(keep)
+        version = self.version + 1
+        self._write_header(conn, version)
+        self.version = version
+
+        del old
+        self._stale_paths = old_paths
+        logger.info(f"向量集合压缩完成: {os.path.basename(self.path)}, 保留 {self.size} 条")
+
+    def _remove_stale_files(self):
+        """删除压缩前的向量文件"""
+        stale_paths, self._stale_paths = self._stale_paths, []
+        for old_path in stale_paths:
+            if not os.path.exists(old_path):
+                continue
+            try:
+                os.remove(old_path)
+            except OSError as e:
+                # 其它进程仍映射旧文件时（Windows）删除会失败，不影响新文件
+                logger.warning(f"旧向量文件删除失败: {old_path}, {e}")
+
+    def _filter_mask(self, conn: sqlite3.Connection, where: Optional[Dict[str, Any]]) -> np.ndarray:
+        """根据过滤条件计算可选行：文档ID查内存中的编号列，章节在元数据库中匹配（调用方持有锁和事务）"""
+        mask = self.alive[:self.size].copy()
+        if not where:
+            return mask
+        if "document_id" in where:
+            code = self._document_codes.get(str(where["document_id"]))
+            if code is None:
+                return np.zeros(self.size, dtype=bool)
+            mask &= self.doc_codes[:self.size] == code
+        if "section" in where:
+            allowed = np.zeros(self.size, dtype=bool)
+            rows = conn.execute(
+                "SELECT row FROM rows WHERE chunk_id IS NOT NULL AND instr(section, ?) > 0", (where["section"],)
+            )
+            allowed[[row for (row,) in rows]] = True
+            mask &= allowed
+        return mask
+
+    def _snapshot(self, where: Optional[Dict[str, Any]] = None) -> _Snapshot:
+        """同步其它进程的写入并取得检索快照"""
+        self._check_exists()
+        with self._lock, self._read_txn() as conn:
+            self._load(conn)
+            return _Snapshot(
+                version=self.version,
+                size=self.size,
+                matrix=self.matrix,
+                norms=self.norms,
+                codes=self.codes,
+                scales=self.scales,
+                ids=self.ids,
+                mask=self._filter_mask(conn, where)
+            )
+
+    def _fetch(self, chunk_ids: List[str]) -> Dict[str, tuple]:
+        """从元数据库读取 chunk_id 对应的 (元数据, 文本)"""
+        if not chunk_ids:
+            return {}
+        placeholders = ",".join("?" * len(chunk_ids))
+        rows = self._reader().execute(
+            f"SELECT chunk_id, metadata, document FROM rows WHERE chunk_id IN ({placeholders})", chunk_ids
+        )
+        return {chunk_id: (json.loads(metadata), document) for chunk_id, metadata, document in rows}
+
+    def search_batch(
+        self,
+        queries: np.ndarray,
+        top_k: int,
+        where: Optional[Dict[str, Any]] = None
+    ) -> List[List[VectorHit]]:
+        """多个查询共享一次分块扫描，得分与 Chroma 的 L2 距离换算一致"""
+        snapshot = self._snapshot(where)
+        if snapshot.size == 0 or top_k <= 0:
+            return [[] for _ in range(len(queries))]
+        if queries.shape[1] != snapshot.matrix.shape[1]:
+            raise VectorDBException(
+                f"查询向量维度不匹配: 期望 {snapshot.matrix.shape[1]}, 实际 {queries.shape[1]}"
+            )
+        if self.quantized:
+            self._recent_queries.extend(np.array(queries, dtype=np.float32))
+
+        grouped = [
+            [(snapshot.ids[row], distance) for row, distance in zip(rows, dist)]
+            for rows, dist in snapshot.search_rows(queries, top_k)
+        ]
+        # 扫描期间被删除的行 chunk_id 为 None 或已不在元数据库中，跳过
+        found = self._fetch(list({chunk_id for hits in grouped for chunk_id, _ in hits if chunk_id is not None}))
+        return [
+            [
+                VectorHit(
+                    chunk_id=chunk_id,
+                    score=max(0, 1 - float(distance)),
+                    metadata=found[chunk_id][0],
+                    chunk_text=found[chunk_id][1]
+                )
+                for chunk_id, distance in hits
+                if chunk_id in found
+            ]
+            for hits in grouped
+        ]
+
+    def search(self, query: np.ndarray, top_k: int, where: Optional[Dict[str, Any]] = None) -> List[VectorHit]:
+        """单个查询检索"""
+        return self.search_batch(query[None, :], top_k, where)[0]
+
+    def _index_bytes(self) -> int:
+        """进程内行索引的字节数估算：ids 列表、chunk_id 到行号的映射、墓碑和文档编号列
+
+        chunk_id 字符串的大小按最多 _ID_SIZE_SAMPLES 个抽样取平均。
+        """
+        with self._lock:
+            ids = self.ids
+            sample = [chunk_id for chunk_id in ids[:_ID_SIZE_SAMPLES] if chunk_id is not None]
+            id_bytes = sum(sys.getsizeof(chunk_id) for chunk_id in sample) / len(sample) if sample else 0
+            return int(
+                sys.getsizeof(ids) + id_bytes * self.live_count
+                + sys.getsizeof(self.row_of) + self.live_count * sys.getsizeof(0)
+                + self.alive.nbytes + self.doc_codes.nbytes
+            )
+
+    def memory_usage(self) -> Dict[str, int]:
+        """检索时需要常驻内存的字节数：向量数据（量化模式下 float32 向量只按候选行读取）加进程内行索引
+
+        文本和元数据不常驻内存，只为返回结果从元数据库读取。
+        """
+        full_bytes = self.size * self.dim * 4
+        if self.quantized:
+            vector_bytes = self.size * (self.dim + 8)
+        else:
+            vector_bytes = full_bytes + self.size * 4
+        index_bytes = self._index_bytes()
+        return {
+            "resident_bytes": vector_bytes + index_bytes,
+            "vector_bytes": vector_bytes,
+            "index_bytes": index_bytes,
+            "full_precision_bytes": full_bytes
+        }
+
+    def estimate_recall(self, k: int = 10) -> Optional[float]:
+        """用最近的真实查询估算两阶段检索相对精确检索的 recall@k，结果按集合版本缓存；尚无查询时返回 None"""
+        snapshot = self._snapshot()
+        if not self.quantized or int(snapshot.mask.sum()) <= k or not self._recent_queries:
+            return None
+        queries = np.stack(list(self._recent_queries))
+        key = (snapshot.version, len(queries), k)
+        cached = self._recall_cache
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        found = 0
+        exact = snapshot.search_rows(queries, k, exact=True)
+        approx = snapshot.search_rows(queries, k)
+        for (exact_rows, _), (approx_rows, _) in zip(exact, approx):
+            found += len(np.intersect1d(exact_rows, approx_rows))
+        recall = round(found / (len(queries) * k), 4)
+        self._recall_cache = (key, recall)
+        return recall
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self.matrix = None
+            self.norms = None
+            self.codes = None
+            self.scales = None
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+            for conn in self._reader_conns:
+                conn.close()
+            self._reader_conns = []
+            self._readers = threading.local()
+
+
+class NumpyVectorAdapter:
+    """进程内 NumPy 向量库适配器（接口与 ChromaAdapter 一致）"""
+
+    def __init__(self, embedding_fn: Optional[Callable[[str], List[float]]] = None):
+        self.embedding_fn = embedding_fn
+        self.root = settings.NUMPY_VECTORDB_DIR
+        self.connected = False
+        self._collections: Dict[str, _NumpyCollection] = {}
+        self._open_lock = threading.Lock()
+        self._runner = BlockingCallRunner()
+
+    async def init_connection(self):
+        """初始化存储目录"""
+        os.makedirs(self.root, exist_ok=True)
+        self.connected = True
+        logger.info(f"NumPy向量库已就绪: {self.root}")
+
+    def _get_collection_name(self, course_id: str) -> str:
+        """获取集合名称"""
+        return f"chunks_{course_id}"
+
+    def _open(self, course_id: str, create: bool) -> _NumpyCollection:
+        collection_name = self._get_collection_name(course_id)
+        with self._open_lock:
+            collection = self._collections.get(collection_name)
+            if collection is None:
+                collection = _NumpyCollection(
+                    os.path.join(self.root, collection_name), settings.NUMPY_VECTORDB_QUANTIZATION.lower()
+                )
+                if not collection.exists():
+                    if not create:
+                        raise VectorDBException(f"向量集合不存在: {collection_name}")
+                    collection.create()
+                    logger.info(f"集合创建成功: {collection_name}")
+                collection.refresh()
+                self._collections[collection_name] = collection
+            return collection
+
+    async def create_collection(self, course_id: str):
+        """创建集合"""
+        if not self.connected:
+            await self.init_connection()
+        return await self._runner.run_write(self._open, course_id, True)
+
+    async def get_collection(self, course_id: str):
+        """获取集合，不存在时创建（已打开的集合直接返回，首次打开走读名额，不与写入排队）"""
+        collection = self._collections.get(self._get_collection_name(course_id))
+        if collection is not None:
+            return collection
+        if not self.connected:
+            await self.init_connection()
+        return await self._runner.run_read(self._open, course_id, True)
+
+    async def upsert(self, course_id: str, vectors: List[VectorRecord]):
+        """插入或更新向量"""
+        if not vectors:
+            return
+
+        try:
+            embeddings = []
+            for vector in vectors:
+                if vector.embedding:
+                    embeddings.append(vector.embedding)
+                elif self.embedding_fn:
+                    embeddings.append(self.embedding_fn(vector.chunk_text))
+                else:
+                    raise ValueError(f"缺少向量: {vector.chunk_id}")
+
+            collection = await self.get_collection(course_id)
+            await self._runner.run_write(
+                collection.upsert,
+                [vector.chunk_id for vector in vectors],
+                np.asarray(embeddings, dtype=np.float32),
+                [
+                    {
+                        "course_id": vector.course_id,
+                        "document_id": vector.document_id,
+                        "section": vector.section,
+                        "page": vector.page
+                    }
+                    for vector in vectors
+                ],
+                [vector.chunk_text for vector in vectors]
+            )
+            logger.debug(f"向量插入成功: {len(vectors)} 条记录")
+
+        except VectorDBException:
+            raise
+        except Exception as e:
+            logger.error(f"向量插入失败: {e}")
+            raise VectorDBException(f"向量插入失败: {e}")
+
+    async def query(
+        self,
+        course_id: str,
+        query_text: str = None,
+        query_embedding: List[float] = None,
+        top_k: int = 12,
+        filters: Optional[Dict[str, Any]] = None
+    ) -> List[VectorHit]:
+        """向量检索"""
+        if not query_embedding:
+            if query_text and self.embedding_fn:
+                query_embedding = self.embedding_fn(query_text)
+            else:
+                raise VectorDBException("NumPy向量库检索需要提供 query_embedding")
+
+        try:
+            collection = await self.get_collection(course_id)
+            hits = await self._runner.run_read(
+                collection.search, np.asarray(query_embedding, dtype=np.float32), top_k, filters
+            )
+            logger.debug(f"向量检索成功: 返回 {len(hits)} 条结果")
+            return hits
+        except VectorDBException:
+            raise
+        except Exception as e:
+            logger.error(f"向量检索失败: {e}")
+            raise VectorDBException(f"向量检索失败: {e}")
+
+    async def query_batch(
+        self,
+        course_id: str,
+        query_embeddings: List[List[float]],
+        top_k: int = 12,
+        filters: Optional[Dict[str, Any]] = None
+    ) -> List[List[VectorHit]]:
+        """多向量批量检索（一次矩阵乘法扫描），结果按查询顺序分组"""
+        if not query_embeddings:
+            return []
+
+        try:
+            collection = await self.get_collection(course_id)
+            grouped = await self._runner.run_read(
+                collection.search_batch, np.asarray(query_embeddings, dtype=np.float32), top_k, filters
+            )
+            logger.debug(f"批量向量检索成功: {len(query_embeddings)} 个查询")
+            return grouped
+        except VectorDBException:
+            raise
+        except Exception as e:
+            logger.error(f"向量检索失败: {e}")
+            raise VectorDBException(f"向量检索失败: {e}")
+
+    async def delete_by_document(self, course_id: str, document_id: str):
+        """根据文档ID删除向量"""
+        try:
+            collection = await self.get_collection(course_id)
+            removed = await self._runner.run_write(collection.delete_document, document_id)
+            if removed:
+                logger.info(f"文档向量删除成功: {document_id}, 删除了 {removed} 条记录")
+            else:
+                logger.info(f"未找到文档 {document_id} 的向量记录")
+        except Exception as e:
+            logger.error(f"文档向量删除失败: {e}")
+            raise VectorDBException(f"文档向量删除失败: {e}")
+
+    async def get_document_vectors(self, course_id: str, document_id: str) -> Dict[str, Dict[str, Any]]:
+        """获取文档已有向量的 chunk_id 及元数据（入库中断后核对文本块与向量）"""
+        try:
+            collection = await self.get_collection(course_id)
+            return await self._runner.run_read(collection.document_vectors, document_id)
+        except VectorDBException:
+            raise
+        except Exception as e:
+            logger.error(f"获取文档向量失败: {e}")
+            raise VectorDBException(f"获取文档向量失败: {e}")
+
+    async def delete_by_ids(self, course_id: str, chunk_ids: List[str]):
+        """根据文本块ID删除向量"""
+        try:
+            collection = await self.get_collection(course_id)
+            removed = await self._runner.run_write(collection.delete_ids, chunk_ids)
+            logger.info(f"向量删除成功: 课程 {course_id}, 删除了 {removed} 条记录")
+        except Exception as e:
+            logger.error(f"向量删除失败: {e}")
+            raise VectorDBException(f"向量删除失败: {e}")
+
+    async def drop_collection(self, course_id: str):
+        """删除集合"""
+        collection_name = self._get_collection_name(course_id)
+        try:
+            collection = self._collections.pop(collection_name, None)
+            if collection is not None:
+                collection.close()
+            await self._runner.run_write(
+                shutil.rmtree, os.path.join(self.root, collection_name), ignore_errors=True
+            )
+            logger.info(f"集合删除成功: {collection_name}")
+        except Exception as e:
+            logger.error(f"集合删除失败: {e}")
+            raise VectorDBException(f"集合删除失败: {e}")
+
+    async def get_collection_stats(self, course_id: str) -> Dict[str, Any]:
+        """获取集合统计信息"""
+        try:
+            collection = await self.get_collection(course_id)
+            await self._runner.run_read(collection.refresh)
+            stats = {
+                "collection_name": self._get_collection_name(course_id),
+                "row_count": collection.live_count,
+                "data_size": collection.size * collection.dim * 4,
+                "deleted_rows": collection.size - collection.live_count,
+                "capacity": collection.capacity,
+                "quantization": collection.quantization,
+                **collection.memory_usage()
+            }
+            if collection.quantized:
+                try:
+                    stats["recall_at_10"] = await self._runner.run_read(collection.estimate_recall, 10)
+                except VectorDBException:
+                    # 估算超时后仍在后台完成并写入缓存，下次统计直接返回
+                    stats["recall_at_10"] = None
+            return stats
+        except Exception as e:
+            logger.error(f"获取集合统计失败: {e}")
+            return {"error": str(e)}
@@ -0,0 +1,228 @@
+import time
+import logging
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from app.core.config import settings
+from app.core.exceptions import KBParseFailedException
+from app.core.metrics import metrics
+from app.kb.parser import DocumentParser
+
+logger = logging.getLogger(__name__)
+
+_parse_tasks = metrics.counter("parse_pool_tasks_total", "提交到解析进程池的子任务数")
+_pool_restarts = metrics.counter("parse_pool_restarts_total", "解析进程异常退出后重建进程池的次数")
+_parse_timeouts = metrics.counter("parse_pool_timeouts_total", "解析子任务超出墙钟时间上限被终止的次数")
+_parse_cpu_seconds = metrics.histogram(
+    "parse_document_cpu_seconds", "单个文档解析消耗的CPU时间",
+    buckets=(0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+)
+
+
+def _limit_cpu(seconds: float):
+    """把本进程的 CPU 软上限设为已用时间 + seconds，超出时由 SIGXCPU 终止进程"""
+    if resource is None or not seconds:
+        return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    limit = int(usage.ru_utime + usage.ru_stime + seconds) + 1
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (limit, hard))
+
+
+# 以下函数在子进程中执行；异常转为 RuntimeError，保证能跨进程传回
+
+def _count_units_task(file_path: str, file_type: str) -> int:
+    try:
+        return DocumentParser.count_units(file_path, file_type)
+    except KBParseFailedException as e:
+        raise RuntimeError(e.message)
+
+
+def _parse_range_task(file_path: str, file_type: str, start: int, end: int, cpu_seconds: float):
+    _limit_cpu(cpu_seconds)
+    started = time.process_time()
+    try:
+        items = list(DocumentParser.iter_range(file_path, file_type, start, end))
+    except KBParseFailedException as e:
+        raise RuntimeError(e.message)
+    return items, time.process_time() - started
+
+
+def _parse_file_task(file_path: str, file_type: str, cpu_seconds: float):
+    _limit_cpu(cpu_seconds)
+    started = time.process_time()
+    metadata: Dict[str, Any] = {}
+    try:
+        items = list(DocumentParser.iter_file(file_path, file_type, metadata))
+    except KBParseFailedException as e:
+        raise RuntimeError(e.message)
+    return items, metadata, time.process_time() - started
+
+
+class ParsePool:
+    """文档解析进程池：PDF/PPT 按页段并行解析、按顺序合并，其它格式整篇在子进程中解析"""
+
+    def __init__(self):
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        metrics.gauge("parse_pool", self.stats, "解析进程池状态")
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # 服务进程中有事件循环和多个线程，用 spawn 避免 fork 继承锁状态
+                self._executor = ProcessPoolExecutor(
+                    max_workers=settings.PARSE_POOL_WORKERS,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._executor
+
+    def _reset(self, broken: ProcessPoolExecutor):
+        """子进程异常退出（如超出CPU上限被终止）后整个进程池不可用，丢弃后重建"""
+        with self._lock:
+            if self._executor is broken:
+                self._executor = None
+                _pool_restarts.inc()
+        broken.shutdown(wait=False, cancel_futures=True)
+        logger.warning("解析进程异常退出，已重建进程池")
+
+    def _kill(self, executor: ProcessPoolExecutor):
+        """子任务超出墙钟时间上限：终止进程池的全部子进程后重建
+
+        卡住的子进程无法单独取消；同时在途的其它文档会收到 BrokenProcessPool 并按原逻辑重试一次。
+        """
+        _parse_timeouts.inc()
+        logger.warning(f"解析子任务超过 {settings.PARSE_TASK_TIMEOUT_SECONDS} 秒，终止解析进程")
+        # ProcessPoolExecutor 没有公开终止子进程的接口
+        for process in list((getattr(executor, "_processes", None) or {}).values()):
+            try:
+                process.terminate()
+            except Exception as e:
+                logger.warning(f"终止解析进程失败: {e}")
+        self._reset(executor)
+
+    def _wait(self, executor: ProcessPoolExecutor, future):
+        """等待子任务结果，超出墙钟时间上限时终止进程池并使本次解析失败（不重新提交）"""
+        timeout = settings.PARSE_TASK_TIMEOUT_SECONDS or None
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            self._kill(executor)
+            raise KBParseFailedException(f"文件解析超时（单个子任务超过 {timeout} 秒）")
+
+    def _run(self, fn, *args):
+        """提交单个子任务并等待结果；进程池损坏时重试一次"""
+        for attempt in range(2):
+            executor = self._get_executor()
+            _parse_tasks.inc()
+            try:
+                return self._wait(executor, executor.submit(fn, *args))
+            except BrokenProcessPool:
+                self._reset(executor)
+                if attempt:
+                    raise KBParseFailedException("解析进程异常退出（可能超出CPU时间限制）")
+            except RuntimeError as e:
+                raise KBParseFailedException(f"文件解析失败: {e}")
+
+    def iter_file(self, file_path: str, file_type: str, metadata: Optional[Dict[str, Any]] = None) -> Iterator[Dict[str, Any]]:
+        """与 DocumentParser.iter_file 产出相同内容，解析在子进程中进行"""
+        if settings.PARSE_POOL_WORKERS <= 0:
+            yield from DocumentParser.iter_file(file_path, file_type, metadata)
+            return
+        if metadata is None:
+            metadata = {}
+
+        doc_type = DocumentParser.DOC_TYPES.get(file_type.lower())
+        if doc_type is None:
+            raise KBParseFailedException(f"不支持的文件类型: {file_type}")
+        metadata["type"], count_key = doc_type
+        metadata[count_key] = 0
+
+        budget = settings.PARSE_CPU_LIMIT_SECONDS
+        if file_type.lower() not in DocumentParser.SPLITTABLE_TYPES:
+            items, parsed_metadata, cpu_seconds = self._run(_parse_file_task, file_path, file_type, budget)
+            _parse_cpu_seconds.observe(cpu_seconds)
+            metadata.update(parsed_metadata)
+            yield from items
+            return
+
+        total = self._run(_count_units_task, file_path, file_type)
+        metadata[count_key] = total
+        step = max(1, settings.PARSE_PAGES_PER_TASK)
+        ranges = [(start, min(start + step, total)) for start in range(0, total, step)]
+        yield from self._iter_ranges(file_path, file_type, ranges, budget)
+
+    def _iter_ranges(
+        self,
+        file_path: str,
+        file_type: str,
+        ranges: List[Tuple[int, int]],
+        budget: float
+    ) -> Iterator[Dict[str, Any]]:
+        """并行解析各页段，按页序产出；在途子任务数为进程数的两倍"""
+        window = settings.PARSE_POOL_WORKERS * 2
+        pending = deque()
+        next_range = 0
+        cpu_used = 0.0
+        retried = False
+
+        def submit(page_range):
+            _parse_tasks.inc()
+            executor = self._get_executor()
+            future = executor.submit(
+                _parse_range_task, file_path, file_type, page_range[0], page_range[1], max(1.0, budget - cpu_used)
+            )
+            return page_range, executor, future
+
+        try:
+            while pending or next_range < len(ranges):
+                while next_range < len(ranges) and len(pending) < window:
+                    pending.append(submit(ranges[next_range]))
+                    next_range += 1
+
+                _, executor, future = pending[0]
+                try:
+                    items, cpu_seconds = self._wait(executor, future)
+                except BrokenProcessPool:
+                    if retried:
+                        raise KBParseFailedException("解析进程异常退出（可能超出CPU时间限制）")
+                    retried = True
+                    self._reset(executor)
+                    pending = deque(submit(pending_range) for pending_range, _, _ in pending)
+                    continue
+                except RuntimeError as e:
+                    raise KBParseFailedException(f"文件解析失败: {e}")
+
+                pending.popleft()
+                cpu_used += cpu_seconds
+                if cpu_used > budget:
+                    raise KBParseFailedException(f"文件解析超出CPU时间限制（{budget} 秒）")
+                yield from items
+        finally:
+            for _, _, future in pending:
+                future.cancel()
+            _parse_cpu_seconds.observe(cpu_used)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"workers": settings.PARSE_POOL_WORKERS, "started": self._executor is not None}
+
+
+# 全局解析进程池
+parse_pool = ParsePool()
@@ -1,6 +1,6 @@
 import os
 import logging
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Iterator, Optional
 from pathlib import Path
 import PyPDF2
 import docx
@@ -15,63 +15,115 @@ logger = logging.getLogger(__name__)
 class DocumentParser:
     """文档解析器"""
     
+    # 文件扩展名 -> (文档类型, 计数字段)
+    DOC_TYPES = {
+        "pdf": ("pdf", "pages"),
+        "docx": ("docx", "paragraphs"),
+        "pptx": ("pptx", "slides"),
+        "md": ("markdown", "sections"),
+        "txt": ("txt", "paragraphs")
+    }
+    
     @staticmethod
     def parse_file(file_path: str, file_type: str) -> Dict[str, Any]:
         """解析文件"""
+        metadata = {}
+        content = list(DocumentParser.iter_file(file_path, file_type, metadata))
+        return {
+            "content": content,
+            "metadata": metadata,
+            "raw_text": "\n\n".join([item["text"] for item in content])
+        }
+    
+    @staticmethod
+    def iter_file(file_path: str, file_type: str, metadata: Optional[Dict[str, Any]] = None) -> Iterator[Dict[str, Any]]:
+        """逐页/逐段解析文件，边解析边产出内容项；metadata 在解析过程中填充（type 在开始时即可用）"""
+        if metadata is None:
+            metadata = {}
+        
+        doc_type = DocumentParser.DOC_TYPES.get(file_type.lower())
+        if doc_type is None:
+            raise KBParseFailedException(f"不支持的文件类型: {file_type}")
+        metadata["type"], count_key = doc_type
+        metadata[count_key] = 0
+        
+        iterators = {
+            "pdf": DocumentParser._iter_pdf,
+            "docx": DocumentParser._iter_docx,
+            "pptx": DocumentParser._iter_pptx,
+            "markdown": DocumentParser._iter_markdown,
+            "txt": DocumentParser._iter_txt
+        }
         try:
-            if file_type.lower() == "pdf":
-                return DocumentParser._parse_pdf(file_path)
-            elif file_type.lower() == "docx":
-                return DocumentParser._parse_docx(file_path)
-            elif file_type.lower() == "pptx":
-                return DocumentParser._parse_pptx(file_path)
-            elif file_type.lower() == "md":
-                return DocumentParser._parse_markdown(file_path)
-            elif file_type.lower() == "txt":
-                return DocumentParser._parse_txt(file_path)
+            yield from iterators[metadata["type"]](file_path, metadata)
+        except KBParseFailedException:
+            raise
+        except Exception as e:
+            logger.error(f"文件解析失败 {file_path}: {e}")
+            raise KBParseFailedException(f"文件解析失败: {e}")
+    
+    # 可按页/幻灯片拆分并行解析的类型
+    SPLITTABLE_TYPES = ("pdf", "pptx")
+    
+    @staticmethod
+    def count_units(file_path: str, file_type: str) -> int:
+        """PDF页数或幻灯片数"""
+        file_type = file_type.lower()
+        if file_type not in DocumentParser.SPLITTABLE_TYPES:
+            raise KBParseFailedException(f"文件类型不支持按页拆分: {file_type}")
+        try:
+            if file_type == "pdf":
+                with open(file_path, 'rb') as file:
+                    return len(PyPDF2.PdfReader(file).pages)
+            return len(Presentation(file_path).slides)
+        except Exception as e:
+            logger.error(f"文件解析失败 {file_path}: {e}")
+            raise KBParseFailedException(f"文件解析失败: {e}")
+    
+    @staticmethod
+    def iter_range(file_path: str, file_type: str, start: int, end: int) -> Iterator[Dict[str, Any]]:
+        """解析第 start 到 end-1 页（或幻灯片，从0开始），产出项与整篇解析一致"""
+        file_type = file_type.lower()
+        if file_type not in DocumentParser.SPLITTABLE_TYPES:
+            raise KBParseFailedException(f"文件类型不支持按页拆分: {file_type}")
+        try:
+            if file_type == "pdf":
+                with open(file_path, 'rb') as file:
+                    yield from DocumentParser._iter_pdf_pages(PyPDF2.PdfReader(file), start, end)
             else:
-                raise KBParseFailedException(f"不支持的文件类型: {file_type}")
-                
+                yield from DocumentParser._iter_pptx_slides(Presentation(file_path), start, end)
         except Exception as e:
             logger.error(f"文件解析失败 {file_path}: {e}")
             raise KBParseFailedException(f"文件解析失败: {e}")
     
     @staticmethod
-    def _parse_pdf(file_path: str) -> Dict[str, Any]:
+    def _iter_pdf(file_path: str, metadata: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
         """解析PDF文件"""
-        content = []
-        metadata = {"type": "pdf", "pages": 0}
-        
         with open(file_path, 'rb') as file:
             pdf_reader = PyPDF2.PdfReader(file)
             metadata["pages"] = len(pdf_reader.pages)
-            
-            for page_num, page in enumerate(pdf_reader.pages, 1):
-                try:
-                    text = page.extract_text()
-                    if text.strip():
-                        content.append({
-                            "page": page_num,
-                            "text": text.strip(),
-                            "section": f"第{page_num}页"
-                        })
-                except Exception as e:
-                    logger.warning(f"PDF页面{page_num}解析失败: {e}")
-                    continue
-        
-        return {
-            "content": content,
-            "metadata": metadata,
-            "raw_text": "\n\n".join([item["text"] for item in content])
-        }
+            yield from DocumentParser._iter_pdf_pages(pdf_reader, 0, metadata["pages"])
     
     @staticmethod
-    def _parse_docx(file_path: str) -> Dict[str, Any]:
+    def _iter_pdf_pages(pdf_reader, start: int, end: int) -> Iterator[Dict[str, Any]]:
+        for index in range(start, min(end, len(pdf_reader.pages))):
+            page_num = index + 1
+            try:
+                text = pdf_reader.pages[index].extract_text()
+            except Exception as e:
+                logger.warning(f"PDF页面{page_num}解析失败: {e}")
+                continue
+            if text.strip():
+                yield {
+                    "page": page_num,
+                    "text": text.strip(),
+                    "section": f"第{page_num}页"
+                }
+    
+    @staticmethod
+    def _iter_docx(file_path: str, metadata: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
         """解析Word文档"""
         doc = docx.Document(file_path)
-        content = []
-        metadata = {"type": "docx", "paragraphs": 0}
-        
         current_section = "文档开始"
         
         for para in doc.paragraphs:
@@ -88,27 +140,24 @@ class DocumentParser:
             ):
                 current_section = text
             
-            content.append({
+            yield {
                 "paragraph": metadata["paragraphs"],
                 "text": text,
                 "section": current_section,
                 "style": para.style.name
-            })
-        
-        return {
-            "content": content,
-            "metadata": metadata,
-            "raw_text": "\n\n".join([item["text"] for item in content])
-        }
+            }
     
     @staticmethod
-    def _parse_pptx(file_path: str) -> Dict[str, Any]:
+    def _iter_pptx(file_path: str, metadata: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
         """解析PowerPoint文档"""
         prs = Presentation(file_path)
-        content = []
-        metadata = {"type": "pptx", "slides": len(prs.slides)}
-        
-        for slide_num, slide in enumerate(prs.slides, 1):
+        metadata["slides"] = len(prs.slides)
+        yield from DocumentParser._iter_pptx_slides(prs, 0, metadata["slides"])
+    
+    @staticmethod
+    def _iter_pptx_slides(prs, start: int, end: int) -> Iterator[Dict[str, Any]]:
+        slides = list(prs.slides)
+        for slide_num, slide in enumerate(slides[start:end], start + 1):
             slide_text = []
             slide_title = f"幻灯片{slide_num}"
             
@@ -122,86 +171,75 @@ class DocumentParser:
                         slide_title = text
             
             if slide_text:
-                content.append({
+                yield {
                     "slide": slide_num,
                     "text": "\n".join(slide_text),
                     "section": slide_title
-                })
-        
-        return {
-            "content": content,
-            "metadata": metadata,
-            "raw_text": "\n\n".join([item["text"] for item in content])
-        }
+                }
     
     @staticmethod
-    def _parse_markdown(file_path: str) -> Dict[str, Any]:
-        """解析Markdown文件"""
-        with open(file_path, 'r', encoding='utf-8') as file:
-            md_content = file.read()
-        
-        # 简单的Markdown解析
-        lines = md_content.split('\n')
-        content = []
+    def _iter_markdown(file_path: str, metadata: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        """解析Markdown文件（按行读取）"""
         current_section = "文档开始"
         current_text = []
         
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-            
-            # 检测标题
-            if line.startswith('#'):
-                # 保存之前的内容
-                if current_text:
-                    content.append({
-                        "text": "\n".join(current_text),
-                        "section": current_section
-                    })
-                    current_text = []
+        with open(file_path, 'r', encoding='utf-8') as file:
+            for line in file:
+                line = line.strip()
+                if not line:
+                    continue
                 
-                # 更新当前章节
-                current_section = line.lstrip('#').strip()
-            else:
-                current_text.append(line)
+                # 检测标题
+                if line.startswith('#'):
+                    # 产出之前的内容
+                    if current_text:
+                        metadata["sections"] += 1
+                        yield {
+                            "text": "\n".join(current_text),
+                            "section": current_section
+                        }
+                        current_text = []
+                    
+                    # 更新当前章节
+                    current_section = line.lstrip('#').strip()
+                else:
+                    current_text.append(line)
         
-        # 保存最后的内容
+        # 产出最后的内容
         if current_text:
-            content.append({
+            metadata["sections"] += 1
+            yield {
                 "text": "\n".join(current_text),
                 "section": current_section
-            })
-        
-        metadata = {"type": "markdown", "sections": len(content)}
-        
-        return {
-            "content": content,
-            "metadata": metadata,
-            "raw_text": md_content
-        }
+            }
     
     @staticmethod
-    def _parse_txt(file_path: str) -> Dict[str, Any]:
-        """解析纯文本文件"""
-        with open(file_path, 'r', encoding='utf-8') as file:
-            text = file.read()
-        
-        # 简单按段落分割
-        paragraphs = [p.strip() for p in text.split('\n\n') if p.strip()]
-        
-        content = []
-        for i, para in enumerate(paragraphs, 1):
-            content.append({
-                "paragraph": i,
-                "text": para,
-                "section": f"段落{i}"
-            })
-        
-        metadata = {"type": "txt", "paragraphs": len(paragraphs)}
+    def _iter_txt(file_path: str, metadata: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        """解析纯文本文件（按空行分段，逐行读取）"""
+        lines = []
+        
+        def flush():
+            para = "\n".join(lines).strip()
+            lines.clear()
+            if para:
+                metadata["paragraphs"] += 1
+                return {
+                    "paragraph": metadata["paragraphs"],
+                    "text": para,
+                    "section": f"段落{metadata['paragraphs']}"
+                }
+            return None
         
-        return {
-            "content": content,
-            "metadata": metadata,
-            "raw_text": text
-        }
\ No newline at end of file
+        with open(file_path, 'r', encoding='utf-8') as file:
+            for line in file:
+                line = line.rstrip("\n")
+                if line:
+                    lines.append(line)
+                elif lines:
+                    item = flush()
+                    if item:
+                        yield item
+        
+        item = flush()
+        if item:
+            yield item
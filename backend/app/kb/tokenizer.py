@@ -0,0 +1,106 @@
+import re
+import logging
+import threading
+from collections import OrderedDict
+from typing import List
+
+try:
+    from tokenizers import Tokenizer
+except ImportError:  # 未安装 tokenizers 时使用估算
+    Tokenizer = None
+
+from app.core.config import settings
+from app.core.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# 估算规则：每个非空白字符计 1 个 token。BERT 中文词表下每个 token 至少覆盖一个非空白字符
+# （中文字符、标点单独成 token，陌生的英文单词和数字会被切成单字符的 ## 片段），因此估算值不小于实际 token 数
+_ESTIMATE_PATTERN = re.compile(r"\S")
+
+# 向量模型在输入两端添加的特殊 token（[CLS]、[SEP]）
+SPECIAL_TOKENS = 2
+
+
+class TokenCounter:
+    """向量模型的 token 计数：优先使用本地 tokenizer.json，否则使用估算；结果按文本缓存（LRU）"""
+
+    def __init__(self, tokenizer_path: str = None, max_entries: int = None):
+        self.tokenizer_path = tokenizer_path if tokenizer_path is not None else settings.EMBEDDING_TOKENIZER_PATH
+        self.max_entries = max_entries or settings.TOKENIZER_CACHE_MAX_ENTRIES
+        self._tokenizer = None
+        self._loaded = False
+        self._entries: "OrderedDict[str, List[int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = metrics.counter("tokenizer_cache_hits_total", "token 切分缓存命中次数")
+        self._misses = metrics.counter("tokenizer_cache_misses_total", "token 切分缓存未命中次数")
+
+    @property
+    def mode(self) -> str:
+        return "tokenizer" if self._load() is not None else "estimate"
+
+    def _load(self):
+        """首次使用时加载 tokenizer，加载失败则退回估算"""
+        if self._loaded:
+            return self._tokenizer
+        with self._lock:
+            if not self._loaded:
+                if self.tokenizer_path and Tokenizer is None:
+                    logger.warning("未安装 tokenizers，token 数使用估算")
+                elif self.tokenizer_path:
+                    try:
+                        tokenizer = Tokenizer.from_file(self.tokenizer_path)
+                        tokenizer.no_truncation()
+                        tokenizer.no_padding()
+                        self._tokenizer = tokenizer
+                        logger.info(f"已加载向量模型 tokenizer: {self.tokenizer_path}")
+                    except Exception as e:
+                        logger.warning(f"加载 tokenizer 失败，token 数使用估算: {e}")
+                self._loaded = True
+        return self._tokenizer
+
+    def token_ends(self, text: str) -> List[int]:
+        """每个 token 结束处的字符偏移（升序，不含特殊 token）；text[:ends[k - 1]] 含 k 个 token"""
+        with self._lock:
+            ends = self._entries.get(text)
+            if ends is not None:
+                self._entries.move_to_end(text)
+                self._hits.inc()
+                return ends
+        self._misses.inc()
+
+        tokenizer = self._load()
+        if tokenizer is not None:
+            ends = [end for _, end in tokenizer.encode(text, add_special_tokens=False).offsets]
+        else:
+            ends = self._estimate_ends(text)
+
+        with self._lock:
+            self._entries[text] = ends
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return ends
+
+    @staticmethod
+    def _estimate_ends(text: str) -> List[int]:
+        return [match.end() for match in _ESTIMATE_PATTERN.finditer(text)]
+
+    def count(self, text: str) -> int:
+        """token 数（不含特殊 token）"""
+        return len(self.token_ends(text))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """截断到不超过 max_tokens 个 token"""
+        ends = self.token_ends(text)
+        if len(ends) <= max_tokens:
+            return text
+        return text[:ends[max_tokens - 1]] if max_tokens > 0 else ""
+
+
+def embedding_token_limit() -> int:
+    """单个文本块可用的 token 数：向量模型输入上限减去特殊 token"""
+    return settings.EMBEDDING_MAX_TOKENS - SPECIAL_TOKENS
+
+
+# 全局 token 计数器
+token_counter = TokenCounter()
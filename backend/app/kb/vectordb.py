@@ -1,5 +1,8 @@
 from typing import List, Dict, Any, Optional, Callable
 from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
 import logging
 import chromadb
 from chromadb.config import Settings
@@ -32,6 +35,55 @@ class VectorHit:
     chunk_text: str
 
 
+_vectordb_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _get_vectordb_executor() -> ThreadPoolExecutor:
+    """向量库阻塞调用专用线程池（进程内共享）"""
+    global _vectordb_executor
+    if _vectordb_executor is None:
+        _vectordb_executor = ThreadPoolExecutor(
+            max_workers=settings.VECTORDB_MAX_CONCURRENT_READS + settings.VECTORDB_MAX_CONCURRENT_WRITES,
+            thread_name_prefix="vectordb"
+        )
+    return _vectordb_executor
+
+
+class BlockingCallRunner:
+    """在专用线程池中执行向量库的同步调用，读写分别限流，读操作带超时"""
+    
+    def __init__(self, read_timeout: float = None):
+        self.read_timeout = read_timeout if read_timeout is not None else settings.VECTOR_SEARCH_TIMEOUT
+        self._read_slots: Optional[asyncio.Semaphore] = None
+        self._write_slots: Optional[asyncio.Semaphore] = None
+    
+    async def _run(self, slots: asyncio.Semaphore, timeout: Optional[float], fn: Callable, *args, **kwargs):
+        await slots.acquire()
+        future = asyncio.get_running_loop().run_in_executor(
+            _get_vectordb_executor(), functools.partial(fn, *args, **kwargs)
+        )
+        # 名额在线程真正结束时才归还，超时的调用不会让线程池被占满
+        future.add_done_callback(lambda _: slots.release())
+        if timeout is None:
+            return await future
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            raise VectorDBException(f"向量库操作超时（{timeout}s）")
+    
+    async def run_read(self, fn: Callable, *args, **kwargs):
+        """执行读操作（检索、计数）"""
+        if self._read_slots is None:
+            self._read_slots = asyncio.Semaphore(settings.VECTORDB_MAX_CONCURRENT_READS)
+        return await self._run(self._read_slots, self.read_timeout, fn, *args, **kwargs)
+    
+    async def run_write(self, fn: Callable, *args, **kwargs):
+        """执行写操作（插入、删除、建集合），批量入库耗时较长，不设超时"""
+        if self._write_slots is None:
+            self._write_slots = asyncio.Semaphore(settings.VECTORDB_MAX_CONCURRENT_WRITES)
+        return await self._run(self._write_slots, None, fn, *args, **kwargs)
+
+
 class ChromaAdapter:
     """Chroma向量数据库适配器"""
     
@@ -39,6 +91,11 @@ class ChromaAdapter:
         self.embedding_fn = embedding_fn
         self.client = None
         self.connected = False
+        # 集合句柄缓存与延迟计数（None 表示尚未统计）
+        self._collections: Dict[str, Any] = {}
+        self._counts: Dict[str, Optional[int]] = {}
+        # chromadb 为同步实现，所有调用都放到专用线程池执行
+        self._runner = BlockingCallRunner()
 
     def _backup_and_reset_persist_dir(self, persist_dir: str) -> bool:
         """备份并重置持久化目录"""
@@ -68,11 +125,11 @@ class ChromaAdapter:
             logger.info(f"Chroma目录: {persist_dir}")
             
             # 最简单的方式创建客户端
-            self.client = chromadb.PersistentClient(path=persist_dir)
+            self.client = await self._runner.run_write(chromadb.PersistentClient, path=persist_dir)
             self.connected = True
             
             # 测试连接
-            collections = self.client.list_collections()
+            collections = await self._runner.run_read(self.client.list_collections)
             logger.info(f"Chroma连接成功，现有{len(collections)}个集合")
             
         except Exception as e:
@@ -92,9 +149,9 @@ class ChromaAdapter:
                             "手动删除 storage/chroma_db 并重新导入知识库。"
                         )
                     # 重新创建客户端
-                    self.client = chromadb.PersistentClient(path=persist_dir)
+                    self.client = await self._runner.run_write(chromadb.PersistentClient, path=persist_dir)
                     self.connected = True
-                    collections = self.client.list_collections()
+                    collections = await self._runner.run_read(self.client.list_collections)
                     logger.info(f"ChromaDB重建成功，现有{len(collections)}个集合")
                     return
                 except Exception as reset_error:
@@ -117,21 +174,25 @@ class ChromaAdapter:
         try:
             # 尝试获取现有集合
             try:
-                collection = self.client.get_collection(collection_name)
+                collection = await self._runner.run_read(self.client.get_collection, collection_name)
                 logger.info(f"集合已存在: {collection_name}")
+                self._collections[collection_name] = collection
                 return collection
             except Exception:
                 # 集合不存在，创建新集合
                 pass
             
             # 创建新集合 - 不使用默认embedding函数，我们自己提供embedding
-            collection = self.client.create_collection(
+            collection = await self._runner.run_write(
+                self.client.create_collection,
                 name=collection_name,
                 metadata={"description": f"原子物理课程{course_id}知识库"},
                 embedding_function=None  # 关键：不使用默认embedding函数
             )
             
             logger.info(f"集合创建成功: {collection_name}")
+            self._collections[collection_name] = collection
+            self._counts[collection_name] = 0
             return collection
             
         except Exception as e:
@@ -139,17 +200,22 @@ class ChromaAdapter:
             raise VectorDBException(f"创建向量集合失败: {e}")
     
     async def get_collection(self, course_id: str):
-        """获取集合"""
+        """获取集合（句柄按课程缓存，drop_collection 时失效）"""
         collection_name = self._get_collection_name(course_id)
         
+        collection = self._collections.get(collection_name)
+        if collection is not None:
+            return collection
+        
         try:
             if not self.connected:
                 await self.init_connection()
             
             try:
-                collection = self.client.get_collection(collection_name)
-                count = collection.count()
-                logger.info(f"获取集合成功: {collection_name}, 向量数: {count}")
+                collection = await self._runner.run_read(self.client.get_collection, collection_name)
+                self._collections[collection_name] = collection
+                self._counts.setdefault(collection_name, None)
+                logger.info(f"获取集合成功: {collection_name}")
                 return collection
             except Exception as e:
                 # 集合不存在
@@ -192,9 +258,13 @@ class ChromaAdapter:
                 elif self.embedding_fn:
                     embeddings.append(self.embedding_fn(vector.chunk_text))
             
+            # upsert 可能覆盖已有记录，计数在下次统计时重新获取
+            self._counts[self._get_collection_name(course_id)] = None
+            
             # 插入数据
             if embeddings:
-                collection.upsert(
+                await self._runner.run_write(
+                    collection.upsert,
                     ids=ids,
                     documents=documents,
                     metadatas=metadatas,
@@ -202,16 +272,18 @@ class ChromaAdapter:
                 )
             else:
                 # 让Chroma自动生成embedding
-                collection.upsert(
+                await self._runner.run_write(
+                    collection.upsert,
                     ids=ids,
                     documents=documents,
                     metadatas=metadatas
                 )
             
-            logger.info(f"向量插入成功: {len(vectors)} 条记录")
+            logger.debug(f"向量插入成功: {len(vectors)} 条记录")
             
         except Exception as e:
             logger.error(f"向量插入失败: {e}")
+            self._invalidate_collection(course_id)
             raise VectorDBException(f"向量插入失败: {e}")
     
     async def query(
@@ -226,107 +298,116 @@ class ChromaAdapter:
         try:
             collection = await self.get_collection(course_id)
 
-            # 构建过滤条件 - 暂时不使用course_id过滤，因为集合名已经包含了course_id
-            where_filter = None
-            if filters:
-                where_filter = {}
-                if "document_id" in filters:
-                    where_filter["document_id"] = filters["document_id"]
-                if "section" in filters:
-                    where_filter["section"] = {"$contains": filters["section"]}
+            where_filter = self._build_where(filters)
+
+            # 执行检索（根据是否有过滤条件决定是否传where参数）
+            query_kwargs = {
+                "n_results": top_k,
+                "include": ["documents", "metadatas", "distances"]
+            }
+            if where_filter:
+                query_kwargs["where"] = where_filter
 
-            # 执行检索
             if query_embedding:
                 # 使用提供的embedding
-                logger.info(f"使用embedding查询，维度: {len(query_embedding)}, top_k: {top_k}, where: {where_filter}")
-
-                # 根据是否有过滤条件决定是否传where参数
-                if where_filter:
-                    results = collection.query(
-                        query_embeddings=[query_embedding],
-                        n_results=top_k,
-                        where=where_filter,
-                        include=["documents", "metadatas", "distances"]
-                    )
-                else:
-                    results = collection.query(
-                        query_embeddings=[query_embedding],
-                        n_results=top_k,
-                        include=["documents", "metadatas", "distances"]
-                    )
-
-                logger.info(f"Chroma返回结果: ids={len(results.get('ids', [[]])[0]) if results.get('ids') else 0}")
+                logger.debug(f"使用embedding查询，维度: {len(query_embedding)}, top_k: {top_k}, where: {where_filter}")
+                query_kwargs["query_embeddings"] = [query_embedding]
             elif query_text:
                 # 使用文本查询
                 if self.embedding_fn:
-                    query_embedding = self.embedding_fn(query_text)
-                    if where_filter:
-                        results = collection.query(
-                            query_embeddings=[query_embedding],
-                            n_results=top_k,
-                            where=where_filter,
-                            include=["documents", "metadatas", "distances"]
-                        )
-                    else:
-                        results = collection.query(
-                            query_embeddings=[query_embedding],
-                            n_results=top_k,
-                            include=["documents", "metadatas", "distances"]
-                        )
+                    query_kwargs["query_embeddings"] = [self.embedding_fn(query_text)]
                 else:
                     # 让Chroma自动处理
-                    if where_filter:
-                        results = collection.query(
-                            query_texts=[query_text],
-                            n_results=top_k,
-                            where=where_filter,
-                            include=["documents", "metadatas", "distances"]
-                        )
-                    else:
-                        results = collection.query(
-                            query_texts=[query_text],
-                            n_results=top_k,
-                            include=["documents", "metadatas", "distances"]
-                        )
+                    query_kwargs["query_texts"] = [query_text]
             else:
                 raise ValueError("必须提供 query_text 或 query_embedding")
 
-            # 转换结果
-            logger.info(f"results类型: {type(results)}, keys: {results.keys() if hasattr(results, 'keys') else 'N/A'}")
-            logger.info(f"results['ids']: {results.get('ids', 'N/A')}")
-
-            hits = []
-            if results['ids'] and len(results['ids']) > 0:
-                for i in range(len(results['ids'][0])):
-                    # Chroma返回的是距离，需要转换为相似度分数
-                    distance = results['distances'][0][i]
-                    # 将距离转换为相似度分数 (0-1)，距离越小相似度越高
-                    score = max(0, 1 - distance)
-
-                    hit = VectorHit(
-                        chunk_id=results['ids'][0][i],
-                        score=score,
-                        metadata=results['metadatas'][0][i],
-                        chunk_text=results['documents'][0][i]
-                    )
-                    hits.append(hit)
-
-            logger.info(f"向量检索成功: 返回 {len(hits)} 条结果")
+            results = await self._runner.run_read(collection.query, **query_kwargs)
+
+            hits = self._convert_results(results, 0)
+            logger.debug(f"向量检索成功: 返回 {len(hits)} 条结果")
             return hits
 
         except Exception as e:
-            error_msg = str(e)
-            logger.error(f"向量检索失败: {e}")
-
-            # 检查是否是数据库损坏的错误
-            if "Cannot open header file" in error_msg or "corrupted" in error_msg.lower():
-                raise VectorDBException(
-                    "向量数据库文件无法打开（可能被占用或已损坏）。"
-                    "请先停止后端服务，确保没有其它进程占用 storage/chroma_db/chroma.sqlite3，"
-                    "然后手动删除 storage/chroma_db 并重新导入知识库。"
-                )
+            self._raise_query_error(course_id, e)
+
+    async def query_batch(
+        self,
+        course_id: str,
+        query_embeddings: List[List[float]],
+        top_k: int = 12,
+        filters: Optional[Dict[str, Any]] = None
+    ) -> List[List[VectorHit]]:
+        """多向量批量检索（一次 collection.query），结果按查询顺序分组"""
+        if not query_embeddings:
+            return []
 
-            raise VectorDBException(f"向量检索失败: {e}")
+        try:
+            collection = await self.get_collection(course_id)
+
+            query_kwargs = {
+                "query_embeddings": query_embeddings,
+                "n_results": top_k,
+                "include": ["documents", "metadatas", "distances"]
+            }
+            where_filter = self._build_where(filters)
+            if where_filter:
+                query_kwargs["where"] = where_filter
+
+            results = await self._runner.run_read(collection.query, **query_kwargs)
+            grouped = [self._convert_results(results, i) for i in range(len(query_embeddings))]
+            logger.debug(f"批量向量检索成功: {len(query_embeddings)} 个查询")
+            return grouped
+
+        except Exception as e:
+            self._raise_query_error(course_id, e)
+
+    @staticmethod
+    def _build_where(filters: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """构建过滤条件 - 不使用course_id过滤，因为集合名已经包含了course_id"""
+        if not filters:
+            return None
+        where_filter = {}
+        if "document_id" in filters:
+            where_filter["document_id"] = filters["document_id"]
+        if "section" in filters:
+            where_filter["section"] = {"$contains": filters["section"]}
+        return where_filter
+
+    @staticmethod
+    def _convert_results(results: Dict[str, Any], i: int) -> List[VectorHit]:
+        """把第 i 个查询的检索结果转换为 VectorHit 列表"""
+        hits = []
+        if results['ids'] and len(results['ids']) > i:
+            for j in range(len(results['ids'][i])):
+                # Chroma返回的是距离，需要转换为相似度分数
+                distance = results['distances'][i][j]
+                # 将距离转换为相似度分数 (0-1)，距离越小相似度越高
+                score = max(0, 1 - distance)
+
+                hits.append(VectorHit(
+                    chunk_id=results['ids'][i][j],
+                    score=score,
+                    metadata=results['metadatas'][i][j],
+                    chunk_text=results['documents'][i][j]
+                ))
+        return hits
+
+    def _raise_query_error(self, course_id: str, e: Exception):
+        """检索失败时丢弃缓存句柄并抛出向量库异常"""
+        error_msg = str(e)
+        logger.error(f"向量检索失败: {e}")
+        self._invalidate_collection(course_id)
+
+        # 检查是否是数据库损坏的错误
+        if "Cannot open header file" in error_msg or "corrupted" in error_msg.lower():
+            raise VectorDBException(
+                "向量数据库文件无法打开（可能被占用或已损坏）。"
+                "请先停止后端服务，确保没有其它进程占用 storage/chroma_db/chroma.sqlite3，"
+                "然后手动删除 storage/chroma_db 并重新导入知识库。"
+            )
+
+        raise VectorDBException(f"向量检索失败: {e}")
     
     async def delete_by_document(self, course_id: str, document_id: str):
         """根据文档ID删除向量"""
@@ -334,22 +415,69 @@ class ChromaAdapter:
             collection = await self.get_collection(course_id)
             
             # 查找要删除的文档
-            results = collection.get(
+            results = await self._runner.run_read(
+                collection.get,
                 where={"document_id": document_id},
                 include=["metadatas"]
             )
             
             if results['ids']:
                 # 删除找到的文档
-                collection.delete(ids=results['ids'])
+                await self._runner.run_write(collection.delete, ids=results['ids'])
+                collection_name = self._get_collection_name(course_id)
+                if self._counts.get(collection_name) is not None:
+                    self._counts[collection_name] -= len(results['ids'])
                 logger.info(f"文档向量删除成功: {document_id}, 删除了 {len(results['ids'])} 条记录")
             else:
                 logger.info(f"未找到文档 {document_id} 的向量记录")
             
         except Exception as e:
             logger.error(f"文档向量删除失败: {e}")
+            self._invalidate_collection(course_id)
             raise VectorDBException(f"文档向量删除失败: {e}")
     
+    async def get_document_vectors(self, course_id: str, document_id: str) -> Dict[str, Dict[str, Any]]:
+        """获取文档已有向量的 chunk_id 及元数据（入库中断后核对文本块与向量）"""
+        try:
+            collection = await self.get_collection(course_id)
+            results = await self._runner.run_read(
+                collection.get,
+                where={"document_id": document_id},
+                include=["metadatas"]
+            )
+            return dict(zip(results['ids'], results['metadatas']))
+        except Exception as e:
+            logger.error(f"获取文档向量失败: {e}")
+            raise VectorDBException(f"获取文档向量失败: {e}")
+    
+    async def delete_by_ids(self, course_id: str, chunk_ids: List[str]):
+        """根据文本块ID删除向量"""
+        try:
+            collection = await self.get_collection(course_id)
+            await self._runner.run_write(collection.delete, ids=chunk_ids)
+            # 不确定其中多少条实际存在，计数下次重新读取
+            self._counts[self._get_collection_name(course_id)] = None
+            logger.info(f"向量删除成功: 课程 {course_id}, {len(chunk_ids)} 条记录")
+        except Exception as e:
+            logger.error(f"向量删除失败: {e}")
+            self._invalidate_collection(course_id)
+            raise VectorDBException(f"向量删除失败: {e}")
+    
+    def _invalidate_collection(self, course_id: str):
+        """丢弃缓存的集合句柄和计数"""
+        collection_name = self._get_collection_name(course_id)
+        self._collections.pop(collection_name, None)
+        self._counts.pop(collection_name, None)
+    
+    async def _get_count(self, course_id: str, collection) -> int:
+        """获取向量数（仅在缓存失效时调用 collection.count()）"""
+        collection_name = self._get_collection_name(course_id)
+        count = self._counts.get(collection_name)
+        if count is None:
+            count = await self._runner.run_read(collection.count)
+            self._counts[collection_name] = count
+        return count
+    
     async def drop_collection(self, course_id: str):
         """删除集合"""
         collection_name = self._get_collection_name(course_id)
@@ -358,7 +486,8 @@ class ChromaAdapter:
             if not self.connected:
                 await self.init_connection()
                 
-            self.client.delete_collection(collection_name)
+            await self._runner.run_write(self.client.delete_collection, collection_name)
+            self._invalidate_collection(course_id)
             logger.info(f"集合删除成功: {collection_name}")
             
         except Exception as e:
@@ -369,7 +498,7 @@ class ChromaAdapter:
         """获取集合统计信息"""
         try:
             collection = await self.get_collection(course_id)
-            count = collection.count()
+            count = await self._get_count(course_id, collection)
             
             return {
                 "collection_name": self._get_collection_name(course_id),
@@ -394,6 +523,9 @@ def create_vectordb_adapter(embedding_fn: Optional[Callable[[str], List[float]]]
     """创建向量数据库适配器"""
     if settings.VECTORDB_TYPE.lower() == "chroma":
         return ChromaAdapter(embedding_fn=embedding_fn)
+    elif settings.VECTORDB_TYPE.lower() == "numpy":
+        from app.kb.numpy_vectordb import NumpyVectorAdapter
+        return NumpyVectorAdapter(embedding_fn=embedding_fn)
     elif settings.VECTORDB_TYPE.lower() == "milvus-lite":
         raise NotImplementedError("Milvus Lite已弃用，请使用Chroma")
     else:
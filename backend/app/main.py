@@ -1,16 +1,19 @@
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, Depends, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
 from fastapi.staticfiles import StaticFiles
 import time
 import uuid
+import asyncio
 from contextlib import asynccontextmanager
 
 from app.core.config import settings
+from app.core.auth import require_admin
 from app.core.logging import setup_logging
 from app.api.v1.router import api_router
 from app.db.session import engine
-from app.models.orm import Base
+from app.db.migrations import upgrade_schema
+from app.models.orm import Base, User
 
 
 @asynccontextmanager
@@ -18,18 +21,31 @@ async def lifespan(app: FastAPI):
     # 启动时初始化
     setup_logging()
     
-    # 创建数据库表
+    # 创建数据库表，并为已有表补齐新增的列
     Base.metadata.create_all(bind=engine)
+    upgrade_schema(engine)
     
     # 初始化向量数据库连接
     from app.kb.vectordb import create_vectordb_adapter
     vectordb = create_vectordb_adapter()
     await vectordb.init_connection()
     
+    # 启动入库队列（恢复上次中断的任务）
+    from app.services.kb_service import kb_service
+    from app.services.ingest_queue import ingest_queue
+    ingest_queue.ensure_started(kb_service.run_ingest_job)
+    
+    # 为旧文档补算内容哈希（上传去重用）
+    await asyncio.to_thread(kb_service.backfill_content_hashes)
+    
     yield
     
     # 关闭时清理
-    pass
+    await ingest_queue.stop()
+    from app.kb.parse_pool import parse_pool
+    parse_pool.shutdown()
+    from app.services.llm_client import llm_client
+    await llm_client.close()
 
 
 app = FastAPI(
@@ -80,4 +96,14 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy", "timestamp": time.time()}
\ No newline at end of file
+    return {"status": "healthy", "timestamp": time.time()}
+
+@app.get("/metrics")
+async def get_metrics(current_user: User = Depends(require_admin)):
+    """运行指标（需要管理员权限）"""
+    if not settings.METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    from app.core.metrics import metrics
+    # 部分指标（入库队列等）需要查询数据库，放到线程中求值
+    snapshot = await asyncio.to_thread(metrics.snapshot)
+    return {"timestamp": time.time(), "metrics": snapshot}
\ No newline at end of file
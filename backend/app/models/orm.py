@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, Float, DateTime, ForeignKey, JSON, Boolean
+from sqlalchemy import Column, Integer, String, Text, Float, DateTime, ForeignKey, JSON, Boolean, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from app.db.session import Base
@@ -46,11 +46,16 @@ class Document(Base):
     file_type = Column(String(20), nullable=False)
     storage_path = Column(String(500), nullable=False)
     status = Column(String(20), nullable=False, default="uploaded")  # uploaded|processing|ready|failed
+    content_hash = Column(String(64))  # 文件内容 SHA-256，用于同课程内去重
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     
     # 关系
     course = relationship("Course", back_populates="documents")
     chunks = relationship("Chunk", back_populates="document")
+    
+    __table_args__ = (
+        Index("ix_documents_course_content_hash", "course_id", "content_hash"),
+    )
 
 
 class Chunk(Base):
@@ -62,11 +67,16 @@ class Chunk(Base):
     chunk_index = Column(Integer, nullable=False)
     chunk_text = Column(Text, nullable=False)
     meta_json = Column(JSON)  # {section, page, offset, title_path...}
+    content_hash = Column(String(64))  # chunk_text 的 SHA-256，增量入库时比对
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     
     # 关系
     document = relationship("Document", back_populates="chunks")
     course = relationship("Course", back_populates="chunks")
+    
+    __table_args__ = (
+        Index("ix_chunks_document_content_hash", "document_id", "content_hash"),
+    )
 
 
 class KnowledgePoint(Base):
@@ -155,8 +165,57 @@ class IngestTask(Base):
     id = Column(Integer, primary_key=True, index=True)
     task_id = Column(String(50), unique=True, index=True, nullable=False)
     document_id = Column(Integer, ForeignKey("documents.id"), nullable=False)
-    status = Column(String(20), nullable=False, default="queued")  # queued|processing|done|failed
+    status = Column(String(20), nullable=False, default="queued", index=True)  # queued|processing|done|failed
     progress = Column(Float, default=0.0)
     error_message = Column(Text)
+    chunk_policy_json = Column(JSON)  # {max_chars, overlap}
+    mode = Column(String(20), nullable=False, default="full")  # full|incremental
+    attempts = Column(Integer, nullable=False, default=0)
+    worker_id = Column(String(100))  # 当前持有租约的工作者
+    lease_expires_at = Column(DateTime(timezone=True))
+    started_at = Column(DateTime(timezone=True))
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+
+class KBGeneration(Base):
+    __tablename__ = "kb_generations"
+    
+    course_id = Column(Integer, ForeignKey("courses.id"), primary_key=True)
+    generation = Column(Integer, nullable=False, default=0)  # 每次入库/删除文档后递增
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+
+class UploadSession(Base):
+    __tablename__ = "upload_sessions"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    upload_id = Column(String(50), unique=True, index=True, nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    course_id = Column(Integer, ForeignKey("courses.id"), nullable=False)
+    file_name = Column(String(255), nullable=False)
+    file_type = Column(String(20), nullable=False)
+    total_size = Column(Integer)  # 客户端声明的文件大小，完成时校验
+    status = Column(String(20), nullable=False, default="open")  # open|completed|aborted
+    document_id = Column(Integer, ForeignKey("documents.id"))
     created_at = Column(DateTime(timezone=True), server_default=func.now())
-    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
\ No newline at end of file
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+    
+    parts = relationship("UploadPart", back_populates="session", cascade="all, delete-orphan")
+
+
+class UploadPart(Base):
+    __tablename__ = "upload_parts"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    session_id = Column(Integer, ForeignKey("upload_sessions.id"), nullable=False)
+    part_number = Column(Integer, nullable=False)  # 从1开始
+    size = Column(Integer, nullable=False)
+    sha256 = Column(String(64), nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    
+    session = relationship("UploadSession", back_populates="parts")
+    
+    __table_args__ = (
+        Index("ix_upload_parts_session_part", "session_id", "part_number", unique=True),
+    )
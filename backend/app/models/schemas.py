@@ -1,4 +1,4 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, model_validator
 from typing import List, Optional, Dict, Any
 from datetime import datetime
 from enum import Enum
@@ -88,17 +88,73 @@ class DocumentResponse(BaseModel):
 class UploadResponse(BaseModel):
     document_id: int
     status: str
+    deduplicated: bool = False  # 课程内已有相同内容的文档，直接返回该文档
+
+
+# 断点续传上传
+class UploadSessionCreate(BaseModel):
+    course_id: int
+    file_name: str = Field(..., min_length=1, max_length=255)
+    total_size: Optional[int] = Field(None, ge=0)
+
+
+class UploadPartInfo(BaseModel):
+    part_number: int
+    size: int
+    sha256: str
+
+
+class UploadSessionResponse(BaseModel):
+    upload_id: str
+    course_id: int
+    file_name: str
+    status: str
+    total_size: Optional[int] = None
+    received_bytes: int = 0
+    part_max_size: int
+    parts: List[UploadPartInfo] = []
+    document_id: Optional[int] = None
 
 
 # 知识库相关模型
+class ChunkLengthUnit(str, Enum):
+    CHARS = "chars"
+    TOKENS = "tokens"  # 按向量模型的 token 计长，保证每个文本块都能完整向量化
+
+
 class ChunkPolicy(BaseModel):
-    max_chars: int = 800
-    overlap: int = 120
+    max_chars: int = Field(800, gt=0)
+    overlap: int = Field(120, ge=0)
+    unit: Optional[ChunkLengthUnit] = None  # 未指定时按给出的字段推断，都未给出时取 CHUNK_LENGTH_UNIT
+    max_tokens: Optional[int] = Field(None, gt=0)  # 按 token 计长时的块大小，默认 CHUNK_SIZE_TOKENS
+    overlap_tokens: Optional[int] = Field(None, ge=0)
+
+    @model_validator(mode="after")
+    def _resolve_unit(self) -> "ChunkPolicy":
+        """未指定 unit 时：只给出 max_chars/overlap（旧版请求）按字符计长，给出 max_tokens/overlap_tokens 按 token 计长，两类混用时拒绝"""
+        if self.unit is not None:
+            return self
+        char_fields = {"max_chars", "overlap"} & self.model_fields_set
+        token_fields = [name for name in ("max_tokens", "overlap_tokens") if getattr(self, name) is not None]
+        if char_fields and token_fields:
+            raise ValueError("max_chars/overlap 与 max_tokens/overlap_tokens 不能同时指定，请用 unit 选择计长单位")
+        if char_fields:
+            self.unit = ChunkLengthUnit.CHARS
+        elif token_fields:
+            self.unit = ChunkLengthUnit.TOKENS
+        return self
+
+
+class IngestMode(str, Enum):
+    FULL = "full"
+    INCREMENTAL = "incremental"  # 与已有文本块比对，只向量化新增或变化的部分
 
 
 class IngestRequest(BaseModel):
     document_id: int
     chunk_policy: Optional[ChunkPolicy] = None
+    mode: IngestMode = IngestMode.FULL
+    force: bool = False  # 文档已入库时仍重新处理
 
 
 class IngestResponse(BaseModel):
@@ -118,6 +174,7 @@ class TaskResponse(BaseModel):
     status: str
     progress: float
     error: Optional[str] = None
+    queue_position: Optional[int] = None  # 排队中时前面的任务数
 
 
 class SearchHit(BaseModel):
@@ -132,6 +189,21 @@ class SearchResponse(BaseModel):
     hits: List[SearchHit]
 
 
+class BatchSearchRequest(BaseModel):
+    course_id: int
+    queries: List[str] = Field(..., min_length=1, max_length=256)
+    top_k: int = Field(12, ge=1, le=100)
+
+
+class BatchSearchResult(BaseModel):
+    query: str
+    hits: List[SearchHit]
+
+
+class BatchSearchResponse(BaseModel):
+    results: List[BatchSearchResult]
+
+
 # QA相关模型
 class QARequest(BaseModel):
     course_id: int
@@ -152,6 +224,7 @@ class QAResponse(BaseModel):
     confidence: float
     citations: List[Citation]
     followups: List[str] = []
+    cached: bool = False
 
 
 class FeedbackRequest(BaseModel):
@@ -0,0 +1,47 @@
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+from app.core.config import settings
+from app.core.metrics import metrics
+
+
+class AnswerCache:
+    """问答结果缓存（TTL + LRU），键中包含知识库版本号，知识库变更后旧条目自然失效"""
+
+    def __init__(self, name: str = "answer_cache", max_entries: int = None, ttl_seconds: float = None):
+        self.max_entries = max_entries or settings.ANSWER_CACHE_MAX_ENTRIES
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else settings.ANSWER_CACHE_TTL_SECONDS
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = metrics.counter(f"{name}_hits_total", "问答缓存命中次数")
+        self._misses = metrics.counter(f"{name}_misses_total", "问答缓存未命中次数")
+        metrics.gauge(f"{name}_entries", lambda: len(self._entries), "问答缓存条目数")
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """查询缓存，过期条目视为未命中"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self._hits.inc()
+                    return value
+                del self._entries[key]
+        self._misses.inc()
+        return None
+
+    def put(self, key: Hashable, value: Any):
+        """写入缓存，超过容量时淘汰最久未使用的条目"""
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._entries.clear()
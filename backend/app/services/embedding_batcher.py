@@ -0,0 +1,82 @@
+import time
+import asyncio
+import logging
+from typing import List, Tuple, Set
+
+from app.core.config import settings
+from app.core.metrics import metrics
+from app.services.llm_client import llm_client, EmbeddingResult
+
+logger = logging.getLogger(__name__)
+
+_batch_size = metrics.histogram(
+    "query_embedding_batch_size", "查询向量微批的批大小",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128)
+)
+_queue_wait = metrics.histogram(
+    "query_embedding_queue_wait_seconds", "查询向量在微批队列中的等待时间",
+    buckets=(0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25)
+)
+
+
+class EmbeddingMicroBatcher:
+    """查询向量微批处理器：合并短时间窗口内的并发请求为一次批量调用"""
+
+    def __init__(self, max_wait_ms: float = None, max_batch_size: int = None):
+        self.max_wait = (max_wait_ms if max_wait_ms is not None else settings.EMBEDDING_MICROBATCH_WAIT_MS) / 1000
+        self.max_batch_size = max(1, max_batch_size or settings.EMBEDDING_MICROBATCH_MAX_SIZE)
+        self._pending: List[Tuple[str, asyncio.Future, float]] = []
+        self._flush_handle = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def embed(self, text: str) -> EmbeddingResult:
+        """获取单条查询文本的向量（与同窗口内的其他请求合并发送）"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future, time.perf_counter()))
+
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.max_wait, self._flush)
+
+        return await future
+
+    def _flush(self):
+        """取出当前等待队列并发起批量请求"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        task = asyncio.get_running_loop().create_task(self._run_batch(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, batch: List[Tuple[str, asyncio.Future, float]]):
+        """执行一次批量向量化，并把结果分发给各个调用方"""
+        now = time.perf_counter()
+        for _, _, enqueued_at in batch:
+            _queue_wait.observe(now - enqueued_at)
+        _batch_size.observe(len(batch))
+
+        try:
+            results = await llm_client.get_embeddings_batch([text for text, _, _ in batch])
+        except Exception as e:
+            logger.error(f"查询向量微批失败: {len(batch)} 条, {e}")
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future, _), result in zip(batch, results):
+            # 调用方可能已取消等待
+            if not future.done():
+                future.set_result(result)
+
+
+# 全局微批处理器
+embedding_batcher = EmbeddingMicroBatcher()
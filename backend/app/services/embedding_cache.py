@@ -0,0 +1,203 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import logging
+import asyncio
+import threading
+import unicodedata
+from typing import List, Optional
+
+import numpy as np
+
+from app.core.config import settings
+from app.core.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+_cache_hits = metrics.counter("embedding_cache_hits_total", "向量缓存命中次数")
+_cache_misses = metrics.counter("embedding_cache_misses_total", "向量缓存未命中次数")
+_cache_evictions = metrics.counter("embedding_cache_evictions_total", "向量缓存淘汰条数")
+
+# 向量以小端 float32 连续存储
+_VECTOR_DTYPE = np.dtype("<f4")
+
+
+def normalize_text(text: str) -> str:
+    """缓存键使用的文本标准化：NFKC + 合并空白"""
+    text = unicodedata.normalize("NFKC", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def text_hash(text: str) -> str:
+    """标准化文本的内容哈希"""
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """持久化向量缓存（按 (模型, 文本哈希) 寻址，SQLite + float32 二进制存储）"""
+
+    def __init__(self, path: str = None, max_entries: int = None):
+        self.path = path or settings.EMBEDDING_CACHE_PATH
+        self.max_entries = max_entries or settings.EMBEDDING_CACHE_MAX_ENTRIES
+        self._conn: Optional[sqlite3.Connection] = None
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        """延迟打开数据库连接"""
+        if self._conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    model TEXT NOT NULL,
+                    text_hash TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    last_access REAL NOT NULL,
+                    PRIMARY KEY (model, text_hash)
+                ) WITHOUT ROWID
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_access ON embeddings(last_access)")
+            conn.commit()
+            self._count = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            self._conn = conn
+            logger.info(f"向量缓存已加载: {self.path}, {self._count} 条")
+        return self._conn
+
+    def get_many_sync(self, model: str, texts: List[str]) -> List[Optional[List[float]]]:
+        """批量查询缓存，未命中的位置返回None"""
+        if not texts:
+            return []
+
+        hashes = [text_hash(text) for text in texts]
+        found = {}
+        try:
+            with self._lock:
+                conn = self._connect()
+                unique_hashes = list(dict.fromkeys(hashes))
+                # SQLite 参数个数有限，分段查询
+                for i in range(0, len(unique_hashes), 500):
+                    part = unique_hashes[i:i + 500]
+                    placeholders = ",".join("?" * len(part))
+                    rows = conn.execute(
+                        f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                        [model, *part]
+                    ).fetchall()
+                    for h, blob in rows:
+                        found[h] = np.frombuffer(blob, dtype=_VECTOR_DTYPE).tolist()
+
+                if found:
+                    now = time.time()
+                    conn.executemany(
+                        "UPDATE embeddings SET last_access = ? WHERE model = ? AND text_hash = ?",
+                        [(now, model, h) for h in found]
+                    )
+                    conn.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"读取向量缓存失败，按未命中处理: {e}")
+            found = {}
+
+        results = [found.get(h) for h in hashes]
+        hits = sum(1 for r in results if r is not None)
+        _cache_hits.inc(hits)
+        _cache_misses.inc(len(results) - hits)
+        return results
+
+    def put_many_sync(self, model: str, texts: List[str], vectors: List[List[float]]):
+        """批量写入缓存，超出容量时按最近访问时间淘汰"""
+        if not texts:
+            return
+
+        now = time.time()
+        rows = [
+            (model, text_hash(text), np.asarray(vector, dtype=_VECTOR_DTYPE).tobytes(), now)
+            for text, vector in zip(texts, vectors)
+        ]
+        try:
+            with self._lock:
+                conn = self._connect()
+                before = conn.total_changes
+                conn.executemany(
+                    "INSERT OR IGNORE INTO embeddings (model, text_hash, vector, last_access) VALUES (?, ?, ?, ?)",
+                    rows
+                )
+                self._count += conn.total_changes - before
+                conn.commit()
+
+                if self._count > self.max_entries:
+                    self._evict(conn)
+        except sqlite3.Error as e:
+            logger.warning(f"写入向量缓存失败: {e}")
+
+    def _evict(self, conn: sqlite3.Connection):
+        """淘汰最久未访问的条目，多淘汰10%以摊薄淘汰开销"""
+        target = int(self.max_entries * 0.9)
+        excess = self._count - target
+        if excess <= 0:
+            return
+
+        conn.execute(
+            """
+            DELETE FROM embeddings WHERE (model, text_hash) IN (
+                SELECT model, text_hash FROM embeddings ORDER BY last_access LIMIT ?
+            )
+            """,
+            (excess,)
+        )
+        conn.commit()
+        self._count = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        _cache_evictions.inc(excess)
+        logger.info(f"向量缓存淘汰 {excess} 条，剩余 {self._count} 条")
+
+    async def get_many(self, model: str, texts: List[str]) -> List[Optional[List[float]]]:
+        """批量查询缓存（在线程池中执行）"""
+        return await asyncio.to_thread(self.get_many_sync, model, texts)
+
+    async def put_many(self, model: str, texts: List[str], vectors: List[List[float]]):
+        """批量写入缓存（在线程池中执行）"""
+        await asyncio.to_thread(self.put_many_sync, model, texts, vectors)
+
+    def stats(self) -> dict:
+        """缓存统计"""
+        lookups = _cache_hits.value + _cache_misses.value
+        return {
+            "entries": self._count,
+            "max_entries": self.max_entries,
+            "hits": int(_cache_hits.value),
+            "misses": int(_cache_misses.value),
+            "hit_rate": round(_cache_hits.value / lookups, 4) if lookups else 0.0
+        }
+
+    def close(self):
+        """关闭数据库连接"""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class _DisabledEmbeddingCache:
+    """禁用缓存时的空实现"""
+
+    async def get_many(self, model: str, texts: List[str]) -> List[Optional[List[float]]]:
+        return [None] * len(texts)
+
+    async def put_many(self, model: str, texts: List[str], vectors: List[List[float]]):
+        return None
+
+    def stats(self) -> dict:
+        return {"enabled": False}
+
+    def close(self):
+        return None
+
+
+# 全局缓存实例
+embedding_cache = EmbeddingCache() if settings.EMBEDDING_CACHE_ENABLED else _DisabledEmbeddingCache()
+metrics.gauge("embedding_cache", embedding_cache.stats, "向量缓存状态")
@@ -0,0 +1,460 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+import concurrent.futures
+from collections import defaultdict, deque
+from dataclasses import dataclass
+from typing import List, Dict, Any, Iterator, Tuple
+
+from sqlalchemy import insert, update
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.core.metrics import metrics
+from app.kb.parse_pool import parse_pool
+from app.kb.chunker import TextChunker, TextChunk, content_hash
+from app.kb.vectordb import VectorRecord
+from app.models.orm import Chunk, Document, IngestTask
+from app.services.llm_client import llm_client
+
+logger = logging.getLogger(__name__)
+
+_stage_seconds = {
+    stage: metrics.histogram(f"ingest_{stage}_stage_seconds", f"入库流水线 {stage} 阶段的累计耗时（每个文档一次）")
+    for stage in ("parse", "embed", "store")
+}
+_incremental_chunks = {
+    kind: metrics.counter(f"ingest_incremental_{kind}_chunks_total", f"增量入库中{label}的文本块数")
+    for kind, label in (("added", "新增"), ("removed", "删除"), ("unchanged", "未变化"), ("relabeled", "仅页码/章节变化"))
+}
+
+# 队列结束标记
+_DONE = object()
+
+
+@dataclass
+class _Failure:
+    """生产者线程中的异常，经队列传给消费者"""
+    error: BaseException
+
+
+class _ParsedJsonWriter:
+    """边解析边写出解析结果 JSON（{"content": [...], "metadata": {...}}），完成后原子替换"""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self._tmp_path = f"{path}.tmp"
+        self._file = open(self._tmp_path, "w", encoding="utf-8")
+        self._file.write('{"content": [\n')
+        self._first = True
+
+    def write_item(self, item: Dict[str, Any]):
+        if not self._first:
+            self._file.write(",\n")
+        self._file.write(json.dumps(item, ensure_ascii=False))
+        self._first = False
+
+    def close(self, metadata: Dict[str, Any]):
+        self._file.write('\n], "metadata": ')
+        self._file.write(json.dumps(metadata, ensure_ascii=False))
+        self._file.write("}\n")
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        self._file.close()
+        try:
+            os.remove(self._tmp_path)
+        except OSError:
+            pass
+
+
+class _Progress:
+    """按阶段估算入库进度：解析进度 × (0.3 + 0.6 × 已入库块比例)，起点 0.1"""
+
+    def __init__(self):
+        self.metadata: Dict[str, Any] = {}
+        self.items_parsed = 0
+        self.parse_done = False
+        self.chunks_produced = 0
+        self.chunks_stored = 0
+
+    def parse_fraction(self) -> float:
+        if self.parse_done:
+            return 1.0
+        # PDF 页数、幻灯片数在打开文件时即可知道，其它格式解析完才知道总量
+        total = self.metadata.get("pages") or self.metadata.get("slides")
+        if self.metadata.get("type") in ("pdf", "pptx") and total:
+            return min(1.0, self.items_parsed / total)
+        return 0.0
+
+    def value(self) -> float:
+        parsed = self.parse_fraction()
+        stored = self.chunks_stored / self.chunks_produced if self.chunks_produced else 0.0
+        return round(min(0.99, 0.1 + 0.3 * parsed + 0.6 * parsed * stored), 3)
+
+
+class StreamingIngestPipeline:
+    """流式入库：解析+分块（线程） -> 批量向量化 -> 批量写库，阶段之间用有界队列衔接"""
+
+    def __init__(self, vectordb):
+        self.vectordb = vectordb
+
+    def _produce_chunks(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        queue: asyncio.Queue,
+        stop: threading.Event,
+        document: Document,
+        chunker: TextChunker,
+        progress: _Progress
+    ):
+        """在线程中逐页解析（解析本身在进程池中进行）并分块，把文本块放入队列（队列满时阻塞，形成背压）"""
+        def put(item) -> bool:
+            while not stop.is_set():
+                future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+                try:
+                    future.result(timeout=1.0)
+                    return True
+                except concurrent.futures.TimeoutError:
+                    # 取消失败说明已放入队列
+                    if not future.cancel():
+                        return True
+            return False
+
+        started = time.perf_counter()
+        writer = _ParsedJsonWriter(f"{settings.STORAGE_DIR}/parsed/{document.id}.json")
+        try:
+            for chunk in self._iter_document_chunks(document, chunker, progress, writer):
+                if not put(chunk):
+                    writer.abort()
+                    return
+            progress.parse_done = True
+            writer.close(progress.metadata)
+            put(_DONE)
+        except BaseException as e:
+            writer.abort()
+            put(_Failure(e))
+        finally:
+            _stage_seconds["parse"].observe(time.perf_counter() - started)
+
+    @staticmethod
+    def _iter_document_chunks(
+        document: Document,
+        chunker: TextChunker,
+        progress: _Progress,
+        writer: _ParsedJsonWriter
+    ) -> Iterator[TextChunk]:
+        """解析文档并分块，解析结果同时写入 JSON"""
+        def content_items():
+            for item in parse_pool.iter_file(document.storage_path, document.file_type, progress.metadata):
+                writer.write_item(item)
+                progress.items_parsed += 1
+                yield item
+
+        # iter_file 在首次取值时才确定文档类型，先取出第一项
+        items = content_items()
+        first = next(items, None)
+        doc_type = progress.metadata.get("type", "unknown")
+
+        def all_items():
+            if first is not None:
+                yield first
+            yield from items
+
+        yield from chunker.iter_chunks(all_items(), doc_type)
+
+    async def _embed_stage(self, chunk_queue: asyncio.Queue, batch_queue: asyncio.Queue, progress: _Progress):
+        """攒批后发起向量化；已发起的批次按顺序放入下游队列，队列容量即同时在途的批次数"""
+        batch: List[TextChunk] = []
+
+        async def flush():
+            if batch:
+                texts = [chunk.text for chunk in batch]
+                task = asyncio.create_task(llm_client.get_embeddings_batch(texts))
+                await batch_queue.put((list(batch), task))
+                batch.clear()
+
+        while True:
+            item = await chunk_queue.get()
+            if item is _DONE or isinstance(item, _Failure):
+                await flush()
+                await batch_queue.put(item)
+                return
+            batch.append(item)
+            progress.chunks_produced += 1
+            if len(batch) >= settings.INGEST_PIPELINE_BATCH_SIZE:
+                await flush()
+
+    @staticmethod
+    def _insert_chunks(db: Session, document: Document, chunks: List[TextChunk]) -> List[int]:
+        """一条 INSERT ... RETURNING 批量插入文本块，按输入顺序返回ID"""
+        return db.execute(
+            insert(Chunk).returning(Chunk.id, sort_by_parameter_order=True),
+            [
+                {
+                    "document_id": document.id,
+                    "course_id": document.course_id,
+                    "chunk_index": chunk.index,
+                    "chunk_text": chunk.text,
+                    "meta_json": chunk.metadata,
+                    "content_hash": chunk.content_hash
+                }
+                for chunk in chunks
+            ]
+        ).scalars().all()
+
+    @staticmethod
+    def _vector_record(document: Document, chunk_id: int, chunk: TextChunk, embedding_result) -> VectorRecord:
+        return VectorRecord(
+            chunk_id=str(chunk_id),
+            course_id=str(document.course_id),
+            document_id=str(document.id),
+            section=chunk.metadata.get("section", ""),
+            page=chunk.metadata.get("page", 0),
+            chunk_text=chunk.text[:2000],  # 限制长度
+            embedding=embedding_result.embedding
+        )
+
+    def _store_batch(
+        self,
+        db: Session,
+        document: Document,
+        chunks: List[TextChunk],
+        embeddings
+    ) -> Tuple[List[VectorRecord], List[Tuple[int, int, str, Dict[str, Any]]]]:
+        """写入一批文本块，返回向量记录和供倒排索引使用的 (chunk_id, document_id, text, meta)"""
+        chunk_ids = self._insert_chunks(db, document, chunks)
+        vector_records = []
+        indexed_chunks = []
+        for chunk_id, chunk, embedding_result in zip(chunk_ids, chunks, embeddings):
+            vector_records.append(self._vector_record(document, chunk_id, chunk, embedding_result))
+            indexed_chunks.append((chunk_id, document.id, chunk.text, chunk.metadata))
+        return vector_records, indexed_chunks
+
+    async def run(
+        self,
+        db: Session,
+        task: IngestTask,
+        document: Document,
+        chunker: TextChunker,
+        written_chunk_ids: List[int]
+    ) -> List[Tuple[int, int, str, Dict[str, Any]]]:
+        """执行流式入库，每批写入后提交并更新任务进度；返回全部已写入的文本块
+
+        已提交的文本块ID追加到 written_chunk_ids，失败时由调用方清理。
+        """
+        loop = asyncio.get_running_loop()
+        chunk_queue: asyncio.Queue = asyncio.Queue(maxsize=settings.INGEST_PIPELINE_QUEUE_SIZE)
+        batch_queue: asyncio.Queue = asyncio.Queue(maxsize=settings.INGEST_PIPELINE_EMBED_INFLIGHT)
+        stop = threading.Event()
+        progress = _Progress()
+
+        producer = asyncio.create_task(asyncio.to_thread(
+            self._produce_chunks, loop, chunk_queue, stop, document, chunker, progress
+        ))
+        embedder = asyncio.create_task(self._embed_stage(chunk_queue, batch_queue, progress))
+
+        indexed_chunks = []
+        embed_seconds = 0.0
+        store_seconds = 0.0
+        try:
+            while True:
+                item = await batch_queue.get()
+                if item is _DONE:
+                    break
+                if isinstance(item, _Failure):
+                    raise item.error
+
+                chunks, embedding_task = item
+                waited = time.perf_counter()
+                embeddings = await embedding_task
+                embed_seconds += time.perf_counter() - waited
+
+                stored = time.perf_counter()
+                vector_records, batch_indexed = self._store_batch(db, document, chunks, embeddings)
+                written_chunk_ids.extend(chunk_id for chunk_id, _, _, _ in batch_indexed)
+                progress.chunks_stored += len(chunks)
+                task.progress = progress.value()
+                # 文本块与进度在一个事务中提交后立即写向量，向量写入失败时由调用方按ID清理，
+                # 进程在两者之间退出时由任务重试前的 reconcile_vectors 补齐；
+                # 不在持有 SQLite 写锁时让出事件循环，否则其它入库任务会在事件循环线程上等锁
+                db.commit()
+                await self.vectordb.upsert(str(document.course_id), vector_records)
+                store_seconds += time.perf_counter() - stored
+                indexed_chunks.extend(batch_indexed)
+
+                logger.debug(f"入库进度: {document.file_name}, 已写入 {progress.chunks_stored} 块, 进度 {task.progress}")
+
+            _stage_seconds["embed"].observe(embed_seconds)
+            _stage_seconds["store"].observe(store_seconds)
+            return indexed_chunks
+        finally:
+            stop.set()
+            embedder.cancel()
+            # 取消已发起但未消费的向量化请求
+            while not batch_queue.empty():
+                pending = batch_queue.get_nowait()
+                if isinstance(pending, tuple):
+                    pending[1].cancel()
+            await asyncio.gather(producer, embedder, return_exceptions=True)
+
+    def _parse_document(self, document: Document, chunker: TextChunker, progress: _Progress) -> List[TextChunk]:
+        """一次性解析并分块（增量入库需要完整的新文本块集合才能比对）"""
+        writer = _ParsedJsonWriter(f"{settings.STORAGE_DIR}/parsed/{document.id}.json")
+        try:
+            chunks = list(self._iter_document_chunks(document, chunker, progress, writer))
+        except BaseException:
+            writer.abort()
+            raise
+        progress.parse_done = True
+        writer.close(progress.metadata)
+        return chunks
+
+    async def _embed_all(self, texts: List[str]) -> list:
+        """分批向量化，最多 INGEST_PIPELINE_EMBED_INFLIGHT 批同时在途，结果保持输入顺序"""
+        size = settings.INGEST_PIPELINE_BATCH_SIZE
+        slots = asyncio.Semaphore(settings.INGEST_PIPELINE_EMBED_INFLIGHT)
+
+        async def embed(batch: List[str]):
+            async with slots:
+                return await llm_client.get_embeddings_batch(batch)
+
+        batches = await asyncio.gather(*(embed(texts[i:i + size]) for i in range(0, len(texts), size)))
+        return [result for batch in batches for result in batch]
+
+    async def run_incremental(
+        self,
+        db: Session,
+        task: IngestTask,
+        document: Document,
+        chunker: TextChunker,
+        written_chunk_ids: List[int]
+    ) -> Dict[str, int]:
+        """增量入库：按内容哈希比对新旧文本块，只向量化新增的文本块，删除已不存在的文本块
+
+        内容未变但页码/章节变化的文本块需要更新向量元数据，其向量通常可从向量缓存取得。
+        新插入的文本块ID追加到 written_chunk_ids，失败时由调用方清理。
+        """
+        progress = _Progress()
+        started = time.perf_counter()
+        chunks = await asyncio.to_thread(self._parse_document, document, chunker, progress)
+        _stage_seconds["parse"].observe(time.perf_counter() - started)
+        task.progress = 0.4
+        db.commit()
+
+        # 同一内容可能出现多次，按出现顺序一一对应
+        existing = db.query(
+            Chunk.id, Chunk.chunk_text, Chunk.chunk_index, Chunk.meta_json, Chunk.content_hash
+        ).filter(Chunk.document_id == document.id).order_by(Chunk.id).all()
+        existing_by_hash: Dict[str, deque] = defaultdict(deque)
+        for row in existing:
+            existing_by_hash[row.content_hash or content_hash(row.chunk_text)].append(row)
+
+        added: List[TextChunk] = []
+        updates: List[Dict[str, Any]] = []
+        relabeled: List[Tuple[int, TextChunk]] = []
+        for chunk in chunks:
+            rows = existing_by_hash.get(chunk.content_hash)
+            if not rows:
+                added.append(chunk)
+                continue
+            row = rows.popleft()
+            if row.chunk_index != chunk.index or row.meta_json != chunk.metadata or row.content_hash is None:
+                updates.append({
+                    "id": row.id,
+                    "chunk_index": chunk.index,
+                    "meta_json": chunk.metadata,
+                    "content_hash": chunk.content_hash
+                })
+            old_meta = row.meta_json or {}
+            if (
+                old_meta.get("section", "") != chunk.metadata.get("section", "")
+                or old_meta.get("page", 0) != chunk.metadata.get("page", 0)
+            ):
+                relabeled.append((row.id, chunk))
+        removed_ids = [row.id for rows in existing_by_hash.values() for row in rows]
+
+        started = time.perf_counter()
+        targets = added + [chunk for _, chunk in relabeled]
+        embeddings = await self._embed_all([chunk.text for chunk in targets])
+        _stage_seconds["embed"].observe(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        course_id = str(document.course_id)
+        if removed_ids:
+            db.query(Chunk).filter(Chunk.id.in_(removed_ids)).delete(synchronize_session=False)
+        if updates:
+            db.execute(update(Chunk), updates)
+        added_ids = self._insert_chunks(db, document, added) if added else []
+        written_chunk_ids.extend(added_ids)
+        task.progress = 0.9
+        # 与流式入库相同，先提交再改向量库：提交失败时旧文本块及其向量都保持不变，重试时仍能比对
+        db.commit()
+        
+        if removed_ids:
+            await self.vectordb.delete_by_ids(course_id, [str(chunk_id) for chunk_id in removed_ids])
+
+        target_ids = added_ids + [chunk_id for chunk_id, _ in relabeled]
+        vector_records = [
+            self._vector_record(document, chunk_id, chunk, embedding_result)
+            for chunk_id, chunk, embedding_result in zip(target_ids, targets, embeddings)
+        ]
+        if vector_records:
+            await self.vectordb.upsert(course_id, vector_records)
+        _stage_seconds["store"].observe(time.perf_counter() - started)
+
+        summary = {
+            "added": len(added),
+            "removed": len(removed_ids),
+            "unchanged": len(chunks) - len(added),
+            "relabeled": len(relabeled)
+        }
+        for kind, count in summary.items():
+            _incremental_chunks[kind].inc(count)
+        return summary
+
+    async def reconcile_vectors(self, db: Session, document: Document) -> Dict[str, int]:
+        """核对文档的文本块与向量库：补写缺失或章节/页码过期的向量，删除已没有文本块的向量
+
+        文本块先于向量提交，进程在两者之间退出时会留下没有向量的文本块（增量入库还会留下已删除
+        文本块的向量和过期的元数据）；中断的任务重试前调用，重新向量化通常命中向量缓存。
+        """
+        course_id = str(document.course_id)
+        stored = await self.vectordb.get_document_vectors(course_id, str(document.id))
+        rows = db.query(Chunk.id, Chunk.chunk_text, Chunk.meta_json).filter(Chunk.document_id == document.id).all()
+
+        row_ids = {str(row.id) for row in rows}
+        orphaned = [chunk_id for chunk_id in stored if chunk_id not in row_ids]
+        stale = []
+        for row in rows:
+            meta = stored.get(str(row.id))
+            row_meta = row.meta_json or {}
+            if (
+                meta is None
+                or meta.get("section", "") != row_meta.get("section", "")
+                or meta.get("page", 0) != row_meta.get("page", 0)
+            ):
+                stale.append(row)
+
+        if orphaned:
+            await self.vectordb.delete_by_ids(course_id, orphaned)
+        if stale:
+            embeddings = await self._embed_all([row.chunk_text for row in stale])
+            await self.vectordb.upsert(course_id, [
+                VectorRecord(
+                    chunk_id=str(row.id),
+                    course_id=course_id,
+                    document_id=str(document.id),
+                    section=(row.meta_json or {}).get("section", ""),
+                    page=(row.meta_json or {}).get("page", 0),
+                    chunk_text=row.chunk_text[:2000],
+                    embedding=embedding_result.embedding
+                )
+                for row, embedding_result in zip(stale, embeddings)
+            ])
+        return {"missing": len(stale), "orphaned": len(orphaned)}
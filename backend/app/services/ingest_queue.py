@@ -0,0 +1,262 @@
+import os
+import uuid
+import socket
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from sqlalchemy import or_
+
+from app.core.config import settings
+from app.core.metrics import metrics
+from app.db.session import SessionLocal
+from app.models.orm import IngestTask
+
+logger = logging.getLogger(__name__)
+
+_claimed = metrics.counter("ingest_queue_claimed_total", "入库队列领取的任务数")
+_requeued = metrics.counter("ingest_queue_requeued_total", "租约过期后重新排队的任务数")
+_lease_lost = metrics.counter("ingest_queue_lease_lost_total", "租约被接管后中止处理的任务数")
+_wait_seconds = metrics.histogram(
+    "ingest_queue_wait_seconds", "入库任务从入队到开始处理的等待时间",
+    buckets=(0.1, 0.5, 1.0, 5.0, 15.0, 30.0, 60.0, 300.0, 900.0)
+)
+
+# 任务处理函数：(task_id, document_id, chunk_policy_json, mode, attempts)
+IngestHandler = Callable[[str, int, Optional[Dict[str, Any]], str, int], Awaitable[None]]
+
+
+class IngestQueue:
+    """基于 ingest_tasks 表的持久化入库队列：工作者通过条件更新领取任务并持有租约"""
+
+    def __init__(self):
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self._handler: Optional[IngestHandler] = None
+        self._workers: List[asyncio.Task] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._active = 0
+        self._stopping = False
+        metrics.gauge("ingest_queue", self.stats, "入库队列状态")
+
+    @staticmethod
+    def _now() -> datetime:
+        return datetime.utcnow()
+
+    def _lease_deadline(self) -> datetime:
+        return self._now() + timedelta(seconds=settings.INGEST_QUEUE_LEASE_SECONDS)
+
+    def recover_stale_leases(self) -> int:
+        """租约已过期（或旧版本遗留、没有租约）的处理中任务重新排队，超过尝试次数则标记失败"""
+        db = SessionLocal()
+        try:
+            stale = db.query(IngestTask).filter(
+                IngestTask.status == "processing",
+                or_(IngestTask.lease_expires_at.is_(None), IngestTask.lease_expires_at < self._now())
+            ).all()
+            requeued = 0
+            for task in stale:
+                if (task.attempts or 0) >= settings.INGEST_QUEUE_MAX_ATTEMPTS:
+                    task.status = "failed"
+                    task.error_message = f"入库任务中断次数过多（{task.attempts} 次）"
+                else:
+                    task.status = "queued"
+                    requeued += 1
+                task.worker_id = None
+                task.lease_expires_at = None
+            db.commit()
+            if stale:
+                _requeued.inc(requeued)
+                logger.warning(f"恢复租约过期的入库任务: 重新排队 {requeued} 个, 失败 {len(stale) - requeued} 个")
+            return requeued
+        finally:
+            db.close()
+
+    def _claim(self) -> Optional[IngestTask]:
+        """按入队顺序领取一个任务；条件更新保证多个工作者（含其它进程）不会领取同一任务"""
+        db = SessionLocal()
+        try:
+            while True:
+                candidate = db.query(IngestTask).filter(
+                    IngestTask.status == "queued"
+                ).order_by(IngestTask.id).first()
+                if candidate is None:
+                    return None
+
+                now = self._now()
+                updated = db.query(IngestTask).filter(
+                    IngestTask.id == candidate.id,
+                    IngestTask.status == "queued"
+                ).update({
+                    IngestTask.status: "processing",
+                    IngestTask.worker_id: self.worker_id,
+                    IngestTask.lease_expires_at: self._lease_deadline(),
+                    IngestTask.attempts: IngestTask.attempts + 1,
+                    IngestTask.started_at: now
+                }, synchronize_session=False)
+                db.commit()
+                if updated:
+                    db.refresh(candidate)
+                    _claimed.inc()
+                    if candidate.created_at is not None:
+                        created_at = candidate.created_at.replace(tzinfo=None)
+                        _wait_seconds.observe(max(0.0, (now - created_at).total_seconds()))
+                    db.expunge(candidate)
+                    return candidate
+                # 已被其它工作者领取，继续找下一个
+        finally:
+            db.close()
+
+    def _renew_lease(self, task_id: str, attempts: int) -> bool:
+        """续约；任务已被重新排队或由其它工作者（含本进程的其它工作者）领取时返回 False"""
+        db = SessionLocal()
+        try:
+            # 领取时尝试次数加一，worker_id 与尝试次数都一致才是本次领取；处理函数已更新状态的任务仍属于本次领取
+            updated = db.query(IngestTask).filter(
+                IngestTask.task_id == task_id,
+                IngestTask.worker_id == self.worker_id,
+                IngestTask.attempts == attempts
+            ).update({IngestTask.lease_expires_at: self._lease_deadline()}, synchronize_session=False)
+            db.commit()
+            return bool(updated)
+        finally:
+            db.close()
+
+    def _release(self, task_id: str, attempts: int, requeue: bool = False):
+        """处理结束后清除租约；处理函数未能更新状态时标记失败，被取消时重新排队"""
+        db = SessionLocal()
+        try:
+            if requeue:
+                unfinished = {IngestTask.status: "queued", IngestTask.worker_id: None, IngestTask.lease_expires_at: None}
+            else:
+                unfinished = {IngestTask.status: "failed", IngestTask.error_message: "入库任务异常结束"}
+            db.query(IngestTask).filter(
+                IngestTask.task_id == task_id,
+                IngestTask.worker_id == self.worker_id,
+                IngestTask.attempts == attempts,
+                IngestTask.status == "processing"
+            ).update(unfinished, synchronize_session=False)
+            db.query(IngestTask).filter(
+                IngestTask.task_id == task_id,
+                IngestTask.worker_id == self.worker_id,
+                IngestTask.attempts == attempts
+            ).update({IngestTask.lease_expires_at: None}, synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    async def _keep_lease(self, task_id: str, attempts: int, job: asyncio.Task) -> bool:
+        """处理期间定期续约；租约已被接管时取消处理函数，避免两个工作者同时写同一文档"""
+        interval = max(1.0, settings.INGEST_QUEUE_LEASE_SECONDS / 3)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if not await asyncio.to_thread(self._renew_lease, task_id, attempts):
+                    logger.warning(f"入库任务租约已失效，停止处理: {task_id}")
+                    _lease_lost.inc()
+                    job.cancel()
+                    return True
+            except Exception as e:
+                logger.error(f"入库任务续约失败: {task_id}, {e}")
+
+    async def _process(self, task: IngestTask):
+        job = asyncio.create_task(
+            self._handler(task.task_id, task.document_id, task.chunk_policy_json, task.mode, task.attempts)
+        )
+        heartbeat = asyncio.create_task(self._keep_lease(task.task_id, task.attempts, job))
+        self._active += 1
+        requeue = False
+        try:
+            await job
+        except asyncio.CancelledError:
+            if not heartbeat.done() or self._stopping:
+                # 服务关闭，任务放回队列
+                requeue = True
+                raise
+            # 租约已被接管，任务由新的领取者处理（重试前清理本次已写入的文本块）
+        except Exception as e:
+            logger.error(f"入库任务处理异常: {task.task_id}, {e}")
+        finally:
+            self._active -= 1
+            heartbeat.cancel()
+            await asyncio.to_thread(self._release, task.task_id, task.attempts, requeue)
+
+    async def _worker(self, n: int):
+        if n == 0:
+            # 启动时回收上次运行遗留的过期租约
+            try:
+                if await asyncio.to_thread(self.recover_stale_leases):
+                    self.notify()
+            except Exception as e:
+                logger.error(f"回收过期租约失败: {e}")
+        while True:
+            try:
+                task = await asyncio.to_thread(self._claim)
+            except Exception as e:
+                logger.error(f"领取入库任务失败: {e}")
+                task = None
+
+            if task is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=settings.INGEST_QUEUE_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    # 轮询时顺带回收其它进程遗留的过期租约
+                    await asyncio.to_thread(self.recover_stale_leases)
+                continue
+
+            logger.info(f"工作者 {n} 领取入库任务: {task.task_id}（第 {task.attempts} 次）")
+            await self._process(task)
+
+    def ensure_started(self, handler: IngestHandler):
+        """在当前事件循环中启动工作者（重复调用无副作用）"""
+        self._workers = [worker for worker in self._workers if not worker.done()]
+        if self._workers:
+            return
+        self._handler = handler
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._workers = [
+            asyncio.create_task(self._worker(n)) for n in range(settings.INGEST_QUEUE_WORKERS)
+        ]
+        logger.info(f"入库队列已启动: {self.worker_id}, {settings.INGEST_QUEUE_WORKERS} 个工作者")
+
+    def notify(self):
+        """有新任务入队，唤醒空闲工作者"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def stop(self):
+        """停止工作者，处理中的任务放回队列（未能放回的在租约过期后由下次启动恢复）"""
+        self._stopping = True
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def queue_position(self, db, task: IngestTask) -> Optional[int]:
+        """排队中的任务前面还有多少个任务"""
+        if task.status != "queued":
+            return None
+        return db.query(IngestTask).filter(
+            IngestTask.status == "queued",
+            IngestTask.id < task.id
+        ).count()
+
+    def stats(self) -> Dict[str, Any]:
+        db = SessionLocal()
+        try:
+            queued = db.query(IngestTask).filter(IngestTask.status == "queued").count()
+            processing = db.query(IngestTask).filter(IngestTask.status == "processing").count()
+        finally:
+            db.close()
+        return {
+            "queued": queued,
+            "processing": processing,
+            "local_active": self._active,
+            "local_workers": len(self._workers)
+        }
+
+
+# 全局入库队列
+ingest_queue = IngestQueue()
@@ -1,24 +1,42 @@
+import io
 import os
+import time
 import uuid
-import json
+import inspect
+import hashlib
 import logging
 import asyncio
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 from pathlib import Path
+from dataclasses import dataclass
 from sqlalchemy.orm import Session
 
 from app.core.config import settings
 from app.core.exceptions import KBUploadFailedException, KBIngestFailedException, TaskNotFoundException
-from app.models.orm import Document, Chunk, IngestTask
-from app.models.schemas import ChunkPolicy
+from app.models.orm import Document, Chunk, IngestTask, KBGeneration
+from app.models.schemas import ChunkPolicy, IngestMode
 from app.kb.parser import DocumentParser
 from app.kb.chunker import TextChunker
-from app.kb.vectordb import create_vectordb_adapter, VectorRecord
+from app.kb.vectordb import create_vectordb_adapter
+from app.kb.lexical_index import lexical_index, reciprocal_rank_fusion
+from app.core.singleflight import SingleFlight
 from app.services.llm_client import llm_client
+from app.services.embedding_batcher import embedding_batcher
+from app.services.ingest_pipeline import StreamingIngestPipeline
+from app.services.ingest_queue import ingest_queue
+from app.services.query_planner import query_planner, QueryPlan, PLAN_HYBRID, PLAN_LEXICAL
 
 logger = logging.getLogger(__name__)
 
 
+@dataclass
+class PreparedSearch:
+    """已完成关键词检索与检索规划的查询；需要向量时已按预算取得查询向量"""
+    plan: QueryPlan
+    lexical_results: List[Dict[str, Any]]
+    query_embedding: Optional[List[float]]
+
+
 class KBService:
     """知识库服务"""
     
@@ -31,6 +49,8 @@ class KBService:
         self.embedding_fn = embedding_fn
         self.vectordb = create_vectordb_adapter(embedding_fn=None)  # 我们会在异步方法中处理embedding
         self.parser = DocumentParser()
+        self.ingest_pipeline = StreamingIngestPipeline(self.vectordb)
+        self._lexical_build_flight = SingleFlight("lexical_index_build")
     
     async def upload_document(
         self,
@@ -39,84 +59,297 @@ class KBService:
         file_name: str,
         file_content: bytes,
         file_type: str
-    ) -> Document:
-        """上传文档"""
+    ) -> Tuple[Document, bool]:
+        """上传文档；课程内已有相同内容的文档时直接返回该文档，第二个返回值表示是否去重"""
+        return await self.upload_document_stream(db, course_id, file_name, io.BytesIO(file_content), file_type)
+    
+    async def upload_document_stream(
+        self,
+        db: Session,
+        course_id: int,
+        file_name: str,
+        stream,
+        file_type: str
+    ) -> Tuple[Document, bool]:
+        """流式上传文档：按块写入临时文件并计算哈希、检查大小，完成后移动到存储目录"""
+        temp_path = None
         try:
             # 验证文件类型
             if file_type.lower() not in [ft.lower() for ft in settings.ALLOWED_FILE_TYPES]:
                 raise KBUploadFailedException(f"不支持的文件类型: {file_type}")
             
-            # 验证文件大小
-            if len(file_content) > settings.get_max_file_size_bytes():
-                raise KBUploadFailedException(
-                    f"文件过大: {len(file_content)} bytes, 最大允许: {settings.get_max_file_size_bytes()} bytes"
-                )
-            
-            # 生成存储路径
-            doc_id = str(uuid.uuid4())
-            storage_path = f"{settings.STORAGE_DIR}/raw/{course_id}/{doc_id}_{file_name}"
-            
-            # 确保目录存在
-            os.makedirs(os.path.dirname(storage_path), exist_ok=True)
-            
-            # 保存文件
-            with open(storage_path, 'wb') as f:
-                f.write(file_content)
-            
-            # 创建数据库记录
-            document = Document(
-                course_id=course_id,
-                file_name=file_name,
-                file_type=file_type,
-                storage_path=storage_path,
-                status="uploaded"
-            )
-            
-            db.add(document)
-            db.commit()
-            db.refresh(document)
-            
-            logger.info(f"文档上传成功: {file_name} -> {document.id}")
-            return document
+            temp_path, content_hash, _ = await self.receive_to_temp(stream)
+            return self.add_uploaded_file(db, course_id, file_name, file_type, temp_path, content_hash)
             
         except Exception as e:
             logger.error(f"文档上传失败: {e}")
             raise KBUploadFailedException(f"文档上传失败: {e}")
+        finally:
+            if temp_path and os.path.exists(temp_path):
+                os.remove(temp_path)
+    
+    async def receive_to_temp(self, stream) -> Tuple[str, str, int]:
+        """把上传流按块写入 storage/tmp，边写边计算 SHA-256 并检查大小；返回 (临时路径, 哈希, 字节数)
+        
+        stream 可以是 UploadFile（异步 read）或普通文件对象。
+        """
+        max_size = settings.get_max_file_size_bytes()
+        temp_dir = f"{settings.STORAGE_DIR}/tmp"
+        os.makedirs(temp_dir, exist_ok=True)
+        temp_path = f"{temp_dir}/{uuid.uuid4()}.part"
+        
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(temp_path, 'wb') as f:
+                while True:
+                    block = stream.read(settings.UPLOAD_BLOCK_SIZE)
+                    if inspect.isawaitable(block):
+                        block = await block
+                    if not block:
+                        break
+                    size += len(block)
+                    if size > max_size:
+                        raise KBUploadFailedException(f"文件过大: 超过 {max_size} bytes")
+                    digest.update(block)
+                    # 写盘放到线程中，慢磁盘不阻塞事件循环
+                    await asyncio.to_thread(f.write, block)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        return temp_path, digest.hexdigest(), size
+    
+    def add_uploaded_file(
+        self,
+        db: Session,
+        course_id: int,
+        file_name: str,
+        file_type: str,
+        temp_path: str,
+        content_hash: str
+    ) -> Tuple[Document, bool]:
+        """登记已完整接收的上传文件：重复内容复用已有文档，否则原子移动到 storage/raw/{course_id}/ 并创建文档记录"""
+        # 同课程内内容相同的文档不再重复保存和入库
+        duplicate = self.find_duplicate(db, course_id, content_hash)
+        if duplicate:
+            logger.info(f"文档内容重复，复用已有文档: {file_name} -> {duplicate.id}")
+            return duplicate, True
+        
+        storage_path = self._move_to_storage(course_id, file_name, temp_path)
+        
+        # 创建数据库记录
+        document = Document(
+            course_id=course_id,
+            file_name=file_name,
+            file_type=file_type,
+            storage_path=storage_path,
+            status="uploaded",
+            content_hash=content_hash
+        )
+        
+        db.add(document)
+        db.commit()
+        db.refresh(document)
+        
+        logger.info(f"文档上传成功: {file_name} -> {document.id}")
+        return document, False
+    
+    @staticmethod
+    def _move_to_storage(course_id: int, file_name: str, temp_path: str) -> str:
+        """临时文件与存储目录在同一文件系统，os.replace 为原子操作"""
+        storage_path = f"{settings.STORAGE_DIR}/raw/{course_id}/{uuid.uuid4()}_{file_name}"
+        os.makedirs(os.path.dirname(storage_path), exist_ok=True)
+        os.replace(temp_path, storage_path)
+        return storage_path
+    
+    async def replace_document(
+        self,
+        db: Session,
+        document: Document,
+        file_name: str,
+        stream,
+        file_type: str
+    ) -> bool:
+        """替换文档文件（之后按增量方式入库）；内容未变化时返回 False"""
+        if file_type.lower() != document.file_type.lower():
+            raise KBUploadFailedException(f"文件类型与原文档不一致: {file_type}")
+        
+        # 正在入库的任务仍会读取原文件
+        active_task = db.query(IngestTask).filter(
+            IngestTask.document_id == document.id,
+            IngestTask.status.in_(["queued", "processing"])
+        ).first()
+        if active_task:
+            raise KBUploadFailedException(f"文档正在入库，请稍后再替换: {active_task.task_id}")
+        
+        temp_path, content_hash, _ = await self.receive_to_temp(stream)
+        try:
+            if content_hash == document.content_hash:
+                logger.info(f"文档内容未变化: {document.id}")
+                return False
+            
+            old_path = document.storage_path
+            document.file_name = file_name
+            document.storage_path = self._move_to_storage(document.course_id, file_name, temp_path)
+            document.content_hash = content_hash
+            db.commit()
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        
+        if os.path.exists(old_path):
+            os.remove(old_path)
+        
+        logger.info(f"文档文件已替换: {document.id} -> {file_name}")
+        return True
+    
+    def find_duplicate(self, db: Session, course_id: int, content_hash: str) -> Optional[Document]:
+        """查找课程内内容相同且未入库失败的文档（走 course_id + content_hash 索引）"""
+        return db.query(Document).filter(
+            Document.course_id == course_id,
+            Document.content_hash == content_hash,
+            Document.status != "failed"
+        ).order_by(Document.id).first()
+    
+    def backfill_content_hashes(self) -> int:
+        """为旧版本上传、没有内容哈希的文档补算哈希"""
+        from app.db.session import SessionLocal
+        
+        db = SessionLocal()
+        try:
+            filled = 0
+            for document in db.query(Document).filter(Document.content_hash.is_(None)).all():
+                if not os.path.exists(document.storage_path):
+                    continue
+                digest = hashlib.sha256()
+                with open(document.storage_path, 'rb') as f:
+                    for block in iter(lambda: f.read(1024 * 1024), b""):
+                        digest.update(block)
+                document.content_hash = digest.hexdigest()
+                filled += 1
+            db.commit()
+            if filled:
+                logger.info(f"已补算 {filled} 个文档的内容哈希")
+            return filled
+        finally:
+            db.close()
     
     async def ingest_document(
         self,
         db: Session,
         document_id: int,
-        chunk_policy: Optional[ChunkPolicy] = None
+        chunk_policy: Optional[ChunkPolicy] = None,
+        mode: IngestMode = IngestMode.FULL,
+        force: bool = False
     ) -> str:
-        """异步入库文档"""
+        """异步入库文档；incremental 模式与已有文本块比对，只处理变化的部分"""
+        # 去重上传返回的文档可能已入库或正在入库，不再重复处理；force 时已入库的文档仍重新处理
+        active_task = db.query(IngestTask).filter(
+            IngestTask.document_id == document_id,
+            IngestTask.status.in_(["queued", "processing"])
+        ).order_by(IngestTask.id.desc()).first()
+        if active_task:
+            logger.info(f"文档已在入库队列中: {document_id} -> {active_task.task_id}")
+            return active_task.task_id
+        
+        document = db.query(Document).filter(Document.id == document_id).first()
+        already_ready = (
+            not force and document is not None and document.status == "ready"
+            and chunk_policy is None and mode == IngestMode.FULL
+        )
+        
         # 创建任务记录
         task_id = str(uuid.uuid4())
         task = IngestTask(
             task_id=task_id,
             document_id=document_id,
-            status="queued"
+            status="done" if already_ready else "queued",
+            progress=1.0 if already_ready else 0.0,
+            chunk_policy_json=chunk_policy.model_dump(mode="json", exclude_unset=True) if chunk_policy else None,
+            mode=IngestMode(mode).value
         )
         
         db.add(task)
         db.commit()
         
-        # 启动后台任务
-        asyncio.create_task(self._ingest_document_task(task_id, document_id, chunk_policy))
+        if already_ready:
+            logger.info(f"文档已入库，无需重复处理: {document_id}")
+            return task_id
+        
+        # 放入持久化队列，由工作者领取处理
+        ingest_queue.ensure_started(self.run_ingest_job)
+        ingest_queue.notify()
         
         logger.info(f"文档入库任务创建: {task_id}")
         return task_id
     
+    async def run_ingest_job(
+        self,
+        task_id: str,
+        document_id: int,
+        chunk_policy_json: Optional[Dict[str, Any]],
+        mode: str,
+        attempts: int
+    ):
+        """处理队列领取的入库任务"""
+        if attempts > 1:
+            await self._discard_interrupted_attempt(task_id, document_id)
+            await self._reconcile_vectors(document_id)
+        chunk_policy = ChunkPolicy(**chunk_policy_json) if chunk_policy_json else None
+        await self._ingest_document_task(task_id, document_id, chunk_policy, IngestMode(mode or IngestMode.FULL))
+    
+    async def _discard_interrupted_attempt(self, task_id: str, document_id: int):
+        """任务中断后重试前，清理上次尝试已提交的文本块（创建时间不早于任务入队时间）"""
+        from app.db.session import SessionLocal
+        
+        db = SessionLocal()
+        try:
+            document = db.query(Document).filter(Document.id == document_id).first()
+            if not document:
+                return
+            enqueued_at = db.query(IngestTask.created_at).filter(IngestTask.task_id == task_id).scalar_subquery()
+            chunk_ids = [
+                chunk_id for (chunk_id,) in db.query(Chunk.id).filter(
+                    Chunk.document_id == document_id,
+                    Chunk.created_at >= enqueued_at
+                )
+            ]
+            if chunk_ids:
+                await self._discard_chunks(db, document, chunk_ids)
+        finally:
+            db.close()
+    
+    async def _reconcile_vectors(self, document_id: int):
+        """任务中断后，补齐已提交文本块缺失的向量并清理多余的向量"""
+        from app.db.session import SessionLocal
+        
+        db = SessionLocal()
+        try:
+            document = db.query(Document).filter(Document.id == document_id).first()
+            if not document:
+                return
+            summary = await self.ingest_pipeline.reconcile_vectors(db, document)
+            if summary["missing"] or summary["orphaned"]:
+                logger.warning(
+                    f"入库中断后核对向量: 文档 {document_id}, 补写 {summary['missing']} 条, 删除 {summary['orphaned']} 条"
+                )
+        finally:
+            db.close()
+    
     async def _ingest_document_task(
         self,
         task_id: str,
         document_id: int,
-        chunk_policy: Optional[ChunkPolicy] = None
+        chunk_policy: Optional[ChunkPolicy] = None,
+        mode: IngestMode = IngestMode.FULL
     ):
         """文档入库任务"""
         from app.db.session import SessionLocal
         
         db = SessionLocal()
+        task = None
+        document = None
+        written_chunk_ids: List[int] = []
         try:
             # 更新任务状态
             task = db.query(IngestTask).filter(IngestTask.task_id == task_id).first()
@@ -132,80 +365,50 @@ class KBService:
             if not document:
                 raise Exception("文档不存在")
             
-            # 解析文档
-            logger.info(f"开始解析文档: {document.file_name}")
-            parsed_doc = self.parser.parse_file(document.storage_path, document.file_type)
-            
-            # 保存解析结果
-            parsed_path = f"{settings.STORAGE_DIR}/parsed/{document_id}.json"
-            os.makedirs(os.path.dirname(parsed_path), exist_ok=True)
-            with open(parsed_path, 'w', encoding='utf-8') as f:
-                json.dump(parsed_doc, f, ensure_ascii=False, indent=2)
-            
-            task.progress = 0.3
-            db.commit()
-            
-            # 文本分块
-            logger.info(f"开始文本分块: {document.file_name}")
-            chunker = TextChunker(
-                chunk_size=chunk_policy.max_chars if chunk_policy else settings.CHUNK_SIZE,
-                overlap=chunk_policy.overlap if chunk_policy else settings.CHUNK_OVERLAP
-            )
-            chunks = chunker.chunk_document(parsed_doc)
-            
-            task.progress = 0.5
-            db.commit()
+            chunker = TextChunker.from_policy(chunk_policy)
             
-            # 向量化
-            logger.info(f"开始向量化: {len(chunks)} 个文本块")
-            chunk_texts = [chunk.text for chunk in chunks]
-            embeddings = await llm_client.get_embeddings_batch(chunk_texts)
-            
-            task.progress = 0.7
-            db.commit()
-            
-            # 保存到数据库和向量库
-            logger.info(f"保存到数据库和向量库")
-            vector_records = []
-            
-            for i, (chunk, embedding_result) in enumerate(zip(chunks, embeddings)):
-                # 保存到关系数据库
-                chunk_record = Chunk(
-                    document_id=document_id,
-                    course_id=document.course_id,
-                    chunk_index=chunk.index,
-                    chunk_text=chunk.text,
-                    meta_json=chunk.metadata
-                )
-                db.add(chunk_record)
-                db.flush()  # 获取ID
+            if mode == IngestMode.INCREMENTAL:
+                # 增量入库：只向量化新增的文本块，删除已不存在的文本块
+                logger.info(f"开始增量入库: {document.file_name}")
+                summary = await self.ingest_pipeline.run_incremental(db, task, document, chunker, written_chunk_ids)
                 
-                # 准备向量记录
-                vector_record = VectorRecord(
-                    chunk_id=str(chunk_record.id),
-                    course_id=str(document.course_id),
-                    document_id=str(document_id),
-                    section=chunk.metadata.get("section", ""),
-                    page=chunk.metadata.get("page", 0),
-                    chunk_text=chunk.text[:2000],  # 限制长度
-                    embedding=embedding_result.embedding  # 使用获取的embedding
+                document.status = "ready"
+                task.status = "done"
+                task.progress = 1.0
+                self.bump_kb_generation(db, document.course_id)
+                
+                db.commit()
+                # 有删除和修改，倒排索引下次检索时重建
+                lexical_index.invalidate(document.course_id)
+                
+                logger.info(
+                    f"文档增量入库完成: {document.file_name}, 新增 {summary['added']}, 删除 {summary['removed']}, "
+                    f"未变化 {summary['unchanged']}（其中页码/章节变化 {summary['relabeled']}）"
                 )
-                vector_records.append(vector_record)
+                return
             
-            # 批量插入向量库
-            await self.vectordb.upsert(str(document.course_id), vector_records)
+            # 流式入库：解析、分块、向量化、写库各阶段重叠进行，每批写入后更新进度
+            logger.info(f"开始流式入库: {document.file_name}")
+            indexed_chunks = await self.ingest_pipeline.run(db, task, document, chunker, written_chunk_ids)
             
             # 更新文档状态
             document.status = "ready"
             task.status = "done"
             task.progress = 1.0
+            generation = self.bump_kb_generation(db, document.course_id)
             
             db.commit()
+            await asyncio.to_thread(lexical_index.add_chunks, document.course_id, generation, indexed_chunks)
             
-            logger.info(f"文档入库完成: {document.file_name}, {len(chunks)} 个文本块")
+            logger.info(f"文档入库完成: {document.file_name}, {len(indexed_chunks)} 个文本块")
             
         except Exception as e:
             logger.error(f"文档入库失败: {e}")
+            db.rollback()
+            
+            # 流水线按批提交，清理本次已写入的文本块和向量
+            if written_chunk_ids:
+                await self._discard_chunks(db, document, written_chunk_ids)
             
             # 更新任务状态
             if task:
@@ -213,14 +416,32 @@ class KBService:
                 task.error_message = str(e)
                 db.commit()
             
-            # 更新文档状态
+            # 更新文档状态（可能已写入部分向量，同样使缓存失效）
             if document:
                 document.status = "failed"
+                generation = self.bump_kb_generation(db, document.course_id)
                 db.commit()
+                if mode == IngestMode.INCREMENTAL:
+                    # 增量入库可能已删除或修改部分文本块
+                    lexical_index.invalidate(document.course_id)
+                else:
+                    # 本次写入的文本块已清理，倒排索引内容不变，只推进版本
+                    lexical_index.add_chunks(document.course_id, generation, [])
                 
         finally:
             db.close()
     
+    async def _discard_chunks(self, db: Session, document: Document, chunk_ids: List[int]):
+        """删除入库失败时已写入的文本块及其向量"""
+        try:
+            await self.vectordb.delete_by_ids(str(document.course_id), [str(chunk_id) for chunk_id in chunk_ids])
+            db.query(Chunk).filter(Chunk.id.in_(chunk_ids)).delete(synchronize_session=False)
+            db.commit()
+            logger.info(f"已清理入库失败的文本块: 文档 {document.id}, {len(chunk_ids)} 块")
+        except Exception as e:
+            logger.error(f"清理入库失败的文本块出错: {e}")
+            db.rollback()
+    
     async def get_task_status(self, db: Session, task_id: str) -> Dict[str, Any]:
         """获取任务状态"""
         task = db.query(IngestTask).filter(IngestTask.task_id == task_id).first()
@@ -232,46 +453,196 @@ class KBService:
             "task_id": task.task_id,
             "status": task.status,
             "progress": task.progress,
-            "error": task.error_message
+            "error": task.error_message,
+            "queue_position": ingest_queue.queue_position(db, task)
         }
     
+    def get_kb_generation(self, db: Session, course_id: int) -> int:
+        """获取课程知识库版本号"""
+        record = db.query(KBGeneration).filter(KBGeneration.course_id == course_id).first()
+        return record.generation if record else 0
+    
+    def bump_kb_generation(self, db: Session, course_id: int) -> int:
+        """递增课程知识库版本号（随调用方事务提交），使依赖旧版本的缓存失效"""
+        updated = db.query(KBGeneration).filter(KBGeneration.course_id == course_id).update(
+            {KBGeneration.generation: KBGeneration.generation + 1},
+            synchronize_session=False
+        )
+        if not updated:
+            db.add(KBGeneration(course_id=course_id, generation=1))
+        db.flush()
+        return self.get_kb_generation(db, course_id)
+    
+    def _refresh_lexical_index_sync(self, course_id: int):
+        """倒排索引版本落后于知识库时全量重建（其它进程导入数据后也能感知）"""
+        from app.db.session import SessionLocal
+        
+        db = SessionLocal()
+        try:
+            generation = self.get_kb_generation(db, course_id)
+            if not lexical_index.is_current(course_id, generation):
+                lexical_index.build(db, course_id, generation)
+        finally:
+            db.close()
+    
+    async def _ensure_lexical_index(self, course_id: int):
+        """确保课程倒排索引为最新（并发请求共享一次构建）"""
+        await self._lexical_build_flight.do(
+            course_id, lambda: asyncio.to_thread(self._refresh_lexical_index_sync, course_id)
+        )
+    
+    async def _embed_query(self, query: str, plan, allow_fallback: bool) -> Optional[List[float]]:
+        """获取查询向量；有关键词结果可退回时最多等待预算时间，超时或失败返回None"""
+        started = time.perf_counter()
+        task = asyncio.ensure_future(embedding_batcher.embed(query))
+        query_planner.observe_embedding(task, started)
+        try:
+            if allow_fallback:
+                # 超时后请求继续在后台完成并写入向量缓存
+                result = await asyncio.wait_for(
+                    asyncio.shield(task), settings.QUERY_PLANNER_EMBEDDING_BUDGET_MS / 1000
+                )
+            else:
+                result = await task
+        except Exception as e:
+            if not allow_fallback:
+                raise
+            logger.warning(f"查询向量化超时或失败，退回关键词检索: {type(e).__name__} {e}")
+            plan.mode = PLAN_LEXICAL
+            plan.fallback = True
+            return None
+        
+        plan.embedding_seconds = time.perf_counter() - started
+        return result.embedding
+    
+    async def prepare_search(
+        self,
+        course_id: int,
+        query: str,
+        top_k: int = 12,
+        filters: Optional[Dict[str, Any]] = None
+    ) -> PreparedSearch:
+        """关键词检索并选择检索方式；计划需要向量时才向量化（有关键词结果可退回时受延迟预算限制）"""
+        started = time.perf_counter()
+        lexical_results = []
+        query_embedding = None
+        if settings.LEXICAL_INDEX_ENABLED:
+            await self._ensure_lexical_index(course_id)
+            lexical_results = await asyncio.to_thread(lexical_index.search, course_id, query, top_k, filters)
+            # 查询向量已在本地缓存时，混合检索不需要调用接口
+            query_embedding = await llm_client.get_cached_embedding(query)
+        
+        plan = query_planner.plan(query, lexical_results, has_embedding=query_embedding is not None, started_at=started)
+        if plan.needs_embedding and query_embedding is None:
+            query_embedding = await self._embed_query(query, plan, allow_fallback=bool(lexical_results))
+        return PreparedSearch(plan, lexical_results, query_embedding)
+    
     async def search_knowledge(
         self,
         course_id: int,
         query: str,
         top_k: int = 12,
+        filters: Optional[Dict[str, Any]] = None,
+        prepared: Optional[PreparedSearch] = None
+    ) -> List[Dict[str, Any]]:
+        """搜索知识库：由检索规划器选择关键词、向量或混合检索（混合结果按倒数排名融合）"""
+        try:
+            if prepared is None:
+                prepared = await self.prepare_search(course_id, query, top_k, filters)
+            plan = prepared.plan
+            
+            results = prepared.lexical_results
+            if plan.needs_embedding and prepared.query_embedding is not None:
+                vector_results = await self._vector_search(course_id, prepared.query_embedding, top_k, filters)
+                if plan.mode == PLAN_HYBRID:
+                    results = reciprocal_rank_fusion([vector_results, prepared.lexical_results], top_k)
+                else:
+                    results = vector_results
+            
+            query_planner.record(plan, query, len(results))
+            return results
+            
+        except Exception as e:
+            logger.error(f"知识检索失败: {e}")
+            raise KBIngestFailedException(f"知识检索失败: {e}")
+    
+    async def _vector_search(
+        self,
+        course_id: int,
+        query_embedding: List[float],
+        top_k: int,
         filters: Optional[Dict[str, Any]] = None
     ) -> List[Dict[str, Any]]:
-        """搜索知识库"""
+        """向量检索并转换为统一结果格式"""
+        hits = await self.vectordb.query(
+            course_id=str(course_id),
+            query_embedding=query_embedding,
+            top_k=top_k,
+            filters=filters
+        )
+        return [self._hit_to_result(hit) for hit in hits]
+    
+    @staticmethod
+    def _hit_to_result(hit) -> Dict[str, Any]:
+        """VectorHit 转换为检索结果"""
+        return {
+            "chunk_id": int(hit.chunk_id),
+            "score": hit.score,
+            "document_id": int(hit.metadata["document_id"]),
+            "meta": hit.metadata,
+            "snippet": hit.chunk_text[:200] + "..." if len(hit.chunk_text) > 200 else hit.chunk_text
+        }
+    
+    async def search_knowledge_batch(
+        self,
+        course_id: int,
+        queries: List[str],
+        top_k: int = 12,
+        filters: Optional[Dict[str, Any]] = None
+    ) -> List[List[Dict[str, Any]]]:
+        """批量搜索知识库：需要向量的查询合并为一次批量向量化和一次多向量检索，结果按查询顺序分组"""
+        started = time.perf_counter()
         try:
-            # 获取查询向量
-            embedding_result = await llm_client.get_embedding(query)
+            lexical_results = [[] for _ in queries]
+            if settings.LEXICAL_INDEX_ENABLED:
+                await self._ensure_lexical_index(course_id)
+                lexical_results = await asyncio.to_thread(
+                    lexical_index.search_batch, course_id, queries, top_k, filters
+                )
             
-            # 向量检索 - 使用embedding而不是文本，因为我们的ChromaAdapter需要embedding
-            hits = await self.vectordb.query(
-                course_id=str(course_id),
-                query_embedding=embedding_result.embedding,
-                top_k=top_k,
-                filters=filters
+            plans = [
+                query_planner.plan(query, lexical, has_embedding=False, started_at=started)
+                for query, lexical in zip(queries, lexical_results)
+            ]
+            results = list(lexical_results)
+            
+            pending = [i for i, plan in enumerate(plans) if plan.needs_embedding]
+            if pending:
+                embeddings = await llm_client.get_embeddings_batch([queries[i] for i in pending])
+                hit_groups = await self.vectordb.query_batch(
+                    str(course_id),
+                    [result.embedding for result in embeddings],
+                    top_k=top_k,
+                    filters=filters
+                )
+                for i, hits in zip(pending, hit_groups):
+                    vector_results = [self._hit_to_result(hit) for hit in hits]
+                    if plans[i].mode == PLAN_HYBRID:
+                        results[i] = reciprocal_rank_fusion([vector_results, lexical_results[i]], top_k)
+                    else:
+                        results[i] = vector_results
+            
+            for query, plan, query_results in zip(queries, plans, results):
+                query_planner.record(plan, query, len(query_results))
+            logger.info(
+                f"批量知识检索完成: {len(queries)} 个查询, 向量检索 {len(pending)} 个, "
+                f"耗时 {(time.perf_counter() - started) * 1000:.0f}ms"
             )
-            
-            # 转换结果格式
-            results = []
-            for hit in hits:
-                results.append({
-                    "chunk_id": int(hit.chunk_id),
-                    "score": hit.score,
-                    "document_id": int(hit.metadata["document_id"]),
-                    "meta": hit.metadata,
-                    "snippet": hit.chunk_text[:200] + "..." if len(hit.chunk_text) > 200 else hit.chunk_text
-                })
-            
-            logger.info(f"知识检索完成: 查询='{query}', 结果数={len(results)}")
             return results
             
         except Exception as e:
-            logger.error(f"知识检索失败: {e}")
-            raise KBIngestFailedException(f"知识检索失败: {e}")
+            logger.error(f"批量知识检索失败: {e}")
+            raise KBIngestFailedException(f"批量知识检索失败: {e}")
     
     async def delete_document(self, db: Session, document_id: int):
         """删除文档"""
@@ -288,6 +659,7 @@ class KBService:
             
             # 删除文档记录
             db.delete(document)
+            generation = self.bump_kb_generation(db, document.course_id)
             
             # 删除文件
             if os.path.exists(document.storage_path):
@@ -298,6 +670,7 @@ class KBService:
                 os.remove(parsed_path)
             
             db.commit()
+            await asyncio.to_thread(lexical_index.remove_document, document.course_id, generation, document_id)
             
             logger.info(f"文档删除成功: {document_id}")
             
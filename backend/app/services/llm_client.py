@@ -1,14 +1,26 @@
 import openai
 import httpx
+import asyncio
 import logging
+import time
 from typing import List, Dict, Any, AsyncGenerator, Optional
 from dataclasses import dataclass
 
 from app.core.config import settings
 from app.core.exceptions import LLMException
+from app.core.metrics import metrics
+from app.kb.tokenizer import token_counter, embedding_token_limit
+from app.services.embedding_cache import embedding_cache
 
 logger = logging.getLogger(__name__)
 
+_stream_ttft = metrics.histogram("llm_stream_ttft_seconds", "流式生成首个token耗时")
+_stream_duration = metrics.histogram("llm_stream_duration_seconds", "流式生成总耗时")
+_stream_aborted = metrics.counter("llm_stream_aborted_total", "被提前终止的流式生成")
+_embedding_texts = metrics.counter("embedding_texts_total", "批量向量化的文本条数")
+_embedding_retries = metrics.counter("embedding_batch_retries_total", "因429/413拆分重试的批次数")
+_embedding_request_seconds = metrics.histogram("embedding_request_seconds", "单次向量化请求耗时")
+
 
 @dataclass
 class EmbeddingResult:
@@ -16,6 +28,7 @@ class EmbeddingResult:
     embedding: List[float]
     model: str
     usage: Dict[str, int]
+    cached: bool = False
 
 
 @dataclass
@@ -46,14 +59,36 @@ class SiliconFlowClient:
     """硅基流动客户端"""
     
     def __init__(self):
-        self.client = openai.OpenAI(
-            api_key=settings.SILICONFLOW_API_KEY,
-            base_url=settings.SILICONFLOW_BASE_URL
-        )
+        # 共享的异步连接池：embedding、chat、rerank 复用同一组 keep-alive 连接
         self.http_client = httpx.AsyncClient(
-            timeout=settings.REQUEST_TIMEOUT,
+            timeout=httpx.Timeout(settings.REQUEST_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=settings.LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.LLM_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=settings.LLM_KEEPALIVE_EXPIRY
+            ),
             headers={"Authorization": f"Bearer {settings.SILICONFLOW_API_KEY}"}
         )
+        self.client = openai.AsyncOpenAI(
+            api_key=settings.SILICONFLOW_API_KEY,
+            base_url=settings.SILICONFLOW_BASE_URL,
+            timeout=settings.REQUEST_TIMEOUT,
+            http_client=self.http_client
+        )
+        self.last_embedding_throughput = 0.0
+        metrics.gauge(
+            "embedding_throughput_per_second",
+            lambda: round(self.last_embedding_throughput, 2),
+            "最近一次批量向量化的吞吐（条/秒）"
+        )
+    
+    @staticmethod
+    def _truncate_for_embedding(text: str, warn: bool = True) -> str:
+        """按向量模型的 token 上限截断（按 token 分块的文本块不会被截断）"""
+        truncated = token_counter.truncate(text, embedding_token_limit())
+        if warn and len(truncated) < len(text):
+            logger.warning(f"文本超出向量模型输入上限，已截断: {len(text)} -> {len(truncated)} 字符")
+        return truncated
     
     async def get_embedding(self, text: str, model: str = None) -> EmbeddingResult:
         """获取文本向量"""
@@ -61,20 +96,22 @@ class SiliconFlowClient:
             model = settings.EMBEDDING_MODEL
         
         try:
-            # 截断过长的文本（512 tokens ≈ 1024 中文字符）
-            # 更保守的限制：400 字符（约 200 tokens）
-            max_chars = 400
-            if len(text) > max_chars:
-                text = text[:max_chars]
-                logger.warning(f"文本过长，已截断到 {max_chars} 字符")
+            text = self._truncate_for_embedding(text)
+            
+            cached = (await embedding_cache.get_many(model, [text]))[0]
+            if cached is not None:
+                return EmbeddingResult(embedding=cached, model=model, usage={}, cached=True)
             
-            response = self.client.embeddings.create(
+            response = await self.client.embeddings.create(
                 model=model,
                 input=[text]
             )
             
+            embedding = response.data[0].embedding
+            await embedding_cache.put_many(model, [text], [embedding])
+            
             return EmbeddingResult(
-                embedding=response.data[0].embedding,
+                embedding=embedding,
                 model=model,
                 usage=response.usage.model_dump() if response.usage else {}
             )
@@ -83,48 +120,146 @@ class SiliconFlowClient:
             logger.error(f"获取向量失败: {e}")
             raise LLMException(f"向量化失败: {e}")
     
+    async def get_cached_embedding(self, text: str, model: str = None) -> Optional[List[float]]:
+        """只查本地缓存，不请求API（未命中返回None）"""
+        model = model or settings.EMBEDDING_MODEL
+        return (await embedding_cache.get_many(model, [self._truncate_for_embedding(text, warn=False)]))[0]
+    
     async def get_embeddings_batch(self, texts: List[str], model: str = None) -> List[EmbeddingResult]:
-        """批量获取文本向量"""
+        """批量获取文本向量（先查本地缓存，未命中部分再请求API，结果保持输入顺序）"""
         if model is None:
             model = settings.EMBEDDING_MODEL
         
+        if not texts:
+            return []
+        
+        truncated_texts = [self._truncate_for_embedding(text) for text in texts]
+        
+        results: List[Optional[EmbeddingResult]] = [None] * len(truncated_texts)
+        cached_vectors = await embedding_cache.get_many(model, truncated_texts)
+        
+        # 未命中的文本去重后再请求
+        missing: Dict[str, List[int]] = {}
+        for i, (text, vector) in enumerate(zip(truncated_texts, cached_vectors)):
+            if vector is not None:
+                results[i] = EmbeddingResult(embedding=vector, model=model, usage={}, cached=True)
+            else:
+                missing.setdefault(text, []).append(i)
+        
+        if missing:
+            missing_texts = list(missing)
+            fetched = await self._fetch_embeddings(missing_texts, model)
+            for text, result in zip(missing_texts, fetched):
+                for i in missing[text]:
+                    results[i] = result
+            await embedding_cache.put_many(model, missing_texts, [result.embedding for result in fetched])
+        
+        hits = sum(1 for vector in cached_vectors if vector is not None)
+        if hits:
+            logger.info(f"向量缓存命中: {hits}/{len(texts)}")
+        
+        return results
+    
+    async def _fetch_embeddings(self, truncated_texts: List[str], model: str) -> List[EmbeddingResult]:
+        """请求API获取向量（多批并发，按文本总长度分批，结果保持输入顺序）"""
+        batches = self._plan_embedding_batches(truncated_texts)
+        results: List[Optional[EmbeddingResult]] = [None] * len(truncated_texts)
+        semaphore = asyncio.Semaphore(settings.EMBEDDING_MAX_CONCURRENCY)
+        start_time = time.perf_counter()
+        
+        tasks = [
+            asyncio.create_task(self._embed_batch_adaptive(truncated_texts, indices, model, results, semaphore))
+            for indices in batches
+        ]
         try:
-            # 截断过长的文本（512 tokens ≈ 1024 中文字符）
-            # 更保守的限制：400 字符（约 200 tokens）
-            max_chars = 400
-            truncated_texts = []
-            for text in texts:
-                if len(text) > max_chars:
-                    truncated_text = text[:max_chars]
-                    logger.warning(f"文本过长，已截断: {len(text)} -> {max_chars} 字符")
-                    truncated_texts.append(truncated_text)
-                else:
-                    truncated_texts.append(text)
-            
-            # 分批处理，避免单次请求过大
-            batch_size = min(settings.EMBEDDING_BATCH_SIZE, 16)  # 限制批量大小
-            results = []
-            
-            for i in range(0, len(truncated_texts), batch_size):
-                batch_texts = truncated_texts[i:i + batch_size]
-                
-                response = self.client.embeddings.create(
+            await asyncio.gather(*tasks)
+        except Exception as e:
+            for task in tasks:
+                task.cancel()
+            logger.error(f"批量获取向量失败: {e}")
+            raise LLMException(f"批量向量化失败: {e}")
+        
+        elapsed = time.perf_counter() - start_time
+        self.last_embedding_throughput = len(truncated_texts) / elapsed if elapsed > 0 else 0.0
+        _embedding_texts.inc(len(truncated_texts))
+        logger.info(
+            f"批量向量化完成: {len(truncated_texts)} 条, {len(batches)} 批, 耗时 {elapsed:.2f}s, "
+            f"{self.last_embedding_throughput:.1f} 条/秒"
+        )
+        
+        return results
+    
+    def _plan_embedding_batches(self, texts: List[str]) -> List[List[int]]:
+        """按条数上限和字符总量上限划分批次，返回每批的下标列表"""
+        max_count = max(1, settings.EMBEDDING_BATCH_SIZE)
+        max_chars = max(1, settings.EMBEDDING_BATCH_MAX_CHARS)
+        
+        batches = []
+        current: List[int] = []
+        current_chars = 0
+        for i, text in enumerate(texts):
+            if current and (len(current) >= max_count or current_chars + len(text) > max_chars):
+                batches.append(current)
+                current = []
+                current_chars = 0
+            current.append(i)
+            current_chars += len(text)
+        if current:
+            batches.append(current)
+        
+        return batches
+    
+    async def _embed_batch_adaptive(
+        self,
+        texts: List[str],
+        indices: List[int],
+        model: str,
+        results: List[Optional[EmbeddingResult]],
+        semaphore: asyncio.Semaphore,
+        attempt: int = 0
+    ):
+        """发送一批向量化请求；遇到429/413时拆分批次并重试"""
+        async with semaphore:
+            request_start = time.perf_counter()
+            try:
+                response = await self.client.embeddings.create(
                     model=model,
-                    input=batch_texts
+                    input=[texts[i] for i in indices]
                 )
-                
-                for j, data in enumerate(response.data):
-                    results.append(EmbeddingResult(
+            except openai.APIStatusError as e:
+                if e.status_code not in (413, 429):
+                    raise
+                error = e
+            else:
+                _embedding_request_seconds.observe(time.perf_counter() - request_start)
+                usage = response.usage.model_dump() if response.usage else {}
+                for i, data in zip(indices, sorted(response.data, key=lambda d: d.index)):
+                    results[i] = EmbeddingResult(
                         embedding=data.embedding,
                         model=model,
-                        usage=response.usage.model_dump() if response.usage else {}
-                    ))
-            
-            return results
-            
-        except Exception as e:
-            logger.error(f"批量获取向量失败: {e}")
-            raise LLMException(f"批量向量化失败: {e}")
+                        usage=usage
+                    )
+                return
+        
+        # 释放并发名额后再退避、拆分重试；已达重试上限时直接抛出，不计入重试次数
+        if attempt >= settings.EMBEDDING_MAX_RETRIES:
+            raise error
+        _embedding_retries.inc()
+        
+        if error.status_code == 429:
+            await asyncio.sleep(min(0.5 * (2 ** attempt), 8.0))
+        
+        if len(indices) > 1:
+            mid = len(indices) // 2
+            logger.warning(f"向量化请求返回 {error.status_code}，批次拆分: {len(indices)} -> {mid} + {len(indices) - mid}")
+            await asyncio.gather(
+                self._embed_batch_adaptive(texts, indices[:mid], model, results, semaphore, attempt + 1),
+                self._embed_batch_adaptive(texts, indices[mid:], model, results, semaphore, attempt + 1)
+            )
+        elif error.status_code == 429:
+            await self._embed_batch_adaptive(texts, indices, model, results, semaphore, attempt + 1)
+        else:
+            raise error
     
     async def chat_completion(
         self,
@@ -144,7 +279,7 @@ class SiliconFlowClient:
             if stream:
                 return await self._chat_completion_stream(message_dicts, model, temperature, max_tokens)
             else:
-                response = self.client.chat.completions.create(
+                response = await self.client.chat.completions.create(
                     model=model,
                     messages=message_dicts,
                     temperature=temperature,
@@ -173,24 +308,44 @@ class SiliconFlowClient:
         if model is None:
             model = settings.LLM_MODEL
         
+        message_dicts = [{"role": msg.role, "content": msg.content} for msg in messages]
+        start_time = time.perf_counter()
+        
         try:
-            message_dicts = [{"role": msg.role, "content": msg.content} for msg in messages]
-            
-            stream = self.client.chat.completions.create(
+            stream = await self.client.chat.completions.create(
                 model=model,
                 messages=message_dicts,
                 temperature=temperature,
                 max_tokens=max_tokens,
                 stream=True
             )
-            
-            for chunk in stream:
-                if chunk.choices[0].delta.content is not None:
-                    yield chunk.choices[0].delta.content
+        except Exception as e:
+            logger.error(f"流式聊天补全失败: {e}")
+            raise LLMException(f"流式LLM调用失败: {e}")
+        
+        first_token_at = None
+        completed = False
+        try:
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                        _stream_ttft.observe(first_token_at - start_time)
+                    yield delta
+            completed = True
                     
         except Exception as e:
             logger.error(f"流式聊天补全失败: {e}")
             raise LLMException(f"流式LLM调用失败: {e}")
+        finally:
+            # 消费方提前停止迭代时，关闭上游响应以终止生成并归还连接
+            await stream.response.aclose()
+            _stream_duration.observe(time.perf_counter() - start_time)
+            if not completed:
+                _stream_aborted.inc()
     
     async def rerank(
         self,
@@ -243,6 +398,7 @@ class SiliconFlowClient:
     async def close(self):
         """关闭客户端"""
         await self.http_client.aclose()
+        embedding_cache.close()
 
 
 # 全局客户端实例
@@ -0,0 +1,178 @@
+import re
+import time
+import asyncio
+import logging
+import threading
+from dataclasses import dataclass, field
+from typing import List, Dict, Any, Optional
+
+from app.core.config import settings
+from app.core.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+PLAN_LEXICAL = "lexical"
+PLAN_VECTOR = "vector"
+PLAN_HYBRID = "hybrid"
+
+_plan_counters = {
+    mode: metrics.counter(f"query_plan_{mode}_total", f"检索计划为 {mode} 的请求数")
+    for mode in (PLAN_LEXICAL, PLAN_VECTOR, PLAN_HYBRID)
+}
+_embedding_calls_saved = metrics.counter("query_plan_embedding_calls_saved_total", "检索计划省去的向量化调用次数")
+_embedding_fallbacks = metrics.counter("query_plan_embedding_fallback_total", "向量化超时或失败后退回关键词检索的次数")
+_plan_seconds = metrics.histogram(
+    "query_plan_search_seconds", "按计划执行一次检索的总耗时",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+)
+
+# 延迟 EWMA 的平滑系数
+_EWMA_ALPHA = 0.2
+
+
+@dataclass
+class QueryPlan:
+    """一次检索的执行计划"""
+    mode: str
+    reason: str
+    started_at: float = field(default_factory=time.perf_counter)
+    embedding_seconds: Optional[float] = None
+    fallback: bool = False
+
+    @property
+    def needs_embedding(self) -> bool:
+        return self.mode != PLAN_LEXICAL
+
+
+class EmbeddingHealth:
+    """向量化接口健康度：延迟 EWMA 与连续失败次数"""
+
+    def __init__(self):
+        self.latency_ewma: Optional[float] = None
+        self.consecutive_failures = 0
+        self.last_failure_at = 0.0
+        self.last_observed_at = 0.0
+        self._lock = threading.Lock()
+        metrics.gauge("embedding_api_health", self.stats, "向量化接口健康度")
+
+    def record_success(self, latency: float):
+        with self._lock:
+            self.consecutive_failures = 0
+            self.last_observed_at = time.monotonic()
+            if self.latency_ewma is None:
+                self.latency_ewma = latency
+            else:
+                self.latency_ewma = _EWMA_ALPHA * latency + (1 - _EWMA_ALPHA) * self.latency_ewma
+
+    def record_failure(self, latency: float):
+        """请求失败，失败前的耗时同样计入延迟"""
+        with self._lock:
+            self.consecutive_failures += 1
+            self.last_failure_at = self.last_observed_at = time.monotonic()
+            if latency > 0:
+                previous = self.latency_ewma if self.latency_ewma is not None else latency
+                self.latency_ewma = _EWMA_ALPHA * latency + (1 - _EWMA_ALPHA) * previous
+
+    def is_degraded(self) -> bool:
+        """冷却期内连续失败或平均延迟超出预算时视为降级；冷却期过后重新尝试向量检索"""
+        now = time.monotonic()
+        cooldown = settings.QUERY_PLANNER_COOLDOWN_SECONDS
+        if self.consecutive_failures >= settings.QUERY_PLANNER_FAILURE_THRESHOLD and now - self.last_failure_at < cooldown:
+            return True
+        budget = settings.QUERY_PLANNER_EMBEDDING_BUDGET_MS / 1000
+        return (
+            self.latency_ewma is not None
+            and self.latency_ewma > budget
+            and now - self.last_observed_at < cooldown
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "latency_ewma_ms": round(self.latency_ewma * 1000, 1) if self.latency_ewma is not None else None,
+            "consecutive_failures": self.consecutive_failures,
+            "degraded": self.is_degraded()
+        }
+
+
+class QueryPlanner:
+    """根据查询特征、倒排索引命中和向量化接口状态选择检索方式"""
+
+    def __init__(self):
+        self.health = EmbeddingHealth()
+
+    def observe_embedding(self, task: asyncio.Future, started_at: float):
+        """向量化请求结束时记录健康度（超时退回后请求仍在后台完成，同样计入）"""
+        def _done(future):
+            latency = time.perf_counter() - started_at
+            if future.cancelled():
+                return
+            if future.exception() is not None:
+                self.health.record_failure(latency)
+            elif not future.result().cached:
+                # 缓存命中不代表接口延迟
+                self.health.record_success(latency)
+
+        task.add_done_callback(_done)
+
+    @staticmethod
+    def query_length(query: str) -> int:
+        """去掉空白和标点后的长度"""
+        return len(re.sub(r"[\s\W_]+", "", query))
+
+    def plan(
+        self,
+        query: str,
+        lexical_results: List[Dict[str, Any]],
+        has_embedding: bool,
+        started_at: Optional[float] = None
+    ) -> QueryPlan:
+        """选择检索方式（lexical / vector / hybrid）"""
+        plan = self._choose(query, lexical_results, has_embedding)
+        if started_at is not None:
+            plan.started_at = started_at
+        return plan
+
+    def _choose(self, query: str, lexical_results: List[Dict[str, Any]], has_embedding: bool) -> QueryPlan:
+        if not settings.LEXICAL_INDEX_ENABLED:
+            return QueryPlan(PLAN_VECTOR, "lexical_disabled")
+        if has_embedding:
+            # 已有查询向量，混合检索不增加接口调用
+            if lexical_results:
+                return QueryPlan(PLAN_HYBRID, "embedding_available")
+            return QueryPlan(PLAN_VECTOR, "no_lexical_hits")
+        if not lexical_results:
+            return QueryPlan(PLAN_VECTOR, "no_lexical_hits")
+
+        length = self.query_length(query)
+        if length <= settings.LEXICAL_ONLY_MAX_CHARS:
+            return QueryPlan(PLAN_LEXICAL, "keyword_query")
+        # 较短且所有词项都被同一文本块命中（如专有名词组合）
+        if (
+            length <= settings.QUERY_PLANNER_SHORT_QUERY_CHARS
+            and lexical_results[0]["lexical_score"] >= settings.QUERY_PLANNER_TERM_COVERAGE
+        ):
+            return QueryPlan(PLAN_LEXICAL, "term_coverage")
+        if self.health.is_degraded():
+            return QueryPlan(PLAN_LEXICAL, "embedding_degraded")
+        return QueryPlan(PLAN_HYBRID, "default")
+
+    def record(self, plan: QueryPlan, query: str, result_count: int):
+        """记录计划与耗时"""
+        elapsed = time.perf_counter() - plan.started_at
+        _plan_counters[plan.mode].inc()
+        _plan_seconds.observe(elapsed)
+        if not plan.needs_embedding and not plan.fallback:
+            _embedding_calls_saved.inc()
+        if plan.fallback:
+            _embedding_fallbacks.inc()
+
+        embedding_ms = f"{plan.embedding_seconds * 1000:.0f}ms" if plan.embedding_seconds is not None else "-"
+        # 每次检索都会经过这里，只在 DEBUG 级别记录，且不记录查询原文
+        logger.debug(
+            f"检索计划: 模式={plan.mode}, 原因={plan.reason}, 退回={plan.fallback}, "
+            f"向量化={embedding_ms}, 总耗时={elapsed * 1000:.0f}ms, 查询长度={len(query)}, 结果数={result_count}"
+        )
+
+
+# 全局查询规划器
+query_planner = QueryPlanner()
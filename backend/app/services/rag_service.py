@@ -1,14 +1,19 @@
 import logging
 import re
-from typing import List, Dict, Any, Optional, AsyncGenerator
+import time
+from typing import List, Dict, Any, Optional, AsyncGenerator, Tuple
 from sqlalchemy.orm import Session
 
 from app.core.config import settings
 from app.core.exceptions import QALowConfidenceException, LLMException
+from app.core.singleflight import SingleFlight, StreamSingleFlight
+from app.db.session import SessionLocal
 from app.models.orm import QALog, Chunk, Document
 from app.models.schemas import Citation
 from app.services.llm_client import llm_client, ChatMessage
-from app.services.kb_service import kb_service
+from app.services.kb_service import kb_service, PreparedSearch
+from app.services.answer_cache import AnswerCache
+from app.services.semantic_cache import SemanticAnswerCache
 
 logger = logging.getLogger(__name__)
 
@@ -18,6 +23,13 @@ class RAGService:
     
     def __init__(self):
         self.confidence_threshold = settings.CONFIDENCE_THRESHOLD
+        # 相同 (课程, 标准化问题, top_k) 的并发请求共享一次流水线执行
+        self._answer_flight = SingleFlight("rag_answer")
+        self._stream_flight = StreamSingleFlight("rag_answer_stream")
+        # 精确匹配的答案缓存，键含知识库版本号
+        self._answer_cache = AnswerCache()
+        # 语义缓存：措辞不同但语义相近的问题复用答案
+        self._semantic_cache = SemanticAnswerCache()
     
     async def ask_question(
         self,
@@ -25,8 +37,7 @@ class RAGService:
         user_id: int,
         course_id: int,
         question: str,
-        top_k: int = None,
-        stream: bool = False
+        top_k: int = None
     ) -> Dict[str, Any]:
         """问答"""
         if top_k is None:
@@ -36,43 +47,266 @@ class RAGService:
             # 1. 问题标准化
             normalized_question = self._normalize_question(question)
             
-            # 2. 向量检索
-            search_results = await kb_service.search_knowledge(
-                course_id=course_id,
-                query=normalized_question,
-                top_k=top_k
+            # 2. 查询答案缓存（精确匹配，其次语义相近）
+            result, cache_key, prepared = await self._lookup_cached_answer(
+                db, course_id, normalized_question, top_k
             )
+            cached = result is not None
             
-            if not search_results:
-                return self._create_no_evidence_response(question)
-            
-            # 3. 重排序（可选）
-            if len(search_results) > settings.RERANK_TOP_N:
-                reranked_results = await self._rerank_results(normalized_question, search_results)
-                final_results = reranked_results[:settings.RERANK_TOP_N]
-            else:
-                final_results = search_results
-            
-            # 4. 获取完整文本块信息
-            chunk_details = await self._get_chunk_details(db, final_results)
-            
-            # 5. 构建提示词
-            prompt = self._build_rag_prompt(normalized_question, chunk_details)
-            
-            # 6. LLM生成答案
-            if stream:
-                return await self._generate_answer_stream(
-                    db, user_id, course_id, question, prompt, chunk_details
-                )
-            else:
-                return await self._generate_answer(
-                    db, user_id, course_id, question, prompt, chunk_details
+            # 3. 未命中时，相同问题的并发请求共享一次检索与生成
+            if not cached:
+                start_time = time.perf_counter()
+                result = await self._answer_flight.do(
+                    (course_id, normalized_question, top_k),
+                    lambda: self._run_answer_pipeline(course_id, normalized_question, top_k, prepared)
                 )
+                self._store_answer(cache_key, prepared, result, time.perf_counter() - start_time)
+            
+            # 4. 每个用户各自记录问答日志
+            response = self._finalize_answer(db, user_id, course_id, question, result)
+            response["cached"] = cached
+            return response
                 
         except Exception as e:
             logger.error(f"问答失败: {e}")
             raise LLMException(f"问答服务失败: {e}")
     
+    async def ask_question_stream(
+        self,
+        db: Session,
+        user_id: int,
+        course_id: int,
+        question: str,
+        top_k: int = None
+    ) -> AsyncGenerator[Dict[str, Any], None]:
+        """流式问答"""
+        if top_k is None:
+            top_k = settings.TOP_K
+        
+        normalized_question = self._normalize_question(question)
+        cached_result, cache_key, prepared = await self._lookup_cached_answer(
+            db, course_id, normalized_question, top_k
+        )
+        start_time = time.perf_counter()
+        
+        # 缓存命中时直接返回完整答案
+        if cached_result is not None:
+            async def replay():
+                if not cached_result.get("no_evidence"):
+                    yield {"type": "delta", "text": cached_result["answer"]}
+                yield {"type": "result", "result": cached_result}
+            events = replay()
+        else:
+            # 相同问题的并发流共享一次上游生成，事件扇出给每个订阅者
+            events = self._stream_flight.subscribe(
+                (course_id, normalized_question, top_k),
+                lambda: self._run_answer_stream_pipeline(course_id, normalized_question, top_k, prepared)
+            )
+        try:
+            async for event in events:
+                if event["type"] != "result":
+                    yield event
+                    continue
+                
+                result = event["result"]
+                if cached_result is None:
+                    self._store_answer(cache_key, prepared, result, time.perf_counter() - start_time)
+                response = self._finalize_answer(
+                    db, user_id, course_id, question, result, check_confidence=False
+                )
+                if result.get("no_evidence"):
+                    yield {"type": "delta", "text": response["answer"]}
+                
+                # 发送最终结果
+                yield {
+                    "type": "final",
+                    "qa_id": response["qa_id"],
+                    "confidence": response["confidence"],
+                    "citations": [citation.dict() for citation in response["citations"]],
+                    "cached": cached_result is not None
+                }
+        except Exception as e:
+            logger.error(f"流式问答失败: {e}")
+            yield {"type": "error", "message": str(e)}
+        finally:
+            await events.aclose()
+    
+    def _answer_cache_key(self, db: Session, course_id: int, normalized_question: str, top_k: int) -> tuple:
+        """答案缓存键：课程、标准化问题、top_k 与当前知识库版本号"""
+        generation = kb_service.get_kb_generation(db, course_id)
+        return (course_id, normalized_question, top_k, generation)
+    
+    async def _lookup_cached_answer(
+        self,
+        db: Session,
+        course_id: int,
+        normalized_question: str,
+        top_k: int
+    ) -> Tuple[Optional[Dict[str, Any]], tuple, Optional[PreparedSearch]]:
+        """依次查询精确缓存与语义缓存，返回 (缓存结果, 精确缓存键, 已规划的检索)
+
+        先做检索规划：只有计划需要向量（或向量已在本地缓存）时才有问题向量可查语义缓存，
+        只走关键词检索的问题不为语义缓存额外请求向量化。规划结果随后直接用于检索，不会重复请求。
+        """
+        cache_key = self._answer_cache_key(db, course_id, normalized_question, top_k)
+        result = self._answer_cache.get(cache_key)
+        if result is not None or not settings.SEMANTIC_CACHE_ENABLED:
+            return result, cache_key, None
+        
+        try:
+            prepared = await kb_service.prepare_search(course_id, normalized_question, top_k)
+        except Exception as e:
+            # 检索时会重新规划并报告错误
+            logger.warning(f"检索规划失败，跳过语义缓存: {e}")
+            return None, cache_key, None
+        if prepared.query_embedding is None:
+            return None, cache_key, prepared
+        
+        generation = cache_key[-1]
+        result = self._semantic_cache.get((course_id, top_k), generation, prepared.query_embedding)
+        if result is not None:
+            self._answer_cache.put(cache_key, result)
+        return result, cache_key, prepared
+    
+    def _store_answer(
+        self,
+        cache_key: tuple,
+        prepared: Optional[PreparedSearch],
+        result: Dict[str, Any],
+        latency: float
+    ):
+        """把新生成的答案写入精确缓存和语义缓存"""
+        self._answer_cache.put(cache_key, result)
+        if prepared is not None and prepared.query_embedding is not None and not result.get("no_evidence"):
+            course_id, _, top_k, generation = cache_key
+            self._semantic_cache.put((course_id, top_k), generation, prepared.query_embedding, result, latency)
+    
+    async def _run_answer_pipeline(
+        self,
+        course_id: int,
+        normalized_question: str,
+        top_k: int,
+        prepared: Optional[PreparedSearch] = None
+    ) -> Dict[str, Any]:
+        """问答流水线：检索、重排序、生成（结果与用户无关，可在并发请求间共享）"""
+        db = SessionLocal()
+        try:
+            chunk_details = await self._retrieve_evidence(
+                db, course_id, normalized_question, top_k, prepared
+            )
+            if chunk_details is None:
+                return {"no_evidence": True}
+            
+            prompt = self._build_rag_prompt(normalized_question, chunk_details)
+            return await self._generate_answer(normalized_question, prompt, chunk_details)
+        finally:
+            db.close()
+    
+    async def _run_answer_stream_pipeline(
+        self,
+        course_id: int,
+        normalized_question: str,
+        top_k: int,
+        prepared: Optional[PreparedSearch] = None
+    ) -> AsyncGenerator[Dict[str, Any], None]:
+        """流式问答流水线：产出delta事件，最后产出一个result事件"""
+        db = SessionLocal()
+        try:
+            try:
+                chunk_details = await self._retrieve_evidence(
+                    db, course_id, normalized_question, top_k, prepared
+                )
+            except Exception as e:
+                logger.error(f"流式问答检索失败: {e}")
+                yield {"type": "error", "message": str(e)}
+                return
+            
+            if chunk_details is None:
+                yield {"type": "result", "result": {"no_evidence": True}}
+                return
+            
+            prompt = self._build_rag_prompt(normalized_question, chunk_details)
+            answer_stream = self._generate_answer_stream(normalized_question, prompt, chunk_details)
+            try:
+                async for event in answer_stream:
+                    yield event
+            finally:
+                await answer_stream.aclose()
+        finally:
+            db.close()
+    
+    def _finalize_answer(
+        self,
+        db: Session,
+        user_id: int,
+        course_id: int,
+        question: str,
+        result: Dict[str, Any],
+        check_confidence: bool = True
+    ) -> Dict[str, Any]:
+        """根据共享的生成结果构建单个用户的响应，并保存其问答日志"""
+        if result.get("no_evidence"):
+            return self._create_no_evidence_response(question)
+        
+        answer = result["answer"]
+        confidence = result["confidence"]
+        citations = result["citations"]
+        
+        # 检查置信度
+        if check_confidence and confidence < self.confidence_threshold:
+            return self._create_low_confidence_response(question, answer, confidence, citations)
+        
+        # 保存问答日志
+        qa_log = QALog(
+            user_id=user_id,
+            course_id=course_id,
+            question=question,
+            answer=answer,
+            citations_json=[citation.dict() for citation in citations],
+            confidence=confidence
+        )
+        db.add(qa_log)
+        db.commit()
+        db.refresh(qa_log)
+        
+        return {
+            "qa_id": qa_log.id,
+            "answer": answer,
+            "confidence": confidence,
+            "citations": citations,
+            "followups": result["followups"]
+        }
+    
+    async def _retrieve_evidence(
+        self,
+        db: Session,
+        course_id: int,
+        normalized_question: str,
+        top_k: int,
+        prepared: Optional[PreparedSearch] = None
+    ) -> Optional[List[Dict]]:
+        """检索证据：向量检索、重排序并加载完整文本块，无结果时返回None"""
+        # 向量检索
+        search_results = await kb_service.search_knowledge(
+            course_id=course_id,
+            query=normalized_question,
+            top_k=top_k,
+            prepared=prepared
+        )
+        
+        if not search_results:
+            return None
+        
+        # 重排序（可选）
+        if len(search_results) > settings.RERANK_TOP_N:
+            reranked_results = await self._rerank_results(normalized_question, search_results)
+            final_results = reranked_results[:settings.RERANK_TOP_N]
+        else:
+            final_results = search_results
+        
+        # 获取完整文本块信息
+        return await self._get_chunk_details(db, final_results)
+    
     def _normalize_question(self, question: str) -> str:
         """问题标准化"""
         # 去除多余空格
@@ -171,9 +405,6 @@ class RAGService:
     
     async def _generate_answer(
         self,
-        db: Session,
-        user_id: int,
-        course_id: int,
         question: str,
         prompt: str,
         chunk_details: List[Dict]
@@ -194,38 +425,14 @@ class RAGService:
             
             answer = response.content
             
-            # 计算置信度
-            confidence = self._calculate_confidence(chunk_details, answer)
-            
-            # 提取引用
-            citations = self._extract_citations(chunk_details, answer)
-            
-            # 生成后续问题建议
-            followups = self._generate_followups(question, answer)
-            
-            # 检查置信度
-            if confidence < self.confidence_threshold:
-                return self._create_low_confidence_response(question, answer, confidence, citations)
-            
-            # 保存问答日志
-            qa_log = QALog(
-                user_id=user_id,
-                course_id=course_id,
-                question=question,
-                answer=answer,
-                citations_json=[citation.dict() for citation in citations],
-                confidence=confidence
-            )
-            db.add(qa_log)
-            db.commit()
-            db.refresh(qa_log)
-            
             return {
-                "qa_id": qa_log.id,
                 "answer": answer,
-                "confidence": confidence,
-                "citations": citations,
-                "followups": followups
+                # 计算置信度
+                "confidence": self._calculate_confidence(chunk_details, answer),
+                # 提取引用
+                "citations": self._extract_citations(chunk_details, answer),
+                # 生成后续问题建议
+                "followups": self._generate_followups(question, answer)
             }
             
         except Exception as e:
@@ -234,9 +441,6 @@ class RAGService:
     
     async def _generate_answer_stream(
         self,
-        db: Session,
-        user_id: int,
-        course_id: int,
         question: str,
         prompt: str,
         chunk_details: List[Dict]
@@ -250,38 +454,28 @@ class RAGService:
             
             full_answer = ""
             
-            # 流式生成
-            async for chunk in llm_client.chat_completion_stream(
+            # 流式生成（消费方提前退出时显式关闭上游流）
+            token_stream = llm_client.chat_completion_stream(
                 messages=messages,
                 temperature=0.3,
                 max_tokens=2000
-            ):
-                full_answer += chunk
-                yield {"type": "delta", "text": chunk}
-            
-            # 计算置信度和引用
-            confidence = self._calculate_confidence(chunk_details, full_answer)
-            citations = self._extract_citations(chunk_details, full_answer)
-            
-            # 保存问答日志
-            qa_log = QALog(
-                user_id=user_id,
-                course_id=course_id,
-                question=question,
-                answer=full_answer,
-                citations_json=[citation.dict() for citation in citations],
-                confidence=confidence
             )
-            db.add(qa_log)
-            db.commit()
-            db.refresh(qa_log)
+            try:
+                async for chunk in token_stream:
+                    full_answer += chunk
+                    yield {"type": "delta", "text": chunk}
+            finally:
+                await token_stream.aclose()
             
-            # 发送最终结果
+            # 计算置信度和引用
             yield {
-                "type": "final",
-                "qa_id": qa_log.id,
-                "confidence": confidence,
-                "citations": citations
+                "type": "result",
+                "result": {
+                    "answer": full_answer,
+                    "confidence": self._calculate_confidence(chunk_details, full_answer),
+                    "citations": self._extract_citations(chunk_details, full_answer),
+                    "followups": self._generate_followups(question, full_answer)
+                }
             }
             
         except Exception as e:
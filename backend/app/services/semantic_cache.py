@@ -0,0 +1,117 @@
+import time
+import threading
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+from app.core.config import settings
+from app.core.metrics import metrics
+
+_semantic_hits = metrics.counter("semantic_cache_hits_total", "语义缓存命中次数")
+_semantic_misses = metrics.counter("semantic_cache_misses_total", "语义缓存未命中次数")
+_semantic_saved_seconds = metrics.histogram(
+    "semantic_cache_saved_seconds", "语义缓存命中所节省的生成耗时",
+    buckets=(0.5, 1.0, 2.0, 3.0, 5.0, 8.0, 13.0, 21.0)
+)
+_semantic_best_similarity = metrics.histogram(
+    "semantic_cache_best_similarity", "每次查询的最高余弦相似度（用于调节阈值）",
+    buckets=(0.5, 0.6, 0.7, 0.8, 0.85, 0.88, 0.9, 0.92, 0.94, 0.96, 0.98, 1.0)
+)
+
+
+class _SemanticIndex:
+    """单个 (课程, top_k) 的问题向量索引"""
+
+    def __init__(self, generation: int, capacity: int):
+        self.generation = generation
+        self.capacity = capacity
+        self.vectors: Optional[np.ndarray] = None
+        self.entries: List[Dict[str, Any]] = []
+
+    def search(self, vector: np.ndarray) -> Tuple[int, float]:
+        """返回最相似条目的下标和余弦相似度"""
+        if not self.entries:
+            return -1, 0.0
+        scores = self.vectors[:len(self.entries)] @ vector
+        best = int(np.argmax(scores))
+        return best, float(scores[best])
+
+    def add(self, vector: np.ndarray, entry: Dict[str, Any]):
+        """加入一个条目，满时替换最久未命中的条目"""
+        if self.vectors is None:
+            self.vectors = np.zeros((self.capacity, vector.shape[0]), dtype=np.float32)
+
+        if len(self.entries) < self.capacity:
+            slot = len(self.entries)
+            self.entries.append(entry)
+        else:
+            slot = min(range(len(self.entries)), key=lambda i: self.entries[i]["last_used"])
+            self.entries[slot] = entry
+        self.vectors[slot] = vector
+
+
+class SemanticAnswerCache:
+    """语义答案缓存：问题向量与已缓存问题的余弦相似度超过阈值时直接复用答案"""
+
+    def __init__(self, threshold: float = None, max_entries: int = None, ttl_seconds: float = None):
+        self.threshold = threshold if threshold is not None else settings.SEMANTIC_CACHE_THRESHOLD
+        self.max_entries = max_entries or settings.SEMANTIC_CACHE_MAX_ENTRIES
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else settings.ANSWER_CACHE_TTL_SECONDS
+        self._indexes: Dict[Hashable, _SemanticIndex] = {}
+        self._lock = threading.Lock()
+        metrics.gauge("semantic_cache", self.stats, "语义缓存状态")
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = float(np.linalg.norm(vector))
+        return vector / norm if norm > 0 else vector
+
+    def _get_index(self, key: Hashable, generation: int) -> _SemanticIndex:
+        """获取索引，知识库版本变化时整体丢弃旧索引"""
+        index = self._indexes.get(key)
+        if index is None or index.generation != generation:
+            index = _SemanticIndex(generation, self.max_entries)
+            self._indexes[key] = index
+        return index
+
+    def get(self, key: Hashable, generation: int, embedding: List[float]) -> Optional[Any]:
+        """查找语义相近的已缓存答案"""
+        vector = self._normalize(embedding)
+        with self._lock:
+            index = self._get_index(key, generation)
+            slot, similarity = index.search(vector)
+            if slot >= 0:
+                _semantic_best_similarity.observe(similarity)
+                entry = index.entries[slot]
+                if similarity >= self.threshold and entry["expires_at"] > time.monotonic():
+                    entry["last_used"] = time.monotonic()
+                    _semantic_hits.inc()
+                    _semantic_saved_seconds.observe(entry["latency"])
+                    return entry["result"]
+
+        _semantic_misses.inc()
+        return None
+
+    def put(self, key: Hashable, generation: int, embedding: List[float], result: Any, latency: float):
+        """缓存一个问题的答案，latency 为生成该答案的耗时"""
+        vector = self._normalize(embedding)
+        now = time.monotonic()
+        with self._lock:
+            index = self._get_index(key, generation)
+            index.add(vector, {
+                "result": result,
+                "latency": latency,
+                "expires_at": now + self.ttl_seconds,
+                "last_used": now
+            })
+
+    def stats(self) -> Dict[str, Any]:
+        """缓存统计"""
+        lookups = _semantic_hits.value + _semantic_misses.value
+        return {
+            "indexes": len(self._indexes),
+            "entries": sum(len(index.entries) for index in self._indexes.values()),
+            "threshold": self.threshold,
+            "hit_rate": round(_semantic_hits.value / lookups, 4) if lookups else 0.0
+        }
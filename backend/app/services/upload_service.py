@@ -0,0 +1,252 @@
+import os
+import uuid
+import shutil
+import asyncio
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.core.exceptions import KBUploadFailedException, UploadSessionNotFoundException
+from app.models.orm import Document, UploadPart, UploadSession
+from app.services.kb_service import kb_service
+
+logger = logging.getLogger(__name__)
+
+# 分片编号上限
+MAX_PART_NUMBER = 10000
+
+
+class UploadService:
+    """断点续传上传：分片直接写入磁盘并校验，完成时按顺序拼接后进入常规文档上传流程"""
+    
+    @staticmethod
+    def _session_dir(upload_id: str) -> str:
+        return f"{settings.STORAGE_DIR}/uploads/{upload_id}"
+    
+    def _part_path(self, upload_id: str, part_number: int) -> str:
+        return f"{self._session_dir(upload_id)}/{part_number}.part"
+    
+    def create_session(
+        self,
+        db: Session,
+        user_id: int,
+        course_id: int,
+        file_name: str,
+        total_size: Optional[int] = None
+    ) -> UploadSession:
+        """创建上传会话"""
+        file_type = file_name.split('.')[-1] if '.' in file_name else ''
+        if file_type.lower() not in [ft.lower() for ft in settings.ALLOWED_FILE_TYPES]:
+            raise KBUploadFailedException(f"不支持的文件类型: {file_type}")
+        max_size = settings.get_resumable_upload_max_bytes()
+        if total_size is not None and total_size > max_size:
+            raise KBUploadFailedException(f"文件过大: {total_size} bytes, 最大允许: {max_size} bytes")
+        
+        self.cleanup_expired(db)
+        
+        session = UploadSession(
+            upload_id=str(uuid.uuid4()),
+            user_id=user_id,
+            course_id=course_id,
+            file_name=file_name,
+            file_type=file_type,
+            total_size=total_size,
+            status="open"
+        )
+        db.add(session)
+        db.commit()
+        db.refresh(session)
+        os.makedirs(self._session_dir(session.upload_id), exist_ok=True)
+        
+        logger.info(f"上传会话创建: {session.upload_id}, {file_name}")
+        return session
+    
+    def get_session(self, db: Session, upload_id: str, user_id: Optional[int] = None) -> UploadSession:
+        """获取上传会话；指定 user_id 时只能访问自己创建的会话"""
+        query = db.query(UploadSession).filter(UploadSession.upload_id == upload_id)
+        if user_id is not None:
+            query = query.filter(UploadSession.user_id == user_id)
+        session = query.first()
+        if not session:
+            raise UploadSessionNotFoundException(upload_id)
+        return session
+    
+    async def write_part(
+        self,
+        db: Session,
+        session: UploadSession,
+        part_number: int,
+        stream: AsyncIterator[bytes],
+        expected_sha256: Optional[str] = None
+    ) -> UploadPart:
+        """接收一个分片：边写磁盘边计算 SHA-256，校验后原子替换；重传同一编号的分片会覆盖旧分片"""
+        if session.status != "open":
+            raise KBUploadFailedException(f"上传会话已结束: {session.status}")
+        if not 1 <= part_number <= MAX_PART_NUMBER:
+            raise KBUploadFailedException(f"分片编号超出范围: {part_number}")
+        
+        part_max = settings.get_upload_part_max_bytes()
+        received = sum(part.size for part in session.parts if part.part_number != part_number)
+        remaining = settings.get_resumable_upload_max_bytes() - received
+        
+        part_path = self._part_path(session.upload_id, part_number)
+        temp_path = f"{part_path}.{uuid.uuid4().hex[:8]}.tmp"
+        os.makedirs(os.path.dirname(part_path), exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        # 请求体按小块到达，攒满 UPLOAD_BLOCK_SIZE 后在线程中写盘，避免阻塞事件循环
+        buffer = bytearray()
+        try:
+            with open(temp_path, 'wb') as f:
+                async for block in stream:
+                    size += len(block)
+                    if size > part_max:
+                        raise KBUploadFailedException(f"分片过大: 超过 {part_max} bytes")
+                    if size > remaining:
+                        raise KBUploadFailedException(
+                            f"文件过大: 超过 {settings.get_resumable_upload_max_bytes()} bytes"
+                        )
+                    digest.update(block)
+                    buffer += block
+                    if len(buffer) >= settings.UPLOAD_BLOCK_SIZE:
+                        await asyncio.to_thread(f.write, bytes(buffer))
+                        buffer.clear()
+                if buffer:
+                    await asyncio.to_thread(f.write, bytes(buffer))
+            
+            sha256 = digest.hexdigest()
+            if expected_sha256 and expected_sha256.lower() != sha256:
+                raise KBUploadFailedException(f"分片校验失败: 期望 {expected_sha256}, 实际 {sha256}")
+            os.replace(temp_path, part_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        
+        part = next((part for part in session.parts if part.part_number == part_number), None)
+        if part is None:
+            part = UploadPart(part_number=part_number, size=size, sha256=sha256)
+            session.parts.append(part)
+        else:
+            part.size = size
+            part.sha256 = sha256
+        session.updated_at = datetime.utcnow()
+        try:
+            db.commit()
+        except IntegrityError:
+            # 同一编号的并发请求已先插入分片记录，改为更新该记录
+            db.rollback()
+            part = db.query(UploadPart).filter(
+                UploadPart.session_id == session.id,
+                UploadPart.part_number == part_number
+            ).one()
+            part.size = size
+            part.sha256 = sha256
+            session.updated_at = datetime.utcnow()
+            db.commit()
+        
+        logger.debug(f"分片接收完成: {session.upload_id} #{part_number}, {size} bytes")
+        return part
+    
+    def _assemble(self, session: UploadSession, part_numbers: List[int]) -> Tuple[str, str]:
+        """按编号顺序把分片逐块拷贝到临时文件并计算整体哈希（在线程中执行）"""
+        temp_dir = f"{settings.STORAGE_DIR}/tmp"
+        os.makedirs(temp_dir, exist_ok=True)
+        temp_path = f"{temp_dir}/{uuid.uuid4()}.part"
+        digest = hashlib.sha256()
+        try:
+            with open(temp_path, 'wb') as out:
+                for part_number in part_numbers:
+                    with open(self._part_path(session.upload_id, part_number), 'rb') as f:
+                        for block in iter(lambda: f.read(settings.UPLOAD_BLOCK_SIZE), b""):
+                            digest.update(block)
+                            out.write(block)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        return temp_path, digest.hexdigest()
+    
+    async def complete(self, db: Session, session: UploadSession) -> Tuple[Document, bool]:
+        """拼接分片并登记为文档（内容重复时复用已有文档）；重复调用返回同一文档"""
+        if session.status == "completed":
+            document = db.query(Document).filter(Document.id == session.document_id).first()
+            if document:
+                return document, False
+        if session.status != "open":
+            raise KBUploadFailedException(f"上传会话已结束: {session.status}")
+        
+        part_numbers = sorted(part.part_number for part in session.parts)
+        if not part_numbers:
+            raise KBUploadFailedException("没有已上传的分片")
+        missing = sorted(set(range(1, part_numbers[-1] + 1)) - set(part_numbers))
+        if missing:
+            raise KBUploadFailedException(f"缺少分片: {missing[:20]}")
+        total = sum(part.size for part in session.parts)
+        if session.total_size is not None and total != session.total_size:
+            raise KBUploadFailedException(f"文件大小不一致: 声明 {session.total_size} bytes, 实际 {total} bytes")
+        
+        temp_path, content_hash = await asyncio.to_thread(self._assemble, session, part_numbers)
+        try:
+            document, deduplicated = kb_service.add_uploaded_file(
+                db, session.course_id, session.file_name, session.file_type, temp_path, content_hash
+            )
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        
+        session.status = "completed"
+        session.document_id = document.id
+        db.commit()
+        shutil.rmtree(self._session_dir(session.upload_id), ignore_errors=True)
+        
+        logger.info(f"分片上传完成: {session.upload_id} -> 文档 {document.id}, {len(part_numbers)} 个分片, {total} bytes")
+        return document, deduplicated
+    
+    def abort(self, db: Session, session: UploadSession):
+        """取消上传并删除已接收的分片"""
+        if session.status == "open":
+            session.status = "aborted"
+            db.commit()
+        shutil.rmtree(self._session_dir(session.upload_id), ignore_errors=True)
+        logger.info(f"上传会话已取消: {session.upload_id}")
+    
+    def cleanup_expired(self, db: Session) -> int:
+        """清理超时未完成的上传会话"""
+        deadline = datetime.utcnow() - timedelta(hours=settings.UPLOAD_SESSION_TTL_HOURS)
+        expired = db.query(UploadSession).filter(
+            UploadSession.status == "open",
+            UploadSession.updated_at < deadline
+        ).all()
+        for session in expired:
+            session.status = "aborted"
+            shutil.rmtree(self._session_dir(session.upload_id), ignore_errors=True)
+        if expired:
+            db.commit()
+            logger.info(f"已清理 {len(expired)} 个过期的上传会话")
+        return len(expired)
+    
+    def describe(self, session: UploadSession) -> Dict[str, Any]:
+        """会话状态（客户端据此判断需要续传哪些分片）"""
+        parts = sorted(session.parts, key=lambda part: part.part_number)
+        return {
+            "upload_id": session.upload_id,
+            "course_id": session.course_id,
+            "file_name": session.file_name,
+            "status": session.status,
+            "total_size": session.total_size,
+            "received_bytes": sum(part.size for part in parts),
+            "part_max_size": settings.get_upload_part_max_bytes(),
+            "parts": [
+                {"part_number": part.part_number, "size": part.size, "sha256": part.sha256}
+                for part in parts
+            ],
+            "document_id": session.document_id
+        }
+
+
+# 全局服务实例
+upload_service = UploadService()
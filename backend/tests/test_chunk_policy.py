@@ -0,0 +1,43 @@
+import pytest
+from pydantic import ValidationError
+
+from app.core.config import settings
+from app.kb.chunker import TextChunker
+from app.models.schemas import ChunkPolicy, ChunkLengthUnit
+
+
+def _round_trip(payload):
+    """与入库队列相同：序列化为 JSON 后再解析"""
+    policy = ChunkPolicy(**payload)
+    stored = policy.model_dump(mode="json", exclude_unset=True)
+    return TextChunker.from_policy(ChunkPolicy(**stored) if stored else None)
+
+
+def test_legacy_char_policy_uses_chars(monkeypatch):
+    """旧版请求只给出 max_chars/overlap 时按字符计长，即使默认单位是 tokens"""
+    monkeypatch.setattr(settings, "CHUNK_LENGTH_UNIT", "tokens")
+    chunker = _round_trip({"max_chars": 500, "overlap": 50})
+    assert (chunker.unit, chunker.chunk_size, chunker.overlap) == ("chars", 500, 50)
+
+
+def test_token_fields_use_tokens(monkeypatch):
+    monkeypatch.setattr(settings, "CHUNK_LENGTH_UNIT", "chars")
+    chunker = _round_trip({"max_tokens": 200, "overlap_tokens": 20})
+    assert (chunker.unit, chunker.chunk_size, chunker.overlap) == ("tokens", 200, 20)
+
+
+def test_empty_policy_uses_default_unit(monkeypatch):
+    monkeypatch.setattr(settings, "CHUNK_LENGTH_UNIT", "tokens")
+    assert ChunkPolicy().unit is None
+    assert _round_trip({}).unit == "tokens"
+
+
+def test_mixed_fields_without_unit_rejected():
+    with pytest.raises(ValidationError):
+        ChunkPolicy(max_chars=500, max_tokens=200)
+
+
+def test_explicit_unit_wins():
+    policy = ChunkPolicy(unit="chars", max_chars=600, max_tokens=200)
+    assert policy.unit == ChunkLengthUnit.CHARS
+    assert TextChunker.from_policy(policy).chunk_size == 600
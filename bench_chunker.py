@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+文本分块基准测试
+在原子物理学教案上比较逐窗口 rfind 查找句子边界（旧实现）与预计算边界 + 二分查找（TextChunker）的耗时
+"""
+
+import re
+import sys
+import time
+import argparse
+from pathlib import Path
+
+# 自动检测项目根目录（脚本所在目录）
+project_root = Path(__file__).parent.resolve()
+backend_dir = project_root / "backend"
+sys.path.insert(0, str(backend_dir))
+
+from app.kb.parser import DocumentParser
+from app.kb.chunker import TextChunker
+
+# 教案文件夹路径
+TEACHING_MATERIALS_DIR = project_root / "原子物理学-教案"
+
+SUPPORTED_EXTENSIONS = {
+    '.pdf': 'pdf',
+    '.docx': 'docx',
+    '.pptx': 'pptx',
+    '.md': 'md',
+    '.txt': 'txt'
+}
+
+
+def legacy_split(text: str, chunk_size: int, overlap: int):
+    """旧实现：每个窗口对 7 种结束符各做一次 rfind"""
+    if len(text) <= chunk_size:
+        return [text]
+
+    def find_sentence_boundary(start, preferred_end):
+        search_start = max(start, preferred_end - 100)
+        search_end = min(len(text), preferred_end + 100)
+        best_pos = preferred_end
+        for ending in ['。', '！', '？', '.', '!', '?', '\n\n']:
+            pos = text.rfind(ending, search_start, search_end)
+            if pos > start and abs(pos - preferred_end) < abs(best_pos - preferred_end):
+                best_pos = pos + len(ending)
+        return best_pos
+
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = start + chunk_size
+        if end < len(text):
+            sentence_end = find_sentence_boundary(start, end)
+            if sentence_end > start:
+                end = sentence_end
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        if end >= len(text):
+            break
+        start = max(start + 1, end - overlap)
+    return chunks
+
+
+def load_corpus() -> str:
+    """解析教案目录下的全部文件，拼接为一本“教材”"""
+    texts = []
+    for file_path in sorted(TEACHING_MATERIALS_DIR.iterdir()):
+        file_type = SUPPORTED_EXTENSIONS.get(file_path.suffix.lower())
+        if not file_type:
+            continue
+        started = time.perf_counter()
+        parsed = DocumentParser.parse_file(str(file_path), file_type)
+        texts.append(parsed["raw_text"])
+        print(f"  解析 {file_path.name}: {len(parsed['raw_text'])} 字符, {time.perf_counter() - started:.2f}s")
+    return "\n\n".join(texts)
+
+
+def best_of(func, repeat: int):
+    best = None
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def run_case(name: str, text: str, chunk_size: int, overlap: int, repeat: int):
+    chunker = TextChunker(chunk_size=chunk_size, overlap=overlap, unit="chars")
+    legacy_seconds, legacy_chunks = best_of(lambda: legacy_split(text, chunk_size, overlap), repeat)
+    new_seconds, new_chunks = best_of(lambda: chunker._split_text_with_overlap(text), repeat)
+    print(
+        f"  {name:<28} size={chunk_size:<5} overlap={overlap:<5} "
+        f"旧 {legacy_seconds * 1000:9.1f}ms ({len(legacy_chunks):>6} 块)  "
+        f"新 {new_seconds * 1000:8.1f}ms ({len(new_chunks):>5} 块)  "
+        f"加速 {legacy_seconds / new_seconds:6.1f}x"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="文本分块基准测试")
+    parser.add_argument("--repeat", type=int, default=3, help="每个用例重复次数，取最快一次")
+    args = parser.parse_args()
+
+    if not TEACHING_MATERIALS_DIR.exists():
+        print(f"✗ 教案目录不存在: {TEACHING_MATERIALS_DIR}")
+        return
+
+    print("解析教案:")
+    text = load_corpus()
+    # 去掉全部句末标点和空行：找不到句子边界时的最坏情况
+    unpunctuated = re.sub(r"[。！？.!?]|\n\n", " ", text)
+    print(f"\n全书 {len(text)} 字符\n")
+
+    for chunk_size, overlap in ((800, 120), (400, 200), (200, 150)):
+        run_case("教材全文", text, chunk_size, overlap, args.repeat)
+        run_case("教材全文（无句末标点）", unpunctuated, chunk_size, overlap, args.repeat)
+
+    # 重叠不小于块大小时旧实现每个窗口只前进 1 个字符；取前 100K 字符避免运行过久
+    sample = unpunctuated[:100_000]
+    run_case("前 100K 字符（重叠 ≥ 块大小）", sample, 200, 200, 1)
+
+    # 线性：文本长度翻倍，耗时约翻倍
+    print("\n新实现随文本长度的耗时:")
+    chunker = TextChunker(chunk_size=800, overlap=120, unit="chars")
+    for factor in (1, 2, 4):
+        scaled = text * factor
+        seconds, chunks = best_of(lambda: chunker._split_text_with_overlap(scaled), args.repeat)
+        print(f"  {len(scaled):>9} 字符: {seconds * 1000:8.1f}ms, {len(chunks)} 块")
+
+
+if __name__ == "__main__":
+    main()
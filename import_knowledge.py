@@ -18,7 +18,8 @@ sys.path.insert(0, str(backend_dir))
 os.chdir(backend_dir)
 
 from sqlalchemy.orm import Session
-from app.db.session import SessionLocal
+from app.db.session import SessionLocal, engine
+from app.db.migrations import upgrade_schema
 from app.models.orm import Course, Document
 from app.services.kb_service import kb_service
 
@@ -38,10 +39,6 @@ SUPPORTED_EXTENSIONS = {
 async def import_document(db: Session, course_id: int, file_path: Path):
     """导入单个文档"""
     try:
-        # 读取文件
-        with open(file_path, 'rb') as f:
-            file_content = f.read()
-        
         file_name = file_path.name
         file_ext = file_path.suffix.lower()
         file_type = SUPPORTED_EXTENSIONS.get(file_ext)
@@ -50,16 +47,21 @@ async def import_document(db: Session, course_id: int, file_path: Path):
             print(f"  ⊘ 跳过不支持的文件类型: {file_name}")
             return None
         
-        print(f"  → 上传文档: {file_name} ({len(file_content) / 1024:.1f} KB)")
+        print(f"  → 上传文档: {file_name} ({file_path.stat().st_size / 1024:.1f} KB)")
         
-        # 上传文档
-        document = await kb_service.upload_document(
-            db=db,
-            course_id=course_id,
-            file_name=file_name,
-            file_content=file_content,
-            file_type=file_type
-        )
+        # 上传文档（按块复制，不整体读入内存）
+        with open(file_path, 'rb') as f:
+            document, deduplicated = await kb_service.upload_document_stream(
+                db=db,
+                course_id=course_id,
+                file_name=file_name,
+                stream=f,
+                file_type=file_type
+            )
+        
+        if deduplicated and document.status == "ready":
+            print(f"  ⊘ 内容与已入库文档相同，复用文档ID: {document.id}")
+            return document
         
         print(f"  ✓ 上传成功，文档ID: {document.id}")
         
@@ -131,6 +133,9 @@ async def import_all_documents():
         file_size = file_path.stat().st_size / 1024
         print(f"  {i}. {file_path.name} ({file_size:.1f} KB)")
     
+    # 为旧数据库补齐新增的列
+    upgrade_schema(engine)
+    
     # 获取数据库会话
     db = SessionLocal()
     